@@ -0,0 +1,135 @@
+"""
+Binary attachments for array valued messages.
+
+A message with NumPy arrays is sent as one binary payload:
+
+    MAGIC | header length (uint32, big endian) | JSON header | buffers
+
+The header holds the message with every array replaced by
+{"$attachment": index} and, per attachment, its dtype, shape and offset
+from the first buffer. Buffers start on ALIGN byte boundaries, so decode()
+returns read-only arrays built with frombuffer over the received bytes,
+without a copy or per element parsing.
+"""
+import logging
+from . import codec
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QNA1"
+CONTENT_TYPE = "application/x-quantnet-attachments"
+ALIGN = 8
+_PREFIX = len(MAGIC) + 4
+
+
+def is_attachment(payload):
+    """ check if a received payload carries attachments """
+    return isinstance(payload, (bytes, bytearray, memoryview)) and payload[:len(MAGIC)] == MAGIC
+
+
+_CONTAINERS = (dict, list, tuple)
+
+
+def has_arrays(msg):
+    """ check if a message contains NumPy arrays, anywhere encode() would find them.
+
+    Only the containers of a list are searched, the scalars of plain number
+    lists cost one type check each.
+    """
+    if np is None:
+        return False
+    if isinstance(msg, np.ndarray):
+        return True
+    if isinstance(msg, dict):
+        msg = msg.values()
+    elif not isinstance(msg, (list, tuple)):
+        return False
+    return any(isinstance(v, np.ndarray) or isinstance(v, _CONTAINERS) and has_arrays(v) for v in msg)
+
+
+def _json_default(obj):
+    # NumPy scalars in the message body
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def encode(msg):
+    """ serialize a message with its arrays as attachments, returns bytes """
+    arrays = []
+
+    def strip(obj):
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject:
+                raise TypeError("object arrays can not be attached")
+            arrays.append(np.ascontiguousarray(obj))
+            return {"$attachment": len(arrays) - 1}
+        if isinstance(obj, dict):
+            return {k: strip(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [strip(v) for v in obj]
+        return obj
+
+    body = strip(msg)
+    specs = []
+    offset = 0
+    for a in arrays:
+        specs.append({"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset})
+        offset += _aligned(a.nbytes)
+
+    header = codec.dumps({"msg": body, "attachments": specs}, default=_json_default)
+    pad = _aligned(_PREFIX + len(header)) - _PREFIX - len(header)
+    parts = [MAGIC, len(header).to_bytes(4, "big"), header, bytes(pad)]
+    for a in arrays:
+        parts.append(a.data)
+        if a.nbytes % ALIGN:
+            parts.append(bytes(-a.nbytes % ALIGN))
+    return b"".join(parts)
+
+
+def header(payload):
+    """ the raw JSON header of a payload with attachments """
+    size = int.from_bytes(payload[len(MAGIC):_PREFIX], "big")
+    return bytes(payload[_PREFIX:_PREFIX + size])
+
+
+def decode(payload):
+    """ return the message of a payload with attachments, arrays are views of payload """
+    if np is None:
+        raise ImportError("numpy is required to decode attachments")
+    if not is_attachment(payload):
+        raise ValueError("payload has no attachments")
+    size = int.from_bytes(payload[len(MAGIC):_PREFIX], "big")
+    header = codec.loads(bytes(payload[_PREFIX:_PREFIX + size]))
+    # attachment offsets are relative to the aligned end of the header
+    start = _aligned(_PREFIX + size)
+    arrays = []
+    for spec in header["attachments"]:
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        count = 1
+        for n in shape:
+            count *= n
+        arr = np.frombuffer(payload, dtype=dtype, count=count, offset=start + spec["offset"])
+        arrays.append(arr.reshape(shape))
+
+    def restore(obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and "$attachment" in obj:
+                return arrays[obj["$attachment"]]
+            return {k: restore(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [restore(v) for v in obj]
+        return obj
+
+    return restore(header["msg"])
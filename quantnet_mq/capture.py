@@ -0,0 +1,341 @@
+"""
+Record and replay of MQTT traffic.
+
+A capture log is an append-only binary file:
+
+    header   MAGIC, wall clock time of the start (float64)
+    record   kind (u8), flags (u8), timestamp (float64), topic length (u16),
+             properties length (u32), payload length (u32), topic, properties, payload
+
+Integers are little endian. The timestamp is the monotonic time in seconds
+since the start, the flags are the QoS and the retain bit (0x4) and the
+properties are MQTT5 encoded. Every index_interval messages an index record
+lists (timestamp, offset) of the messages since the previous index, with the
+offset of the previous index record first. Closing the log appends a
+trailer with the offset of the last index record; a log without trailer,
+e.g. after a crash, is indexed by scanning it.
+"""
+import asyncio
+import bisect
+import logging
+import mmap
+import struct
+import time
+from collections import namedtuple
+from gmqtt.mqtt.property import Property
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QNCAP\x01\r\n"
+HEADER = struct.Struct("<8sd")
+RECORD = struct.Struct("<BBdHII")
+TRAILER = struct.Struct("<8sQ")
+TRAILER_MAGIC = b"QNCAPEND"
+INDEX_ENTRY = struct.Struct("<dQ")
+INDEX_PREV = struct.Struct("<Q")
+
+MESSAGE = 1
+INDEX = 2
+RETAIN = 0x4
+NO_INDEX = 0xFFFFFFFFFFFFFFFF
+
+# properties of the receiving connection, not of the message
+SKIPPED_PROPERTIES = ("dup", "retain", "topic_alias", "subscription_identifier")
+
+CapturedMessage = namedtuple("CapturedMessage", ["ts", "topic", "qos", "retain", "properties", "payload"])
+
+
+_encoded = {}
+
+
+def encode_properties(properties):
+    """ MQTT5 encoding of the properties of a received message """
+    out = []
+    for name, values in properties.items():
+        if name in SKIPPED_PROPERTIES:
+            continue
+        for value in values if isinstance(values, list) else (values,):
+            if name == "correlation_data":
+                out.append(b"\x09" + len(value).to_bytes(2, "big") + value)
+                continue
+            # the other properties, e.g. response topics, repeat from message to message
+            key = (name, value)
+            data = _encoded.get(key)
+            if data is None:
+                prop = Property.factory(name=name)
+                if prop is None:
+                    break
+                if len(_encoded) >= 4096:
+                    _encoded.clear()
+                data = _encoded[key] = bytes(prop.dumps(value))
+            out.append(data)
+    return b"".join(out)
+
+
+def decode_properties(data):
+    """ properties as publish keyword arguments """
+    properties = {}
+    data = bytes(data)
+    while data:
+        prop = Property.factory(id_=data[0])
+        if prop is None:
+            raise ValueError(f"invalid property id {data[0]}")
+        result, data = prop.loads(data[1:])
+        for name, value in result.items():
+            if name == "user_property":
+                properties.setdefault(name, []).append(value)
+            else:
+                properties[name] = value
+    return properties
+
+
+class Recorder:
+    """ Appends received messages to a capture log
+
+    record() has the signature of the gmqtt on_message callback less the
+    client, pass it as the recorder keyword argument of MsgServer or
+    RPCServer, or subscribe() it to topics of a client. Records are
+    buffered in memory and written flush_size bytes at a time.
+
+    Parameters
+    ----------
+    path: str
+        File of the capture log, appended to if it exists
+    flush_size: int
+        Bytes buffered before a write
+    index_interval: int
+        Messages between index records
+    """
+
+    def __init__(self, path, flush_size=1 << 20, index_interval=4096):
+        self._file = open(path, "ab")
+        self._flush_size = flush_size
+        self._index_interval = index_interval
+        self._buffer = bytearray()
+        self._start = time.monotonic()
+        # a reopened file gets another log
+        self._buffer += HEADER.pack(MAGIC, time.time())
+        self._offset = self._file.tell() + len(self._buffer)
+        self._index = []
+        self._last_index = NO_INDEX
+        self.messages = 0
+
+    def record(self, topic, payload, qos=0, properties=None):
+        """ append a message """
+        props = b""
+        flags = qos
+        if properties:
+            if properties.get("retain"):
+                flags |= RETAIN
+            # only dup and retain is the common case, nothing to encode
+            if len(properties) > 2 or "dup" not in properties:
+                props = encode_properties(properties)
+        if isinstance(topic, str):
+            topic = topic.encode("utf-8")
+        ts = time.monotonic() - self._start
+        buf = self._buffer
+        buf += RECORD.pack(MESSAGE, flags, ts, len(topic), len(props), len(payload))
+        buf += topic
+        buf += props
+        buf += payload
+        self._index.append((ts, self._offset))
+        self._offset += RECORD.size + len(topic) + len(props) + len(payload)
+        self.messages += 1
+        if len(self._index) >= self._index_interval:
+            self._write_index(ts)
+        if len(buf) >= self._flush_size:
+            self.flush()
+
+    async def on_message(self, client, topic, payload, qos, properties):
+        """ gmqtt on_message callback """
+        self.record(topic, payload, qos, properties)
+
+    def subscribe(self, client, *topics, qos=2):
+        """ record every message of topics, wildcards included, received by a gmqtt client """
+        client.on_message = self.on_message
+        for topic in topics:
+            client.subscribe(topic, qos)
+
+    def _write_index(self, ts):
+        entries = b"".join(INDEX_ENTRY.pack(t, o) for t, o in self._index)
+        payload = INDEX_PREV.pack(self._last_index) + entries
+        self._buffer += RECORD.pack(INDEX, 0, ts, 0, 0, len(payload))
+        self._buffer += payload
+        self._last_index = self._offset
+        self._offset += RECORD.size + len(payload)
+        self._index = []
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._index:
+            self._write_index(time.monotonic() - self._start)
+        self._buffer += TRAILER.pack(TRAILER_MAGIC, self._last_index)
+        self._offset += TRAILER.size
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureLog:
+    """ Memory-mapped capture log, iterates over the recorded messages
+
+    Several logs appended to one file (a Recorder reopened the file) are
+    read as one, the timestamps of the later logs are offset by their wall
+    clock start time.
+    """
+
+    def __init__(self, path):
+        self._fh = open(path, "rb")
+        self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, self.start_time = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a capture log")
+        self._times = None
+        self._offsets = None
+
+    def close(self):
+        if self._map is not None:
+            self._view.release()
+            self._map.close()
+            self._map = None
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _records(self, offset=HEADER.size):
+        """ (kind, offset, record) of the records from offset """
+        data = self._map
+        end = len(data)
+        base = last = 0.0
+        while offset + RECORD.size <= end:
+            if data[offset:offset + 8] == TRAILER_MAGIC:
+                offset += TRAILER.size
+                continue
+            if data[offset:offset + 8] == MAGIC:
+                # the next log of the file
+                base = max(last, HEADER.unpack_from(data, offset)[1] - self.start_time)
+                offset += HEADER.size
+                continue
+            kind, flags, ts, tlen, plen, length = RECORD.unpack_from(data, offset)
+            size = RECORD.size + tlen + plen + length
+            if offset + size > end:
+                logger.warning(f"truncated record at offset {offset}")
+                break
+            last = base + ts
+            yield kind, offset, (flags, last, tlen, plen, length)
+            offset += size
+
+    def index(self):
+        """ the sorted (timestamps, offsets) of the messages """
+        if self._times is None:
+            indexed = self.indexed_offsets()
+            if indexed and indexed[0][1] == HEADER.size:
+                # the index records cover the whole file, a single log
+                self._times = [ts for ts, _ in indexed]
+                self._offsets = [offset for _, offset in indexed]
+                return self._times, self._offsets
+            times, offsets = [], []
+            for kind, offset, (_, ts, _, _, _) in self._records():
+                if kind == MESSAGE:
+                    times.append(ts)
+                    offsets.append(offset)
+            self._times, self._offsets = times, offsets
+        return self._times, self._offsets
+
+    def indexed_offsets(self):
+        """ (timestamp, offset) of the messages from the index records of the last log, by the trailer """
+        size = len(self._map)
+        if size < TRAILER.size:
+            return None
+        magic, last = TRAILER.unpack_from(self._map, size - TRAILER.size)
+        if magic != TRAILER_MAGIC:
+            return None
+        chunks = []
+        while last != NO_INDEX:
+            _, _, _, tlen, plen, length = RECORD.unpack_from(self._map, last)
+            start = last + RECORD.size + tlen + plen
+            chunks.append(list(INDEX_ENTRY.iter_unpack(self._map[start + INDEX_PREV.size:start + length])))
+            last, = INDEX_PREV.unpack_from(self._map, start)
+        return [entry for chunk in reversed(chunks) for entry in chunk]
+
+    def message(self, offset):
+        """ the message recorded at offset, the payload is a memoryview of the log """
+        flags, ts, tlen, plen, length = RECORD.unpack_from(self._map, offset)[1:]
+        start = offset + RECORD.size
+        topic = str(self._view[start:start + tlen], "utf-8")
+        props = decode_properties(self._view[start + tlen:start + tlen + plen]) if plen else {}
+        payload = self._view[start + tlen + plen:start + tlen + plen + length]
+        return CapturedMessage(ts, topic, flags & 0x3, bool(flags & RETAIN), props, payload)
+
+    def __iter__(self):
+        return self.messages()
+
+    def __len__(self):
+        return len(self.index()[0])
+
+    def messages(self, start=None, end=None):
+        """ the messages recorded from start to end seconds """
+        times, offsets = self.index()
+        first = 0 if start is None else bisect.bisect_left(times, start)
+        last = len(times) if end is None else bisect.bisect_right(times, end)
+        for i in range(first, last):
+            msg = self.message(offsets[i])
+            yield msg._replace(ts=times[i])
+
+    async def replay(self, client, speed=1.0, remap=None, start=None, end=None, topics=None):
+        """ publish the recorded messages with a gmqtt client
+
+        speed is the replay rate relative to the recording, 0 publishes as
+        fast as possible. remap renames topics, a callable or a dict of topic
+        prefixes. topics limits the replay to a set of recorded topics.
+        Returns the number of published messages.
+        """
+        if isinstance(remap, dict):
+            prefixes = sorted(remap.items(), key=lambda item: -len(item[0]))
+
+            def rename(topic):
+                for prefix, new in prefixes:
+                    if topic.startswith(prefix):
+                        return new + topic[len(prefix):]
+                return topic
+        else:
+            rename = remap
+
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        first = None
+        n = 0
+        for msg in self.messages(start, end):
+            if topics is not None and msg.topic not in topics:
+                continue
+            if first is None:
+                first = msg.ts
+            if speed:
+                delay = begin + (msg.ts - first) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif n % 1000 == 999:
+                await asyncio.sleep(0)
+            topic = rename(msg.topic) if rename else msg.topic
+            client.publish(topic, bytes(msg.payload), msg.qos, msg.retain, **msg.properties)
+            n += 1
+        return n
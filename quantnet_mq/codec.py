@@ -0,0 +1,153 @@
+"""
+JSON encoding and decoding of the messages.
+
+The backend is orjson or ujson when installed, the standard json module
+otherwise; QUANTNET_JSON=orjson|ujson|json selects one. loads() returns
+the same values with every backend: inputs the fast backends reject, like
+NaN or integers beyond 64 bits, are decoded by the json module.
+
+dumps() encodes with orjson when it is the backend, with the json module
+otherwise. The wire format is compact JSON in UTF-8: no whitespace between
+tokens and non-ASCII characters unescaped. Both encoders write the same
+bytes except for the spelling of floats with an exponent, e.g. 1e-05 and
+0.00001, which decode to the same value. What orjson can not encode the
+same way, NaN and Infinity (null for orjson), integers beyond 64 bits,
+non-string keys and lone surrogates, is encoded by the json module.
+"""
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("orjson", "ujson", "json")
+
+
+def _default(obj):
+    # schema objects and NumPy scalars
+    if hasattr(obj, "for_json"):
+        return obj.for_json()
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+SEPARATORS = (",", ":")
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=SEPARATORS, default=_default)
+
+
+def _json_dumps(obj, default=None):
+    if default is None:
+        text = _encoder.encode(obj)
+    else:
+        text = json.dumps(obj, ensure_ascii=False, separators=SEPARATORS, default=default)
+    return text.encode("utf-8", errors="replace")
+
+
+def _json_loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _make_orjson():
+    import orjson
+
+    def dumps(obj, default=None):
+        try:
+            data = orjson.dumps(obj, default=default or _default)
+        except TypeError:
+            # big integers, non-string keys and surrogates, or objects that raise again
+            return _json_dumps(obj, default)
+        # NaN and Infinity are written as null, only messages with null are encoded again
+        return _json_dumps(obj, default) if b"null" in data else data
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity, or invalid JSON that raises again
+            return _json_loads(data)
+
+    return dumps, loads
+
+
+def _make_ujson():
+    import ujson
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            return _json_loads(data)
+
+    # ujson escapes slashes and spells floats differently, it only decodes
+    return _json_dumps, loads
+
+
+_FACTORIES = {"orjson": _make_orjson, "ujson": _make_ujson, "json": lambda: (_json_dumps, _json_loads)}
+
+backend = None
+_dumps = _json_dumps
+_loads = _json_loads
+
+
+def use(name=None):
+    """ select the backend by name, the first installed one of BACKENDS by default; returns its name """
+    global backend, _dumps, _loads
+    for candidate in (name,) if name else BACKENDS:
+        try:
+            _dumps, _loads = _FACTORIES[candidate]()
+        except ImportError:
+            if name:
+                raise
+            continue
+        backend = candidate
+        logger.debug(f"JSON backend: {backend}")
+        return backend
+
+
+def available():
+    """ names of the installed backends """
+    names = []
+    for name in BACKENDS:
+        try:
+            _FACTORIES[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def dumps(obj, default=None):
+    """ encode obj as compact JSON bytes """
+    return _dumps(obj, default)
+
+
+def loads(data):
+    """ decode JSON bytes, str or memoryview """
+    return _loads(data)
+
+
+def serialize(obj):
+    """ validate a schema object and encode it, obj.serialize() in the compact format """
+    obj.validate()
+    return _dumps(obj.for_json())
+
+
+def from_dict(cls, msg):
+    """ the validated schema object of a decoded message, cls.from_json() without decoding again """
+    obj = cls(**msg)
+    obj.validate()
+    return obj
+
+
+def from_json(cls, data):
+    """ the validated schema object of a JSON message, the from_json() of the schema classes """
+    return from_dict(cls, loads(data))
+
+
+use(os.environ.get("QUANTNET_JSON") or None)
@@ -0,0 +1,157 @@
+"""
+Delivery policies (QoS, message expiry, retain) per message type.
+
+Policies come from x- extensions of the AsyncAPI schemas, on a message of
+components.messages or on a channel operation that references one:
+
+    MonitorMessage:
+      payload:
+        $ref: "#/components/schemas/update"
+      x-qos: 1
+      x-event-types:
+        agentHeartbeat:
+          x-qos: 0
+          x-message-expiry: 10
+
+The policy applies to the title of the payload schema, e.g. getInfo,
+getInfoResponse or MonitorEvent. x-event-types sets policies of single
+MonitorEvent eventTypes, named e.g. MonitorEvent.agentHeartbeat.
+set_policy() overrides the schema at runtime.
+"""
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"x-qos": "qos", "x-message-expiry": "expiry", "x-retain": "retain"}
+
+
+class DeliveryPolicy:
+    """ QoS, message expiry interval in seconds (None for no expiry) and retain flag of a message """
+
+    __slots__ = ("qos", "expiry", "retain")
+
+    def __init__(self, qos=1, expiry=None, retain=False):
+        if qos not in (0, 1, 2):
+            raise ValueError(f"invalid QoS {qos}")
+        self.qos = qos
+        self.expiry = expiry
+        self.retain = retain
+
+    def __repr__(self):
+        return f"DeliveryPolicy(qos={self.qos}, expiry={self.expiry}, retain={self.retain})"
+
+    def __eq__(self, other):
+        return isinstance(other, DeliveryPolicy) and \
+            (self.qos, self.expiry, self.retain) == (other.qos, other.expiry, other.retain)
+
+    def publish_args(self):
+        """ qos, retain and the keyword arguments of a gmqtt publish """
+        kwargs = {}
+        if self.expiry is not None:
+            kwargs["message_expiry_interval"] = int(self.expiry)
+        return self.qos, self.retain, kwargs
+
+
+DEFAULT_POLICY = DeliveryPolicy()
+
+
+def _extensions(obj):
+    return {EXTENSIONS[k]: v for k, v in obj.items() if k in EXTENSIONS}
+
+
+class DeliveryPolicies:
+    """ Delivery policies by message type, loaded from the schemas on first use """
+
+    def __init__(self, default=DEFAULT_POLICY):
+        self._default = default
+        self._schema = None
+        self._overrides = {}
+        self._resolved = {}
+
+    def _load(self):
+        from quantnet_mq.schema.models import Schema
+        self._schema = {}
+        for entry in Schema._SCHEMA.values():
+            self.add_schema(entry.get("json") or {})
+
+    def add_schema(self, sdata):
+        """ read the x- extensions of an AsyncAPI document """
+        if self._schema is None:
+            self._load()
+        components = sdata.get("components", {})
+        schemas = components.get("schemas", {})
+        messages = components.get("messages", {})
+
+        def title(message):
+            ref = (message.get("payload") or {}).get("$ref", "")
+            schema = schemas.get(ref.rsplit("/", 1)[-1], {})
+            return schema.get("title")
+
+        found = {}
+        for channel in (sdata.get("channels") or {}).values():
+            for op in ("publish", "subscribe"):
+                operation = (channel or {}).get(op) or {}
+                ext = _extensions(operation)
+                ref = (operation.get("message") or {}).get("$ref", "")
+                name = title(messages.get(ref.rsplit("/", 1)[-1], {}))
+                if ext and name:
+                    found.setdefault(name, {}).update(ext)
+        for message in messages.values():
+            name = title(message)
+            if not name:
+                continue
+            ext = _extensions(message)
+            if ext:
+                found.setdefault(name, {}).update(ext)
+            for event_type, sub in (message.get("x-event-types") or {}).items():
+                found[f"{name}.{event_type}"] = dict(found.get(name, {}), **_extensions(sub))
+        for name, ext in found.items():
+            try:
+                self._schema[name] = DeliveryPolicy(**ext)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Invalid delivery policy of {name}: {e}")
+        self._resolved.clear()
+
+    def set_policy(self, name, qos=None, expiry=None, retain=None):
+        """ override the policy of a message type, unset fields keep the schema or default value """
+        base = self.get(name)
+        self._overrides[name] = DeliveryPolicy(base.qos if qos is None else qos,
+                                               base.expiry if expiry is None else expiry,
+                                               base.retain if retain is None else retain)
+        self._resolved.clear()
+
+    def clear_policy(self, name):
+        self._overrides.pop(name, None)
+        self._resolved.clear()
+
+    def get(self, name, event_type=None):
+        """ policy of a message type, or of an eventType of it """
+        key = (name, event_type)
+        policy = self._resolved.get(key)
+        if policy is not None:
+            return policy
+        if self._schema is None:
+            self._load()
+        names = [f"{name}.{event_type}", name] if event_type else [name]
+        policy = self._default
+        for n in names:
+            p = self._overrides.get(n) or self._schema.get(n)
+            if p is not None:
+                policy = p
+                break
+        self._resolved[key] = policy
+        return policy
+
+    def for_message(self, msg):
+        """ policy of a published message, a MonitorEvent or a list of them is looked up by eventType """
+        event = msg[0] if isinstance(msg, list) and msg else msg
+        if isinstance(event, dict) and "eventType" in event:
+            return self.get("MonitorEvent", event["eventType"])
+        if isinstance(event, dict) and "cmd" in event:
+            return self.get(event["cmd"])
+        return self._default
+
+
+policies = DeliveryPolicies()
+set_policy = policies.set_policy
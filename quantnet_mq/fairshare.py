@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+REJECT = "reject"
+DELAY = "delay"
+
+
+class AgentState:
+    """ token bucket, fair queuing tag and usage counters of an agent """
+
+    __slots__ = ("tokens", "updated", "weight", "finish", "waiting", "requests", "cost", "rejected", "delayed",
+                 "queued")
+
+    def __init__(self, tokens, now, weight):
+        self.tokens = tokens
+        self.updated = now
+        self.weight = weight
+        self.finish = 0.0
+        self.waiting = 0
+        self.requests = 0
+        self.cost = 0.0
+        self.rejected = 0
+        self.delayed = 0
+        self.queued = 0
+
+
+class FairShare:
+    """ Per agent rate limits and weighted fair queuing of RPC requests
+
+    Every agentId has a token bucket of rate cost units per second, a
+    request takes the cost of its command. A request over the limit is
+    rejected, or with mode="delay" waits for its tokens up to max_delay
+    seconds. With max_concurrency, at most that many requests run at once
+    and the waiting ones start in order of their virtual finish time, so
+    an agent with weight w gets w shares of the handlers whatever the
+    request rate of the others.
+
+    Parameters
+    ----------
+    rate: float
+        Cost units per second of an agent, None for no rate limit
+    burst: float
+        Bucket size, the cost an idle agent can spend at once
+    costs: dict
+        Cost of the commands, 1 for the others
+    weights: dict
+        Fair queuing weight of agents, 1 for the others
+    mode: str
+        "reject" or "delay" requests over the rate limit
+    max_delay: float
+        Longest wait for tokens in delay mode, longer waits are rejected
+    max_concurrency: int
+        Number of requests run at once, None for no limit
+    max_queue: int
+        Requests an agent can have waiting for a slot, more are rejected
+    max_agents: int
+        Number of agents tracked, idle agents are forgotten first
+    """
+
+    def __init__(self, rate=None, burst=None, costs=None, weights=None, mode=REJECT, max_delay=1.0,
+                 max_concurrency=None, max_queue=100, max_agents=10000, clock=time.monotonic):
+        if mode not in (REJECT, DELAY):
+            raise ValueError(f"invalid mode {mode}")
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0)
+        self.costs = dict(costs or {})
+        self.weights = dict(weights or {})
+        self.mode = mode
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_agents = max_agents
+        self._clock = clock
+        self._agents = OrderedDict()
+        self._queue = []
+        self._seq = 0
+        self._vtime = 0.0
+        self._running = 0
+
+    def cost(self, cmd):
+        return self.costs.get(cmd, 1.0) if isinstance(cmd, str) else 1.0
+
+    def _agent(self, agent, now):
+        state = self._agents.get(agent)
+        if state is None:
+            state = self._agents[agent] = AgentState(self.burst, now, self.weights.get(agent, 1.0))
+            if len(self._agents) > self.max_agents:
+                self._evict()
+        else:
+            self._agents.move_to_end(agent)
+        if self.rate is not None:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+        return state
+
+    def _evict(self):
+        for agent, state in self._agents.items():
+            if not state.waiting:
+                del self._agents[agent]
+                return
+
+    async def acquire(self, agent, cost=1.0):
+        """ wait for the rate limit and a slot, returns False if the request is rejected """
+        if not isinstance(agent, str):
+            # requests without a usable agentId share one bucket
+            agent = None
+        state = self._agent(agent, self._clock())
+        state.requests += 1
+        if self.rate is not None and state.tokens < cost:
+            wait = (cost - state.tokens) / self.rate if self.rate > 0 else float("inf")
+            if self.mode == REJECT or wait > self.max_delay:
+                state.rejected += 1
+                return False
+            # the tokens are taken now, later requests of the agent wait behind this one
+            state.tokens -= cost
+            state.delayed += 1
+            state.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                state.waiting -= 1
+        elif self.rate is not None:
+            state.tokens -= cost
+        state.cost += cost
+
+        if self.max_concurrency is None:
+            return True
+        if self._running < self.max_concurrency and not self._queue:
+            self._running += 1
+            return True
+        if state.waiting >= self.max_queue:
+            state.rejected += 1
+            return False
+        state.finish = max(self._vtime, state.finish) + cost / state.weight
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (state.finish, self._seq, fut))
+        state.queued += 1
+        state.waiting += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the slot was handed over already
+                self.release()
+            raise
+        finally:
+            state.waiting -= 1
+        return True
+
+    def release(self):
+        """ free the slot of a finished request, the next waiting request by finish time starts """
+        if self.max_concurrency is None:
+            return
+        self._running -= 1
+        while self._queue and self._running < self.max_concurrency:
+            tag, _, fut = heapq.heappop(self._queue)
+            if fut.done():
+                continue
+            self._vtime = tag
+            self._running += 1
+            fut.set_result(True)
+
+    def usage(self, agent=None):
+        """ usage counters and available tokens of an agent, or of every agent """
+        if agent is not None:
+            state = self._agents.get(agent)
+            return self._usage(state) if state else None
+        return {a: self._usage(s) for a, s in self._agents.items()}
+
+    def _usage(self, state):
+        return {
+            "requests": state.requests,
+            "cost": state.cost,
+            "rejected": state.rejected,
+            "delayed": state.delayed,
+            "queued": state.queued,
+            "waiting": state.waiting,
+            "tokens": state.tokens if self.rate is not None else None,
+        }
@@ -1,15 +1,333 @@
+import asyncio
+import inspect
+import logging
+import random
+import struct
+from collections import OrderedDict
+from functools import partial
 from gmqtt import Client
-from gmqtt.mqtt.constants import PubRecReasonCode
-from quantnet_mq import MQTTClientInterface
+from gmqtt.mqtt.constants import PubRecReasonCode, MQTTCommands, MQTTv50
+from gmqtt.mqtt.package import PackageFactory
+from gmqtt.mqtt.property import Property
+from gmqtt.mqtt.utils import pack_variable_byte_integer
+from quantnet_mq import MQTTClientInterface, codec
+from quantnet_mq.spool import Spool
 
 # used in rpcserver.py
 PubRecReasonCode
 
+logger = logging.getLogger(__name__)
+
+_CORRELATION_DATA = Property.factory(name="correlation_data")
+_TOPIC_ALIAS = Property.factory(name="topic_alias")
+
+# keyword arguments of the messaging classes passed on to MQTTClient
+CLIENT_OPTIONS = ("reconnect_delay", "reconnect_max_delay", "session_expiry_interval", "spool", "manual_ack",
+                  "receive_maximum")
+
+DEFAULT_SESSION_EXPIRY = 300
+SPOOL_BATCH = 256
+
+
+def client_options(kwargs):
+    """ the MQTTClient keyword arguments in kwargs """
+    return {k: kwargs[k] for k in CLIENT_OPTIONS if k in kwargs}
+
+
+class PublishTemplate:
+    """ Pre-encoded PUBLISH packet of a fixed topic, QoS, retain flag and properties.
+
+    Only the payload and the correlation data are encoded per message. With
+    a topic alias the topic is sent with the first packet after each
+    connect and as the 2 byte alias after that. Packets of QoS > 0 are kept
+    for a resend with the full topic, since the broker drops the aliases
+    when the connection is lost.
+    """
+
+    __slots__ = ("_client", "topic", "qos", "retain", "_command", "_topic", "_props", "_alias", "_epoch")
+
+    def __init__(self, client, topic, qos=0, retain=False, **properties):
+        self._client = client
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self._command = bytes((MQTTCommands.PUBLISH | (qos << 1) | (retain & 0x1),))
+        encoded = topic.encode("utf-8")
+        self._topic = struct.pack("!H", len(encoded)) + encoded
+        props = bytearray()
+        for name, value in properties.items():
+            prop = Property.factory(name=name)
+            if prop is None:
+                logger.warning(f"property {name} is not supported, it was ignored")
+                continue
+            props.extend(prop.dumps(value))
+        self._props = bytes(props)
+        self._alias = None
+        self._epoch = -1
+
+    def _packet(self, topic, props, payload, mid):
+        mid = b"" if mid is None else mid.to_bytes(2, "big")
+        n = len(props)
+        prop_length = bytes((n,)) if n < 128 else pack_variable_byte_integer(n)
+        length = len(topic) + len(mid) + len(prop_length) + n + len(payload)
+        remaining = bytes((length,)) if length < 128 else pack_variable_byte_integer(length)
+        return b"".join((self._command, remaining, topic, mid, prop_length, props, payload))
+
+    def encode(self, payload, correlation_data=None):
+        """ return (mid, packet, resend packet); the resend packet has the full topic """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8", errors="replace")
+        elif isinstance(payload, (list, tuple, dict)):
+            payload = codec.dumps(payload)
+        elif payload is None:
+            payload = b""
+        props = self._props
+        if correlation_data is not None:
+            props = b"".join((props, b"\x09", len(correlation_data).to_bytes(2, "big"), correlation_data))
+
+        mid = PackageFactory.id_generator.next_id() if self.qos > 0 else None
+        client = self._client
+        if self._epoch != client.alias_epoch:
+            # first publish on this connection, the topic goes with the alias
+            self._epoch = client.alias_epoch
+            alias = client.topic_alias(self.topic)
+            self._alias = bytes(_TOPIC_ALIAS.dumps(alias)) if alias else None
+            if self._alias:
+                packet = self._packet(self._topic, self._alias + props, payload, mid)
+                return mid, packet, self._packet(self._topic, props, payload, mid) if mid else packet
+        if self._alias:
+            packet = self._packet(b"\x00\x00", self._alias + props, payload, mid)
+            return mid, packet, self._packet(self._topic, props, payload, mid) if mid else packet
+        packet = self._packet(self._topic, props, payload, mid)
+        return mid, packet, packet
+
+    def publish(self, payload, correlation_data=None):
+        mid, packet, full = self.encode(payload, correlation_data)
+        self._client.send_packet(mid, packet, full)
+        return mid
+
+
+def _encode_payload(payload):
+    if isinstance(payload, str):
+        return payload.encode("utf-8", errors="replace")
+    if isinstance(payload, (list, tuple, dict)):
+        return codec.dumps(payload)
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    return b"" if payload is None else bytes(payload)
+
 
 class MQTTClient(MQTTClientInterface, Client):
+    """ gmqtt client with MQTT5 topic aliases, publish templates and reconnects
+
+    Publishes with only constant properties and correlation_data go
+    through a cached PublishTemplate of the topic. template_cache_size
+    bounds the number of cached templates; topic_alias_maximum is the
+    number of aliases the broker may use towards this client.
+
+    A lost connection is reconnected after a jittered, exponentially
+    growing delay from reconnect_delay to reconnect_max_delay seconds.
+    The broker keeps the session for session_expiry_interval seconds, the
+    subscriptions are renewed when it did not. Messages published while
+    disconnected go to the spool, a quantnet_mq.spool.Spool (spool=False
+    for none), and are published in order once connected again, at most
+    receive_maximum unacknowledged QoS > 0 messages at a time.
+
+    With manual_ack, a received QoS > 0 message is acknowledged when the
+    on_message callback returns, with the PUBACK/PUBREC reason code it
+    returns (success for None), and with an error code when it raises.
+    The broker sends at most receive_maximum unacknowledged messages, it
+    holds the others, or hands them to the other consumers of a shared
+    subscription.
+    """
+
     def __init__(self, client_id, clean_session=True, optimistic_acknowledgement=True,
-                 will_message=None, **kwargs):
+                 will_message=None, template_cache_size=1024, reconnect_delay=0.5, reconnect_max_delay=30.0,
+                 spool=None, manual_ack=False, receive_maximum=None, **kwargs):
+        kwargs.setdefault("topic_alias_maximum", 64)
+        if receive_maximum is not None:
+            kwargs["receive_maximum"] = receive_maximum
+        if manual_ack:
+            optimistic_acknowledgement = False
+        kwargs.setdefault("session_expiry_interval", DEFAULT_SESSION_EXPIRY)
         super(MQTTClient, self).__init__(client_id, clean_session, optimistic_acknowledgement, will_message, **kwargs)
+        self._templates = OrderedDict()
+        self._template_cache_size = template_cache_size
+        self._client_aliases = {}
+        self._alias_epoch = 0
+        self._reconnect_base = reconnect_delay
+        self._reconnect_max = reconnect_max_delay
+        self._spool = Spool() if spool is None else spool or None
+        self._flush_task = None
+        self.connects = 0
+        # received messages not acknowledged yet, with manual_ack
+        self.unacked = 0
+
+    @property
+    def on_message(self):
+        return self._on_message_callback
+
+    @on_message.setter
+    def on_message(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_message_callback = cb if self._optimistic_acknowledgement else partial(self._acknowledged, cb)
+
+    async def _acknowledged(self, cb, client, topic, payload, qos, properties):
+        """ run the on_message callback, its result is the reason code of the acknowledgement """
+        self.unacked += 1
+        try:
+            rc = cb(client, topic, payload, qos, properties)
+            if inspect.isawaitable(rc):
+                rc = await rc
+        except Exception as e:
+            logger.error(f"Failed to process message on {topic}: {e}")
+            return PubRecReasonCode.IMPLEMENTATION_SPECIFIC_ERROR
+        finally:
+            self.unacked -= 1
+        return PubRecReasonCode.SUCCESS if rc is None else rc
+
+    @property
+    def alias_epoch(self):
+        """ incremented whenever the topic aliases are reset, on connect and disconnect """
+        return self._alias_epoch
+
+    def _clear_topics_aliases(self):
+        super()._clear_topics_aliases()
+        self._client_aliases = {}
+        self._alias_epoch += 1
+
+    def topic_alias(self, topic):
+        """ alias of topic for this connection, None if the broker allows no more aliases """
+        alias = self._client_aliases.get(topic)
+        if alias is None:
+            maximum = self._connack_properties.get("topic_alias_maximum", 0)
+            if isinstance(maximum, list):
+                maximum = maximum[0]
+            if len(self._client_aliases) >= maximum:
+                return None
+            alias = self._client_aliases[topic] = len(self._client_aliases) + 1
+        return alias
+
+    def template(self, topic, qos=0, retain=False, **properties):
+        """ cached PublishTemplate of topic """
+        key = (topic, qos, retain, *properties.items())
+        tpl = self._templates.get(key)
+        if tpl is None:
+            tpl = self._templates[key] = PublishTemplate(self, topic, qos, retain, **properties)
+            if len(self._templates) > self._template_cache_size:
+                self._templates.popitem(last=False)
+        else:
+            self._templates.move_to_end(key)
+        return tpl
+
+    def send_packet(self, mid, packet, resend_packet):
+        self._connection.send_package(packet)
+        if mid is not None:
+            self._persistent_storage.push_message_nowait(mid, resend_packet)
+
+    def publish(self, message_or_topic, payload=None, qos=0, retain=False, **kwargs):
+        if self._spool is not None and self._is_active and isinstance(message_or_topic, str) \
+                and (self._spool or not self.is_connected):
+            # disconnected, or older messages are still spooled
+            self._spool.put(message_or_topic, _encode_payload(payload), qos, retain, kwargs)
+            return
+        self._publish(message_or_topic, payload, qos, retain, kwargs)
+
+    def _publish(self, message_or_topic, payload, qos, retain, kwargs, packets=None):
+        """ publish now, with packets the packets of templates are appended to it instead of being sent """
+        if not isinstance(message_or_topic, str) or self.protocol_version < MQTTv50:
+            return super().publish(message_or_topic, payload, qos, retain, **kwargs)
+        correlation_data = kwargs.pop("correlation_data", None)
+        try:
+            tpl = self.template(message_or_topic, qos, retain, **kwargs)
+        except TypeError:
+            # unhashable property values, e.g. user_property lists
+            if correlation_data is not None:
+                kwargs["correlation_data"] = correlation_data
+            if packets:
+                self._connection.send_package(b"".join(packets))
+                packets.clear()
+            return super().publish(message_or_topic, payload, qos, retain, **kwargs)
+        if packets is None:
+            tpl.publish(payload, correlation_data)
+            return
+        mid, packet, full = tpl.encode(payload, correlation_data)
+        packets.append(packet)
+        if mid is not None:
+            self._persistent_storage.push_message_nowait(mid, full)
+
+    @property
+    def spool(self):
+        """ the Spool of the messages published while disconnected, None without """
+        return self._spool
+
+    def reconnect_backoff(self):
+        """ delay of the next reconnect attempt, the exponential backoff with equal jitter """
+        delay = min(self._reconnect_max, self._reconnect_base * 2 ** min(self.failed_connections, 16))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def reconnect(self, delay=False):
+        if delay:
+            self._config["reconnect_delay"] = self.reconnect_backoff()
+            logger.info(f"Reconnecting in {self._config['reconnect_delay']:.2f} s")
+        await super().reconnect(delay)
+
+    def _handle_connack_packet(self, cmd, packet):
+        flags, result = packet[0], packet[1]
+        super()._handle_connack_packet(cmd, packet)
+        if result != 0:
+            return
+        self.connects += 1
+        if self.connects > 1:
+            if not flags & 0x1:
+                # the broker has no session, the subscriptions were lost with it
+                logger.info(f"Session not resumed, renewing {len(self.subscriptions)} subscriptions")
+                for sub in self.subscriptions:
+                    self.resubscribe(sub)
+            self._resend_unacknowledged()
+        # spooled while disconnected, or left in the spool file by an earlier process
+        if self._spool and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self._flush_spool())
+
+    def _resend_unacknowledged(self):
+        # at once instead of after the retry timeout
+        storage = self._persistent_storage
+        for _, mid, packet in sorted(getattr(storage, "_queue", ())):
+            self._connection.send_package(packet)
+
+    def _inflight(self):
+        return len(getattr(self._persistent_storage, "_queue", ()))
+
+    async def _flush_spool(self):
+        """ publish the spooled messages in batches, within the receive maximum of the broker """
+        spool = self._spool
+        receive_maximum = self._connack_properties.get("receive_maximum", 65535)
+        if isinstance(receive_maximum, list):
+            receive_maximum = receive_maximum[0]
+        logger.info(f"Publishing {len(spool)} spooled messages")
+        packets = []
+        while spool and self.is_connected:
+            window = max(receive_maximum - self._inflight(), 0)
+            if not window:
+                await asyncio.sleep(0.005)
+                continue
+            for topic, payload, qos, retain, properties in spool.take(min(window, SPOOL_BATCH)):
+                self._publish(topic, payload, qos, retain, dict(properties or {}), packets)
+            if packets:
+                self._connection.send_package(b"".join(packets))
+                packets.clear()
+            # let the acknowledgements in
+            await asyncio.sleep(0)
+        if spool:
+            logger.info(f"Disconnected with {len(spool)} spooled messages left")
+
+    async def disconnect(self, reason_code=0, **properties):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await super().disconnect(reason_code, **properties)
+        if self._spool is not None:
+            self._spool.close()
 
     def topic_match(self, sub, topic):
         """ check if topic start with sub """
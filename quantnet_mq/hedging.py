@@ -0,0 +1,101 @@
+import logging
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class HedgePolicy:
+    """ Hedging of an idempotent RPC command across replicated servers
+
+    When no response came within the delay, the request is sent again to
+    the next topic of topics and the first response wins. The delay is the
+    percentile of the recent latencies of the command. Hedges are limited
+    to max_ratio of the requests with a token bucket, so hedging can not
+    amplify the load by more than that fraction.
+
+    Parameters
+    ----------
+    topics: list
+        RPC topics of the replicas a request can be hedged to
+    percentile: float
+        Percentile of the recent latencies used as hedge delay
+    initial_delay: float
+        Hedge delay in seconds until min_samples latencies are known
+    min_delay: float
+        Lower bound of the hedge delay in seconds
+    max_ratio: float
+        Maximum fraction of the requests that are hedged
+    burst: float
+        Maximum number of hedges that can be sent at once
+    window: int
+        Number of recent latencies kept
+    min_samples: int
+        Latencies needed before the percentile is used
+    """
+
+    def __init__(self, topics, percentile=95.0, initial_delay=0.05, min_delay=0.001, max_ratio=0.1, burst=10.0,
+                 window=1000, min_samples=20):
+        if not topics:
+            raise ValueError("topics must not be empty")
+        self.topics = list(topics)
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._delay = initial_delay
+        self._estimated = False
+        self._stale = 0
+        self._tokens = burst
+        self._next = 0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.throttled = 0
+
+    def observe(self, latency):
+        """ record the latency of a response """
+        self._samples.append(latency)
+        self._stale += 1
+
+    @property
+    def delay(self):
+        """ the hedge delay in seconds, the percentile is recomputed every 32 responses """
+        n = len(self._samples)
+        if n >= self.min_samples and (self._stale >= 32 or not self._estimated):
+            ordered = sorted(self._samples)
+            self._delay = max(self.min_delay, ordered[min(n - 1, int(self.percentile / 100.0 * n))])
+            self._estimated = True
+            self._stale = 0
+        return self._delay
+
+    def request(self):
+        """ account a request, earns max_ratio of a hedge token """
+        self.requests += 1
+        self._tokens = min(self.burst, self._tokens + self.max_ratio)
+
+    def acquire(self, topic):
+        """ return the topic to hedge a request sent to topic to, None if over the rate limit """
+        if self._tokens < 1.0:
+            self.throttled += 1
+            return None
+        for _ in range(len(self.topics)):
+            alternate = self.topics[self._next % len(self.topics)]
+            self._next += 1
+            if alternate != topic:
+                self._tokens -= 1.0
+                self.hedged += 1
+                return alternate
+        return None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "throttled": self.throttled,
+            "delay": self._delay,
+        }
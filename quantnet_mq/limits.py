@@ -0,0 +1,176 @@
+"""
+Size and nesting limits of received payloads, checked on the raw bytes
+before they are decoded.
+
+Limits are looked up by topic filter (MQTT wildcards + and # allowed, the
+most specific filter wins) and, for RPC requests, by command. A command
+limit only tightens the topic limit: the command is found by a scan of
+the raw bytes, which a client controls.
+"""
+import logging
+import re
+from collections import Counter
+from . import attachments
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_DEPTH = 64
+
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_PAIRS = re.compile(rb"\[\]|\{\}")
+_NOT_BRACKETS = bytes(b for b in range(256) if b not in b"[]{}")
+_CMD = re.compile(rb'"cmd"\s*:\s*"([^"\\]{1,256})"')
+
+# reasons of the rejections, by kind
+REASONS = {"size": "Payload too large", "depth": "Payload nested too deep"}
+
+
+def exceeds_depth(data, limit):
+    """ check if the nesting depth of a JSON document is more than limit
+
+    The scan runs in C: strings are cut out and the depth is the running
+    sum of the brackets, or without NumPy, the innermost bracket pairs are
+    removed once per level.
+    """
+    if data.count(b"[") + data.count(b"{") <= limit:
+        # the common case, the structure can not be deeper than its brackets
+        return False
+    brackets = _STRING.sub(b"", data).translate(None, _NOT_BRACKETS)
+    if np is not None:
+        b = np.frombuffer(brackets, dtype=np.uint8)
+        steps = np.where((b == ord("[")) | (b == ord("{")), 1, -1)
+        return bool(b.size) and int(steps.cumsum().max()) > limit
+    for _ in range(limit):
+        if not brackets:
+            return False
+        brackets = _PAIRS.sub(b"", brackets)
+    # unbalanced brackets remain too, the document is not valid JSON anyway
+    return bool(brackets)
+
+
+def topic_matches(sub, topic):
+    """ check if topic matches the subscription filter sub """
+    if sub == topic:
+        return True
+    subs = sub.split("/")
+    levels = topic.split("/")
+    for i, s in enumerate(subs):
+        if s == "#":
+            return True
+        if i >= len(levels) or (s != "+" and s != levels[i]):
+            return False
+    return len(subs) == len(levels)
+
+
+class Limit:
+    """ maximum payload size in bytes and JSON nesting depth, None for no limit """
+
+    __slots__ = ("max_bytes", "max_depth")
+
+    def __init__(self, max_bytes=None, max_depth=None):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+
+    def tighten(self, other):
+        return Limit(_min(self.max_bytes, other.max_bytes), _min(self.max_depth, other.max_depth))
+
+    def __repr__(self):
+        return f"Limit(max_bytes={self.max_bytes}, max_depth={self.max_depth})"
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+class PayloadLimits:
+    """ Size and depth limits of received payloads, with rejection counts
+
+    Parameters
+    ----------
+    max_bytes: int
+        Default maximum payload size in bytes, None for no limit
+    max_depth: int
+        Default maximum JSON nesting depth, None for no limit
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_depth=DEFAULT_MAX_DEPTH):
+        self._default = Limit(max_bytes, max_depth)
+        self._topics = {}
+        self._commands = {}
+        self._resolved = {}
+        self.rejected = Counter()
+
+    def set_topic_limit(self, topic, max_bytes=None, max_depth=None):
+        """ limit of the topics matching a filter, replaces the default limit """
+        self._topics[topic] = Limit(max_bytes, max_depth)
+        self._resolved.clear()
+
+    def set_command_limit(self, cmd, max_bytes=None, max_depth=None):
+        """ limit of the requests of an RPC command, on top of the topic limit """
+        self._commands[cmd] = Limit(max_bytes, max_depth)
+
+    @property
+    def has_command_limits(self):
+        return bool(self._commands)
+
+    def limit(self, topic, cmd=None):
+        """ the limit of a topic, and command """
+        limit = self._resolved.get(topic)
+        if limit is None:
+            limit = self._default
+            best = None
+            for sub, lim in self._topics.items():
+                if topic_matches(sub, topic) and (best is None or _specificity(sub) > _specificity(best)):
+                    best, limit = sub, lim
+            if len(self._resolved) >= 4096:
+                self._resolved.clear()
+            self._resolved[topic] = limit
+        if cmd is not None and cmd in self._commands:
+            limit = limit.tighten(self._commands[cmd])
+        return limit
+
+    def check(self, payload, topic, cmd=None):
+        """ return the kind of limit a payload exceeds, "size" or "depth", None if it is within the limits
+
+        With command limits the command is looked up in the raw payload.
+        Of a payload with attachments only the JSON header is scanned for
+        its depth.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if cmd is None and self._commands:
+            m = _CMD.search(payload, 0, 4096)
+            if m is not None:
+                cmd = m.group(1).decode("utf-8", errors="replace")
+        limit = self.limit(topic, cmd)
+        if limit.max_bytes is not None and len(payload) > limit.max_bytes:
+            return self._reject("size", topic, f"{len(payload)} bytes, limit {limit.max_bytes}")
+        if limit.max_depth is not None:
+            if attachments.is_attachment(payload):
+                # the header nests the message one level deeper
+                depth = exceeds_depth(attachments.header(payload), limit.max_depth + 1)
+            else:
+                depth = exceeds_depth(payload, limit.max_depth)
+            if depth:
+                return self._reject("depth", topic, f"depth limit {limit.max_depth}")
+        return None
+
+    def _reject(self, kind, topic, detail):
+        self.rejected[kind] += 1
+        logger.debug(f"Rejected payload on {topic}: {REASONS[kind]} ({detail})")
+        return kind
+
+    def stats(self):
+        return {f"rejected_{kind}": n for kind, n in self.rejected.items()}
+
+
+def _specificity(sub):
+    # exact levels before + before #
+    return tuple(0 if s == "#" else 1 if s == "+" else 2 for s in sub.split("/"))
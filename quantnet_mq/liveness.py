@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import math
+import time
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """ Hierarchical timing wheel.
+
+    Level 0 has one slot per tick, every higher level one slot per full
+    turn of the level below. Scheduling, rescheduling and cancelling a key
+    are O(1); an entry is moved down a level when its slot comes up and
+    fires from level 0.
+
+    Parameters
+    ----------
+    tick: float
+        Resolution in seconds
+    slots: int
+        Slots per level
+    levels: int
+        Number of levels, deadlines beyond tick * slots ** levels are kept in
+        the top level until they come into range
+    clock: callable
+        Returns the current time in seconds
+    """
+
+    def __init__(self, tick=0.1, slots=256, levels=4, clock=time.monotonic):
+        self._tick = tick
+        self._slots = slots
+        self._spans = [slots ** i for i in range(levels)]
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where = {}
+        self._clock = clock
+        self._current = int(clock() / tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _insert(self, key, t):
+        delta = t - self._current
+        level = 0
+        while level < len(self._spans) - 1 and delta >= self._spans[level] * self._slots:
+            level += 1
+        slot = (t // self._spans[level]) % self._slots
+        self._wheels[level][slot][key] = t
+        self._where[key] = (level, slot)
+
+    def schedule(self, key, deadline):
+        """ (re)schedule key to fire at deadline, in seconds of the clock """
+        self.cancel(key)
+        t = max(math.ceil(deadline / self._tick), self._current + 1)
+        self._insert(key, t)
+
+    def cancel(self, key):
+        where = self._where.pop(key, None)
+        if where:
+            del self._wheels[where[0]][where[1]][key]
+
+    def advance(self, now=None):
+        """ move the wheel to now and return the expired keys """
+        target = int((self._clock() if now is None else now) / self._tick)
+        expired = []
+        while self._current < target:
+            self._current += 1
+            c = self._current
+            # cascade from the top so entries can move down more than one level
+            for level in range(len(self._spans) - 1, 0, -1):
+                if c % self._spans[level] == 0:
+                    slot = self._wheels[level][(c // self._spans[level]) % self._slots]
+                    entries = list(slot.items())
+                    slot.clear()
+                    for key, t in entries:
+                        self._insert(key, t)
+            slot = self._wheels[0][c % self._slots]
+            if slot:
+                entries = list(slot.items())
+                slot.clear()
+                for key, t in entries:
+                    if t <= c:
+                        del self._where[key]
+                        expired.append(key)
+                    else:
+                        self._insert(key, t)
+        return expired
+
+
+class LivenessTracker:
+    """ Track agent liveness from agentHeartbeat MonitorEvents.
+
+    An agent is alive after a heartbeat, suspect when no heartbeat came for
+    suspect_after seconds and dead after dead_after seconds. Deadlines are
+    kept in a TimingWheel, so a heartbeat and an expiry cost O(1) whatever
+    the number of agents. State transitions are published as agentState
+    MonitorEvents through a MsgClient.
+
+    Parameters
+    ----------
+    msgclient: MsgClient
+        Client used to publish the agentState events, None to not publish
+    topic: str
+        Topic of the agentState events
+    suspect_after: float
+        Seconds without heartbeat before an agent is suspect
+    dead_after: float
+        Seconds without heartbeat before an agent is dead
+    tick: float
+        Resolution of the deadlines in seconds
+    clock: callable
+        Monotonic clock of the deadlines
+    """
+
+    ALIVE = "alive"
+    SUSPECT = "suspect"
+    DEAD = "dead"
+
+    def __init__(self, msgclient=None, topic="monitor/agentState", suspect_after=3.0, dead_after=10.0,
+                 tick=0.1, clock=time.monotonic):
+        if dead_after <= suspect_after:
+            raise ValueError("dead_after must be larger than suspect_after")
+        self._msgclient = msgclient
+        self._topic = topic
+        self._suspect_after = suspect_after
+        self._dead_after = dead_after
+        self._tick = tick
+        self._clock = clock
+        self._wheel = TimingWheel(tick=tick, clock=clock)
+        self._states = {}
+        self._pending = []
+        self._on_transition = None
+        self._task = None
+
+    @property
+    def on_transition(self):
+        return self._on_transition
+
+    @on_transition.setter
+    def on_transition(self, cb):
+        if cb and not callable(cb):
+            raise TypeError("The cb must be callable")
+        self._on_transition = cb
+
+    def _transition(self, rid, state):
+        self._states[rid] = state
+        self._pending.append({"rid": rid, "ts": time.time(), "eventType": "agentState", "value": state})
+
+    def heartbeat(self, rid, now=None):
+        """ record a heartbeat of agent rid """
+        now = self._clock() if now is None else now
+        if self._states.get(rid) != self.ALIVE:
+            self._transition(rid, self.ALIVE)
+        self._wheel.schedule(rid, now + self._suspect_after)
+
+    def forget(self, rid):
+        """ stop tracking an agent, e.g. after it deregistered """
+        self._wheel.cancel(rid)
+        self._states.pop(rid, None)
+
+    def state(self, rid):
+        return self._states.get(rid)
+
+    def agents(self, state=None):
+        if state is None:
+            return list(self._states)
+        return [rid for rid, s in self._states.items() if s == state]
+
+    def poll(self, now=None):
+        """ expire the deadlines up to now and return the pending agentState events """
+        now = self._clock() if now is None else now
+        for rid in self._wheel.advance(now):
+            if self._states.get(rid) == self.ALIVE:
+                self._transition(rid, self.SUSPECT)
+                self._wheel.schedule(rid, now + self._dead_after - self._suspect_after)
+            else:
+                self._transition(rid, self.DEAD)
+        events, self._pending = self._pending, []
+        return events
+
+    def subscribe(self, msgserver, topic):
+        """ consume the heartbeats received on topic """
+        msgserver.subscribe(topic, self.on_message)
+
+    async def on_message(self, data):
+        """ MsgServer callback, data is a JSON MonitorEvent or a list of them,
+        or the decoded message when it was sent with attachments """
+        try:
+            events = codec.loads(data) if isinstance(data, (str, bytes)) else data
+        except ValueError as e:
+            logger.warning(f"Invalid monitor message: {e}")
+            return
+        for ev in events if isinstance(events, list) else [events]:
+            if isinstance(ev, dict) and ev.get("eventType") == "agentHeartbeat" and "rid" in ev:
+                self.heartbeat(ev["rid"])
+
+    async def _emit(self, events):
+        for ev in events:
+            if self._on_transition:
+                res = self._on_transition(ev)
+                if asyncio.iscoroutine(res):
+                    await res
+            if self._msgclient:
+                await self._msgclient.publish(self._topic, ev)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._emit(self.poll())
+            except Exception as e:
+                logger.error(f"Liveness tracker failed: {e}")
+            await asyncio.sleep(self._tick)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,123 @@
+import logging
+import threading
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+
+class LastValueCache:
+    """ Latest message per topic, or per topic and key field.
+
+    With key set, a message that is a JSON object, or a list of objects,
+    stores every object under the value of its key field, e.g. the rid of
+    a MonitorEvent; objects without the field are stored under None.
+    Entries are replaced, never modified, so a snapshot is a consistent
+    copy of the cache at one update.
+
+    A message that differs from the cached one only in the ignored fields,
+    e.g. the ts of a MonitorEvent, replaces it but is not a change.
+
+    Parameters
+    ----------
+    key: str
+        Field of the message objects used as key, None to keep one value per topic
+    ignore: tuple
+        Fields of the message objects not compared to detect a change
+    """
+
+    def __init__(self, key=None, ignore=("ts",)):
+        self._key = key
+        self._ignore = frozenset(ignore or ())
+        self._values = {}
+        self._raw = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, topic_key):
+        return topic_key in self._values
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def version(self):
+        """ incremented whenever a value changes """
+        return self._version
+
+    def _strip(self, obj):
+        if isinstance(obj, dict):
+            return {k: v for k, v in obj.items() if k not in self._ignore}
+        if isinstance(obj, list):
+            return [self._strip(o) for o in obj]
+        return obj
+
+    def _same(self, a, b):
+        if self._ignore:
+            a, b = self._strip(a), self._strip(b)
+        try:
+            return bool(a == b)
+        except ValueError:
+            # messages with NumPy arrays are not compared
+            return False
+
+    def update(self, topic, data):
+        """ store a message, data is a JSON string or a decoded message.
+
+        Returns True if a stored value changed.
+        """
+        if isinstance(data, (str, bytes)):
+            if self._raw.get(topic) == data:
+                return False
+            try:
+                msg = codec.loads(data)
+            except ValueError as e:
+                logger.warning(f"Invalid message on {topic}: {e}")
+                return False
+        else:
+            msg = data
+
+        if self._key is None:
+            items = [(None, msg)]
+        else:
+            objs = msg if isinstance(msg, list) else [msg]
+            items = [(o.get(self._key) if isinstance(o, dict) else None, o) for o in objs]
+
+        changed = False
+        with self._lock:
+            for k, value in items:
+                old = self._values.get((topic, k), self)
+                if old is self or not self._same(old, value):
+                    changed = True
+                self._values[(topic, k)] = value
+            if isinstance(data, (str, bytes)):
+                self._raw[topic] = data
+            if changed:
+                self._version += 1
+        return changed
+
+    def get(self, topic, key=None, default=None):
+        return self._values.get((topic, key), default)
+
+    def snapshot(self, topic=None):
+        """ copy of the cache, {(topic, key): value} or {key: value} of one topic """
+        with self._lock:
+            if topic is None:
+                return dict(self._values)
+            return {k: v for (t, k), v in self._values.items() if t == topic}
+
+    def discard(self, topic, key=None):
+        with self._lock:
+            if self._values.pop((topic, key), None) is not None:
+                self._version += 1
+            self._raw.pop(topic, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._raw.clear()
+            self._version += 1
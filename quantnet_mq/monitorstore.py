@@ -0,0 +1,365 @@
+import os
+import re
+import logging
+import numpy as np
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES = ("count", "sum", "mean", "min", "max", "first", "last", "std")
+
+# bytes of an event slot of a series, a float64 timestamp and value
+SLOT_BYTES = 16
+
+
+class Series:
+    """ Fixed capacity columnar ring buffer of one (eventType, rid) stream.
+
+    Timestamps and values are kept in two float64 arrays. String values, as
+    used by agentState, are stored as codes into ``labels``; object values are
+    kept in a lazily created object column and stored as NaN in the value
+    column. When the buffer is full the oldest events are overwritten.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of events kept
+    path: str
+        Base path of memory-mapped files backing the columns, None for memory
+    """
+
+    def __init__(self, capacity, path=None):
+        self._capacity = capacity
+        if path:
+            self._ts = np.memmap(f"{path}.ts", dtype=np.float64, mode="w+", shape=(capacity,))
+            self._values = np.memmap(f"{path}.values", dtype=np.float64, mode="w+", shape=(capacity,))
+        else:
+            self._ts = np.empty(capacity, dtype=np.float64)
+            self._values = np.empty(capacity, dtype=np.float64)
+        self._objects = None
+        self._codes = {}
+        self._labels = []
+        self._head = 0
+        self._size = 0
+        self._last = -np.inf
+        self._sorted = True
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def labels(self):
+        """ the string values, a string value is stored as its index in this list """
+        return self._labels
+
+    def _encode(self, value, i):
+        if isinstance(value, bool):
+            return float(value)
+        if isinstance(value, (int, float)):
+            return value
+        if isinstance(value, str):
+            code = self._codes.get(value)
+            if code is None:
+                code = self._codes[value] = len(self._labels)
+                self._labels.append(value)
+            return code
+        if self._objects is None:
+            self._objects = np.empty(self._capacity, dtype=object)
+        self._objects[i] = value
+        return np.nan
+
+    def append(self, ts, value):
+        i = self._head
+        self._ts[i] = ts
+        if self._objects is not None:
+            # the slot may hold the object of an overwritten event
+            self._objects[i] = None
+        self._values[i] = self._encode(value, i)
+        self._head = (i + 1) % self._capacity
+        if self._size < self._capacity:
+            self._size += 1
+        if ts < self._last:
+            self._sorted = False
+        else:
+            self._last = ts
+
+    def extend(self, ts, values):
+        """ append numeric arrays in one vectorized copy """
+        ts = np.asarray(ts, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(ts) > self._capacity:
+            ts, values = ts[-self._capacity:], values[-self._capacity:]
+        n = len(ts)
+        if not n:
+            return
+        if ts[0] < self._last or np.any(ts[1:] < ts[:-1]):
+            self._sorted = False
+        self._last = max(self._last, ts[-1])
+        first = min(n, self._capacity - self._head)
+        self._ts[self._head:self._head + first] = ts[:first]
+        self._values[self._head:self._head + first] = values[:first]
+        self._ts[:n - first] = ts[first:]
+        self._values[:n - first] = values[first:]
+        if self._objects is not None:
+            self._objects[self._head:self._head + first] = None
+            self._objects[:n - first] = None
+        self._head = (self._head + n) % self._capacity
+        self._size = min(self._capacity, self._size + n)
+
+    def _segments(self):
+        """ the stored events as (ts, values, offset) views, oldest first """
+        if self._size < self._capacity:
+            return [(self._ts[:self._size], self._values[:self._size], 0)]
+        h = self._head
+        return [(self._ts[h:], self._values[h:], h), (self._ts[:h], self._values[:h], 0)]
+
+    def _is_sorted(self):
+        if not self._sorted:
+            # the out of order events may have been overwritten since
+            ts = np.concatenate([seg[0] for seg in self._segments()])
+            self._sorted = bool(np.all(ts[1:] >= ts[:-1]))
+        return self._sorted
+
+    def _select(self, start, end):
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        out = []
+        if self._is_sorted():
+            for ts, values, offset in self._segments():
+                lo = np.searchsorted(ts, start, "left")
+                hi = np.searchsorted(ts, end, "right")
+                out.append((ts[lo:hi], values[lo:hi], np.arange(offset + lo, offset + hi)))
+        else:
+            for ts, values, offset in self._segments():
+                idx = np.flatnonzero((ts >= start) & (ts <= end))
+                out.append((ts[idx], values[idx], idx + offset))
+        return out
+
+    def range(self, start=None, end=None):
+        """ return (ts, values) of the events with start <= ts <= end, oldest first """
+        parts = self._select(start, end)
+        if len(parts) == 1:
+            return parts[0][0].copy(), parts[0][1].copy()
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def objects(self, start=None, end=None):
+        """ return (ts, objects) of the object values in the range """
+        if self._objects is None:
+            return np.empty(0), np.empty(0, dtype=object)
+        parts = self._select(start, end)
+        ts = np.concatenate([p[0] for p in parts])
+        objs = np.concatenate([self._objects[p[2]] for p in parts])
+        keep = np.array([o is not None for o in objs], dtype=bool)
+        return ts[keep], objs[keep]
+
+    def decode(self, values):
+        """ map string value codes back to the strings """
+        return np.asarray(self._labels, dtype=object)[np.asarray(values, dtype=np.int64)]
+
+    def last(self):
+        """ return (ts, value) of the newest event, None if empty """
+        if not self._size:
+            return None
+        i = (self._head - 1) % self._capacity
+        return self._ts[i], self._values[i]
+
+    def aggregate(self, start=None, end=None, aggs=("count", "mean", "min", "max")):
+        """ return a dict of aggregates over the range """
+        ts, values = self.range(start, end)
+        if not self._is_sorted():
+            order = np.argsort(ts, kind="stable")
+            ts, values = ts[order], values[order]
+        res = {}
+        for agg in aggs:
+            if agg == "count":
+                res[agg] = len(values)
+            elif not len(values):
+                res[agg] = None
+            elif agg == "first":
+                res[agg] = float(values[0])
+            elif agg == "last":
+                res[agg] = float(values[-1])
+            elif agg in AGGREGATES:
+                res[agg] = float(getattr(np, agg)(values))
+            else:
+                raise ValueError(f"unknown aggregate {agg}")
+        return res
+
+    def downsample(self, bucket, start=None, end=None, agg="mean"):
+        """ aggregate the range into buckets of bucket seconds.
+
+        Returns (bucket start times, values) of the non-empty buckets.
+        """
+        if agg not in AGGREGATES:
+            raise ValueError(f"unknown aggregate {agg}")
+        ts, values = self.range(start, end)
+        if not len(ts):
+            return ts, values
+        if not self._is_sorted():
+            order = np.argsort(ts, kind="stable")
+            ts, values = ts[order], values[order]
+        origin = ts[0] if start is None else start
+        b = np.floor_divide(ts - origin, bucket).astype(np.int64)
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(b)) + 1))
+        counts = np.diff(np.append(bounds, len(values)))
+        if agg == "count":
+            out = counts.astype(np.float64)
+        elif agg == "sum":
+            out = np.add.reduceat(values, bounds)
+        elif agg == "mean":
+            out = np.add.reduceat(values, bounds) / counts
+        elif agg == "min":
+            out = np.minimum.reduceat(values, bounds)
+        elif agg == "max":
+            out = np.maximum.reduceat(values, bounds)
+        elif agg == "first":
+            out = values[bounds]
+        elif agg == "last":
+            out = values[bounds + counts - 1]
+        else:
+            mean = np.add.reduceat(values, bounds) / counts
+            sq = np.add.reduceat(values * values, bounds) / counts
+            out = np.sqrt(np.maximum(sq - mean * mean, 0))
+        return origin + b[bounds] * bucket, out
+
+    def flush(self):
+        """ write memory-mapped columns to disk """
+        for col in (self._ts, self._values):
+            if isinstance(col, np.memmap):
+                col.flush()
+
+
+class MonitorStore:
+    """ In-memory time series store of MonitorEvent streams.
+
+    Events are kept per (eventType, rid) in a fixed capacity Series of
+    capacity * SLOT_BYTES bytes. New series are created up to max_series
+    and while the columns of all series fit in max_bytes, the events of
+    other series are dropped. Object values are kept besides the columns
+    and are not counted. Use subscribe() to feed the store from a
+    MsgServer.
+
+    Parameters
+    ----------
+    capacity: int
+        Events kept per series, the default holds an hour at one event per second
+    max_series: int
+        Maximum number of series
+    spill_dir: str
+        Directory for memory-mapped series columns, None keeps them in memory
+    max_bytes: int
+        Size of the series columns, in memory or in spill_dir
+    """
+
+    def __init__(self, capacity=3600, max_series=10000, spill_dir=None, max_bytes=256 * 1024 * 1024):
+        self._capacity = capacity
+        self._max_series = max_series
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._series = {}
+        self._by_type = {}
+        self._dropped = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._series)
+
+    @property
+    def nbytes(self):
+        """ size of the series columns """
+        return len(self._series) * self._capacity * SLOT_BYTES
+
+    @property
+    def dropped(self):
+        """ number of events that were invalid or over the series limit """
+        return self._dropped
+
+    def subscribe(self, msgserver, topic):
+        """ feed the store with the monitor events received on topic """
+        msgserver.subscribe(topic, self.on_message)
+
+    async def on_message(self, data):
+        """ MsgServer callback, data is a JSON MonitorEvent or a list of them,
+        or the decoded message when it was sent with attachments """
+        try:
+            events = codec.loads(data) if isinstance(data, (str, bytes)) else data
+        except ValueError as e:
+            logger.warning(f"Invalid monitor message: {e}")
+            self._dropped += 1
+            return
+        if isinstance(events, list):
+            for ev in events:
+                self.add(ev)
+        else:
+            self.add(events)
+
+    def _get_or_create(self, event_type, rid):
+        key = (event_type, rid)
+        s = self._series.get(key)
+        if s is None:
+            if len(self._series) >= self._max_series or self.nbytes + self._capacity * SLOT_BYTES > self._max_bytes:
+                return None
+            path = None
+            if self._spill_dir:
+                name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{event_type}-{rid}")
+                path = os.path.join(self._spill_dir, f"{name}-{len(self._series)}")
+            s = self._series[key] = Series(self._capacity, path)
+            self._by_type.setdefault(event_type, {})[rid] = s
+        return s
+
+    def add(self, event):
+        """ add a MonitorEvent, a dict or a schema object """
+        if hasattr(event, "as_dict"):
+            event = event.as_dict()
+        try:
+            s = self._get_or_create(event["eventType"], event["rid"])
+            if s is None:
+                self._dropped += 1
+                return False
+            s.append(float(event["ts"]), event["value"])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Invalid monitor event: {e}")
+            self._dropped += 1
+            return False
+        return True
+
+    def extend(self, event_type, rid, ts, values):
+        """ add numeric arrays of one series """
+        s = self._get_or_create(event_type, rid)
+        if s is None:
+            self._dropped += len(ts)
+            return False
+        s.extend(ts, values)
+        return True
+
+    def keys(self, event_type=None):
+        if event_type is None:
+            return list(self._series)
+        return [(event_type, rid) for rid in self._by_type.get(event_type, {})]
+
+    def series(self, event_type, rid):
+        return self._series.get((event_type, rid))
+
+    def range(self, event_type, rid, start=None, end=None):
+        s = self._series.get((event_type, rid))
+        if s is None:
+            return np.empty(0), np.empty(0)
+        return s.range(start, end)
+
+    def latest(self, event_type):
+        """ return {rid: (ts, value)} of the newest event of every series of event_type """
+        return {rid: s.last() for rid, s in self._by_type.get(event_type, {}).items() if len(s)}
+
+    def aggregate(self, event_type, start=None, end=None, aggs=("count", "mean", "min", "max")):
+        """ return {rid: aggregates} over every series of event_type """
+        return {rid: s.aggregate(start, end, aggs) for rid, s in self._by_type.get(event_type, {}).items()}
+
+    def flush(self):
+        for s in self._series.values():
+            s.flush()
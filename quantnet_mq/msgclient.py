@@ -1,9 +1,10 @@
 import asyncio
 import logging
 import uuid
-import json
 import uvloop
-from .gmqtt.mqttclient import MQTTClient
+from .gmqtt.mqttclient import MQTTClient, client_options
+from . import attachments, codec
+from .delivery import policies
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +21,7 @@ class MsgClient:
         self._mqtt_client_password = kwargs.get("password", "")
         self._mqtt_broker_host = kwargs.get("host", "127.0.0.1")
         self._mqtt_broker_port = kwargs.get("port", 1883)
+        self._mqtt_client_options = client_options(kwargs)
         self._mqttclient = None
         self._on_msg_callback = None
 
@@ -33,21 +35,38 @@ class MsgClient:
         """
         start the mqtt client
         """
-        self._mqttclient = MQTTClient(f"quantnet-msgclient-{self._cid}")
+        self._mqttclient = MQTTClient(f"quantnet-msgclient-{self._cid}", **self._mqtt_client_options)
 
         self._mqttclient.on_connect = self.on_connect
         self._mqttclient.on_disconnect = self.on_disconnect
         self._mqttclient.set_auth_credentials(self._mqtt_client_username, self._mqtt_client_password)
         await self._mqttclient.connect(host=self._mqtt_broker_host, port=self._mqtt_broker_port)
 
-    def _stop_mqttclient(self):
-        pass
+    async def _stop_mqttclient(self):
+        if self._mqttclient:
+            # a clean stop ends the session on the broker
+            await self._mqttclient.disconnect(session_expiry_interval=0)
+            self._mqttclient = None
 
     async def start(self):
         await self._start_mqttclient()
 
     async def stop(self):
-        self._stop_mqttclient()
+        await self._stop_mqttclient()
 
-    async def publish(self, topic, payload):
-        self._mqttclient.publish(topic, json.dumps(payload), 1, False)
+    async def publish(self, topic, payload, qos=None, expiry=None, retain=None):
+        """ publish a message, NumPy arrays in it are sent as binary attachments.
+
+        QoS, message expiry and retain default to the delivery policy of the
+        message type, see quantnet_mq.delivery.
+        """
+        policy_qos, policy_retain, kwargs = policies.for_message(payload).publish_args()
+        qos = policy_qos if qos is None else qos
+        retain = policy_retain if retain is None else retain
+        if expiry is not None:
+            kwargs["message_expiry_interval"] = int(expiry)
+        if attachments.has_arrays(payload):
+            self._mqttclient.publish(topic, attachments.encode(payload), qos, retain,
+                                     content_type=attachments.CONTENT_TYPE, **kwargs)
+        else:
+            self._mqttclient.publish(topic, codec.dumps(payload), qos, retain, **kwargs)
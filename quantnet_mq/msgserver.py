@@ -4,7 +4,10 @@ import uuid
 import json
 import uvloop
 from typing import Callable
-from .gmqtt.mqttclient import MQTTClient
+from .gmqtt.mqttclient import MQTTClient, PubRecReasonCode, client_options
+from . import attachments, codec
+from .lvcache import LastValueCache
+from .limits import PayloadLimits, DEFAULT_MAX_BYTES, DEFAULT_MAX_DEPTH
 
 
 logger = logging.getLogger(__name__)
@@ -13,9 +16,10 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 class TopicHandler:
-    def __init__(self, topic, cb):
+    def __init__(self, topic, cb, changes_only=False):
         self._topic = topic
         self._cb = cb
+        self._changes_only = changes_only
 
     @property
     def topic(self):
@@ -25,24 +29,92 @@ class TopicHandler:
     def cb(self):
         return self._cb
 
+    @property
+    def changes_only(self):
+        return self._changes_only
+
 
 class MsgServer:
+    """ Subscriber of pubsub topics
+
+    Parameters
+    ----------
+    cid: str
+        Client ID
+    last_value_cache: bool
+        Keep the latest message of every received topic in ``cache``,
+        retained messages seed the cache when subscribing
+    cache_key: str
+        Field of the messages to cache by in addition to the topic, e.g. rid
+    cache_ignore: tuple
+        Fields of the messages that are not a change for changes_only, ("ts",) by default
+    subscribe_qos: int
+        Maximum QoS of the subscriptions, messages are received at the lower
+        of it and the QoS they were published with
+    recorder: quantnet_mq.capture.Recorder
+        Capture log every received message is appended to
+    max_payload_bytes: int
+        Maximum message size, larger messages are dropped
+    max_payload_depth: int
+        Maximum JSON nesting depth of a message
+    payload_limits: quantnet_mq.limits.PayloadLimits
+        Message limits, per topic filter, instead of max_payload_bytes and max_payload_depth
+    reconnect_delay: float
+        First delay of the reconnect backoff in seconds, doubled up to reconnect_max_delay
+    session_expiry_interval: int
+        Seconds the broker keeps the session and queues messages while disconnected
+    spool: quantnet_mq.spool.Spool
+        Buffer of the messages published while disconnected, False for none
+    manual_ack: bool
+        Acknowledge a QoS > 0 message when its callback returns instead of on receipt
+    receive_maximum: int
+        Unacknowledged QoS > 0 messages the broker may send at once, with manual_ack
+        the messages being processed
+    shared_group: str
+        Subscribe as a member of the shared subscription group, the broker
+        splits the messages among the members
+    """
+
     def __init__(self, cid=None, **kwargs):
         self._cid = cid or uuid.uuid4().hex
         self._topic_handlers = {}
+        self._subscribe_qos = kwargs.get("subscribe_qos", 2)
+        self._shared_group = kwargs.get("shared_group")
+        self._cache = LastValueCache(kwargs.get("cache_key"), kwargs.get("cache_ignore", ("ts",))) \
+            if kwargs.get("last_value_cache", False) else None
+        self._recorder = kwargs.get("recorder")
+        self._limits = kwargs.get("payload_limits") or PayloadLimits(
+            kwargs.get("max_payload_bytes", DEFAULT_MAX_BYTES), kwargs.get("max_payload_depth", DEFAULT_MAX_DEPTH))
 
         self._mqtt_client_username = kwargs.get("username", "")
         self._mqtt_client_password = kwargs.get("password", "")
         self._mqtt_broker_host = kwargs.get("host", "127.0.0.1")
         self._mqtt_broker_port = kwargs.get("port", 1883)
+        self._mqtt_client_options = client_options(kwargs)
         self._mqttclient = None
 
     def on_connect(self, client, flags, rc, properties):
         logger.info("Connected: %s", self._cid)
 
     async def on_message(self, client, topic, payload, qos, properties):
-        jsonString = json.dumps(json.loads(payload), indent=4, sort_keys=False)
-        logger.debug("RECV MSG: %s", jsonString)
+        """ pass the message to the topic callback, as a JSON string or,
+        for a message with attachments, as the decoded message with NumPy arrays """
+        if self._recorder is not None:
+            self._recorder.record(topic, payload, qos, properties)
+        if self._limits.check(payload, topic) is not None:
+            logger.warning("Dropped message on %s: payload limits exceeded", topic)
+            return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+        if attachments.is_attachment(payload):
+            data = attachments.decode(payload)
+            logger.debug("RECV MSG: %d bytes with attachments", len(payload))
+        else:
+            # decoding checks that the message is JSON, it is formatted only for the debug log
+            msg = codec.loads(payload)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("RECV MSG: %s", json.dumps(msg, indent=4, sort_keys=False))
+            data = payload.decode("utf-8")
+
+        changed = self._cache.update(topic, data) if self._cache is not None else True
 
         if topic in self._topic_handlers.keys():
             handler = self._topic_handlers[topic]
@@ -57,10 +129,9 @@ class MsgServer:
             #     logger.warn(reason)
             # if instance and handler:
             #     handler.handle(self, topic, instance, properties)
-            jsonString = payload.decode("utf-8")
             cb_func = handler.cb
-            if cb_func:
-                await cb_func(jsonString)
+            if cb_func and (changed or not handler.changes_only):
+                await cb_func(data)
         elif client.topic_wildcard(topic) in self._topic_handlers.keys():
             handler = self._topic_handlers[client.topic_wildcard(topic)]
             """ TODO: use this code when broacast class is ready """
@@ -74,10 +145,9 @@ class MsgServer:
             #     logger.warn(reason)
             # if instance and handler:
             #     handler.handle(self, topic, instance, properties)
-            jsonString = payload.decode("utf-8")
             cb_func = handler.cb
-            if cb_func:
-                await cb_func(jsonString)
+            if cb_func and (changed or not handler.changes_only):
+                await cb_func(data)
         else:
             logger.warning("unknown topic: %s", topic)
 
@@ -92,7 +162,7 @@ class MsgServer:
         """
         start the mqtt client
         """
-        self._mqttclient = MQTTClient(self._cid)
+        self._mqttclient = MQTTClient(self._cid, **self._mqtt_client_options)
 
         self._mqttclient.on_connect = self.on_connect
         self._mqttclient.on_message = self.on_message
@@ -102,22 +172,55 @@ class MsgServer:
         await self._mqttclient.connect(host=self._mqtt_broker_host, port=self._mqtt_broker_port)
 
         for h in self._topic_handlers.values():
-            self._mqttclient.subscribe(h.topic, 2)
+            self._mqttclient.subscribe(self._filter(h.topic), self._subscribe_qos)
 
-    def _stop_mqttclient(self):
-        pass
+    def _filter(self, topic):
+        return f"$share/{self._shared_group}/{topic}" if self._shared_group else topic
+
+    async def _stop_mqttclient(self):
+        if self._mqttclient:
+            # a clean stop ends the session on the broker
+            await self._mqttclient.disconnect(session_expiry_interval=0)
+            self._mqttclient = None
 
     async def start(self):
         await self._start_mqttclient()
 
     async def stop(self):
-        self._stop_mqttclient()
+        await self._stop_mqttclient()
+
+    @property
+    def limits(self):
+        """ the PayloadLimits of the messages, rejections are counted in limits.stats() """
+        return self._limits
 
-    def subscribe(self, topic: str, cb: Callable):
+    @property
+    def cache(self):
+        """ the LastValueCache, None unless created with last_value_cache=True """
+        return self._cache
+
+    def get(self, topic, key=None, default=None):
+        """ latest cached message of topic, and key if the cache has a cache_key """
+        if self._cache is None:
+            raise RuntimeError("last value cache is not enabled")
+        return self._cache.get(topic, key, default)
+
+    def snapshot(self, topic=None):
+        """ copy of the cached messages, see LastValueCache.snapshot """
+        if self._cache is None:
+            raise RuntimeError("last value cache is not enabled")
+        return self._cache.snapshot(topic)
+
+    def subscribe(self, topic: str, cb: Callable, changes_only=False):
+        """ subscribe cb to topic, with changes_only the callback is skipped
+        for messages that do not change the cached value """
         if not isinstance(topic, str) or not topic.strip():
             raise TypeError("topic must be a non-empty string")
 
         if cb and not callable(cb):
             raise TypeError("The cb must be callable")
 
-        self._topic_handlers[topic] = TopicHandler(topic, cb)
+        if changes_only and self._cache is None:
+            raise ValueError("changes_only requires last_value_cache=True")
+
+        self._topic_handlers[topic] = TopicHandler(topic, cb, changes_only)
@@ -0,0 +1,309 @@
+"""
+On-demand profiling of a live process through the admin profile RPC.
+
+Three modes capture the event loop thread for a number of seconds:
+
+    sample        the stack of the loop thread is sampled every interval of
+                  CPU time (SIGPROF) and the collapsed stacks are counted
+                  ("outer;inner;leaf count" lines, the input of flame graph
+                  tools); the interval grows to keep the time spent
+                  sampling under max_overhead
+    cprofile      cProfile of the loop thread, or with a command, only of
+                  the steps of that command's handler; the pstats listing
+                  by cumulative time
+    tracemalloc   the allocation growth by line over the capture
+
+cProfile and tracemalloc slow everything they trace, their captures are
+limited to max_duration seconds like the sampling ones. One capture runs at
+a time.
+"""
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter
+from quantnet_mq import Code
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+TRACEMALLOC = "tracemalloc"
+MODES = (SAMPLE, CPROFILE, TRACEMALLOC)
+
+PROFILE_CMD = "profile"
+
+
+def collapse(frame, root=None):
+    """ the collapsed stack of a frame, outermost function first """
+    names = []
+    while frame is not None and frame is not root:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SignalSampler:
+    """ Samples the stack of the main thread on SIGPROF, every interval seconds of CPU time
+
+    The time spent per sample is measured, and the interval grows so that
+    sampling takes at most max_overhead of the sampled time.
+    """
+
+    def __init__(self, interval=0.005, max_overhead=0.02):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = Counter()
+        self.samples = 0
+        self.busy = 0.0
+        self._current = interval
+        self._previous = None
+
+    def _on_signal(self, signum, frame):
+        start = time.perf_counter()
+        self.stacks[collapse(frame)] += 1
+        cost = time.perf_counter() - start
+        self.busy += cost
+        self.samples += 1
+        needed = cost / self.max_overhead
+        if needed > self._current * 1.25:
+            self._current = needed
+            signal.setitimer(signal.ITIMER_PROF, needed, needed)
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._on_signal)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def collapsed(self, limit=None):
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common(limit))
+
+
+class Sampler(threading.Thread):
+    """ Samples the stack of a thread from another thread until stopped
+
+    For event loops outside the main thread, where SIGPROF is not
+    delivered. A sample can only be taken when the sampled thread releases
+    the GIL, so CPU bound code is under-represented. The interval grows
+    like the one of SignalSampler.
+    """
+
+    def __init__(self, thread_id, interval=0.005, max_overhead=0.02):
+        super().__init__(name="quantnet-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = Counter()
+        self.samples = 0
+        self.busy = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        interval = self.interval
+        frames = sys._current_frames
+        while not self._stop_event.wait(interval):
+            start = time.perf_counter()
+            frame = frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[collapse(frame)] += 1
+            del frame
+            cost = time.perf_counter() - start
+            self.busy += cost
+            self.samples += 1
+            interval = max(self.interval, cost / self.max_overhead)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    collapsed = SignalSampler.collapsed
+
+
+@types.coroutine
+def _profile_steps(coro, profile):
+    """ await coro with profile enabled only while it runs, not while it waits """
+    value, exc = None, None
+    while True:
+        profile.enable()
+        try:
+            yielded = coro.send(value) if exc is None else coro.throw(exc)
+        except StopIteration as e:
+            return e.value
+        finally:
+            profile.disable()
+        try:
+            value, exc = (yield yielded), None
+        except BaseException as e:
+            value, exc = None, e
+
+
+class Profiler:
+    """ Handler of the admin profile command
+
+    Register it with RPCServer.enable_profiling(). A request is accepted
+    from the agents in agents and, with a token, only if its payload
+    carries the token. agentId is whatever the client claims, restrict
+    the admin topic on the broker or set a token.
+
+    Parameters
+    ----------
+    agents: set
+        agentIds allowed to profile, None for any
+    token: str
+        Shared secret the requests must carry
+    max_duration: float
+        Longest capture in seconds
+    max_overhead: float
+        Fraction of the time the sampler may take from the loop thread
+    output_dir: str
+        Directory of the results of requests with toFile, None to refuse them
+    limit: int
+        Default number of stacks, functions or lines of a result
+    """
+
+    def __init__(self, agents=None, token=None, max_duration=30.0, max_overhead=0.02, output_dir=None, limit=50):
+        if agents is None and token is None:
+            logger.warning("Profiling is enabled for every agent, without a token")
+        self.agents = set(agents) if agents is not None else None
+        self.token = token
+        self.max_duration = max_duration
+        self.max_overhead = max_overhead
+        self.output_dir = output_dir
+        self.limit = limit
+        self._active = None
+        self._handler_profile = None
+
+    @property
+    def active(self):
+        """ the mode of the running capture, None if there is none """
+        return self._active
+
+    def authorized(self, agent, payload):
+        if self.agents is not None and agent not in self.agents:
+            return False
+        if self.token is not None:
+            return hmac.compare_digest(str(payload.get("token", "")), self.token)
+        return True
+
+    def handler_profile(self, cmd):
+        """ the cProfile of the running capture of cmd's handler, None unless one runs """
+        if self._handler_profile is not None and self._handler_profile[0] == cmd:
+            return self._handler_profile[1]
+        return None
+
+    async def profiled(self, profile, coro):
+        return await _profile_steps(coro, profile)
+
+    async def handle(self, request):
+        """ run a capture, the profileResponse message as a dict """
+        agent = str(request.agentId)
+        payload = request.payload.as_dict()
+        if not self.authorized(agent, payload):
+            logger.warning(f"Refused profiling request of {agent}")
+            return _response(Code.FAILED, "Not authorized")
+        if self._active is not None:
+            return _response(Code.ALREADY_EXISTS, f"A {self._active} capture is running")
+        mode = payload["mode"]
+        if mode not in MODES:
+            return _response(Code.INVALID_ARGUMENT, f"unknown mode {mode}")
+        duration = float(payload.get("duration", 5.0))
+        if not 0 < duration <= self.max_duration:
+            return _response(Code.INVALID_ARGUMENT, f"duration must be in (0, {self.max_duration}] seconds")
+        if payload.get("toFile") and self.output_dir is None:
+            return _response(Code.INVALID_ARGUMENT, "writing results to files is not enabled")
+        limit = int(payload.get("limit", self.limit))
+
+        logger.info(f"Profiling ({mode}) for {duration} s, requested by {agent}")
+        self._active = mode
+        start = time.perf_counter()
+        try:
+            if mode == SAMPLE:
+                result, stats = await self._sample(duration, float(payload.get("interval", 0.005)), limit)
+            elif mode == CPROFILE:
+                result, stats = await self._cprofile(duration, payload.get("command"), limit)
+            else:
+                result, stats = await self._tracemalloc(duration, limit)
+        finally:
+            self._active = None
+            self._handler_profile = None
+        out = dict(stats, mode=mode, duration=time.perf_counter() - start)
+        if payload.get("toFile"):
+            path = os.path.join(self.output_dir, f"{mode}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.txt")
+            with open(path, "w") as f:
+                f.write(result)
+            out["file"] = path
+        else:
+            out["result"] = result
+        return _response(Code.OK, payload=out)
+
+    async def _sample(self, duration, interval, limit):
+        interval = max(interval, 0.001)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "setitimer"):
+            sampler = SignalSampler(interval, self.max_overhead)
+        else:
+            sampler = Sampler(threading.get_ident(), interval, self.max_overhead)
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            sampler.stop()
+        return sampler.collapsed(limit), {"samples": sampler.samples, "overhead": sampler.busy / duration}
+
+    async def _cprofile(self, duration, cmd, limit):
+        profile = cProfile.Profile()
+        if cmd:
+            # only the steps of the handler, see RPCServer._execute
+            self._handler_profile = (cmd, profile)
+            await asyncio.sleep(duration)
+        else:
+            profile.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profile.disable()
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        calls = stats.total_calls
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        return out.getvalue(), {"samples": calls}
+
+    async def _tracemalloc(self, duration, limit):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(duration)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+        lines = [f"{stat.size_diff:+d} B {stat.count_diff:+d} blocks {stat.traceback[0]}" for stat in diff[:limit]]
+        return "\n".join(lines), {"samples": len(diff)}
+
+
+def _response(code, reason=None, payload=None):
+    status = {"code": code.value, "value": code.name}
+    if reason:
+        status["reason"] = reason
+    res = {"status": status}
+    if payload is not None:
+        res["payload"] = payload
+    return res
@@ -0,0 +1,211 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from quantnet_mq import Code, codec
+
+
+logger = logging.getLogger(__name__)
+
+
+def payload_key(msg):
+    """ default cache key, the canonical JSON of the request payload """
+    if hasattr(msg, "as_dict"):
+        msg = msg.as_dict()
+    return json.dumps(msg, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class CachePolicy:
+    """ Caching of the responses of a read-only RPC command
+
+    Parameters
+    ----------
+    ttl: float
+        Seconds a response is served from the cache
+    max_entries: int
+        Responses kept for the command, the least recently used is evicted
+    key: callable
+        Maps the request payload to a hashable key, payload_key by default
+    invalidate_on: tuple
+        MonitorEvent eventTypes that invalidate cached responses
+    rid: callable
+        Maps (topic, payload) of a request to the rid of the MonitorEvents
+        that invalidate its response, None to invalidate every response of
+        the command on a matching event
+    """
+
+    __slots__ = ("ttl", "max_entries", "key", "invalidate_on", "rid")
+
+    def __init__(self, ttl=1.0, max_entries=1024, key=payload_key, invalidate_on=(), rid=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = key
+        self.invalidate_on = frozenset(invalidate_on)
+        self.rid = rid
+
+
+class RPCResultCache:
+    """ TTL cache of RPC responses with MonitorEvent invalidation
+
+    Only successful responses are cached. Hits, misses, invalidations and
+    the age of the responses served from the cache are counted in stats().
+
+    Parameters
+    ----------
+    clock: callable
+        Monotonic clock of the TTLs
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._policies = {}
+        self._entries = {}
+        self._by_rid = {}
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._invalidated = 0
+        self._evicted = 0
+        self._age_sum = 0.0
+        self._age_max = 0.0
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """ incremented on every invalidation, a response requested before one is not cached """
+        return self._generation
+
+    def set_policy(self, cmd, policy):
+        if policy is None:
+            self._policies.pop(cmd, None)
+            self.invalidate(cmd)
+            return
+        self._policies[cmd] = policy
+        self._entries.setdefault(cmd, OrderedDict())
+
+    def policy(self, cmd):
+        return self._policies.get(cmd)
+
+    def _key(self, cmd, topic, msg):
+        return topic, self._policies[cmd].key(msg)
+
+    def get(self, cmd, topic, msg):
+        """ return the cached response body, None on a miss """
+        policy = self._policies.get(cmd)
+        if policy is None:
+            return None
+        entries = self._entries[cmd]
+        key = self._key(cmd, topic, msg)
+        entry = entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        body, stored, rid = entry
+        age = self._clock() - stored
+        if age > policy.ttl:
+            self._remove(cmd, key)
+            self._expired += 1
+            self._misses += 1
+            return None
+        entries.move_to_end(key)
+        self._hits += 1
+        self._age_sum += age
+        self._age_max = max(self._age_max, age)
+        return body
+
+    def put(self, cmd, topic, msg, body, generation=None):
+        """ cache a response body if it has an OK status.
+
+        generation is the value of the generation property when the request
+        was sent, the response is not cached if an invalidation came since.
+        """
+        policy = self._policies.get(cmd)
+        if policy is None or (generation is not None and generation != self._generation):
+            return False
+        try:
+            status = codec.loads(body).get("status", {})
+        except (ValueError, TypeError, AttributeError):
+            return False
+        if not isinstance(status, dict) or status.get("code") != Code.OK:
+            return False
+        entries = self._entries[cmd]
+        key = self._key(cmd, topic, msg)
+        if key in entries:
+            self._remove(cmd, key)
+        rid = policy.rid(topic, msg) if policy.rid else None
+        entries[key] = (body, self._clock(), rid)
+        if rid is not None:
+            self._by_rid.setdefault((cmd, rid), set()).add(key)
+        while len(entries) > policy.max_entries:
+            self._remove(cmd, next(iter(entries)))
+            self._evicted += 1
+        return True
+
+    def _remove(self, cmd, key):
+        _, _, rid = self._entries[cmd].pop(key)
+        if rid is not None:
+            keys = self._by_rid[(cmd, rid)]
+            keys.discard(key)
+            if not keys:
+                del self._by_rid[(cmd, rid)]
+
+    def invalidate(self, cmd=None, rid=None):
+        """ drop the cached responses of cmd, or of every command, optionally only those of rid """
+        n = 0
+        for c in [cmd] if cmd is not None else list(self._entries):
+            entries = self._entries.get(c)
+            if not entries:
+                continue
+            if rid is None:
+                n += len(entries)
+                entries.clear()
+                for k in [k for k in self._by_rid if k[0] == c]:
+                    del self._by_rid[k]
+            else:
+                for key in list(self._by_rid.get((c, rid), ())):
+                    self._remove(c, key)
+                    n += 1
+        self._invalidated += n
+        self._generation += 1
+        return n
+
+    def on_event(self, event):
+        """ invalidate the responses affected by a MonitorEvent """
+        if hasattr(event, "as_dict"):
+            event = event.as_dict()
+        if not isinstance(event, dict):
+            return 0
+        event_type = event.get("eventType")
+        n = 0
+        for cmd, policy in self._policies.items():
+            if event_type in policy.invalidate_on:
+                n += self.invalidate(cmd, event.get("rid") if policy.rid else None)
+        return n
+
+    def subscribe(self, msgserver, topic):
+        """ invalidate from the monitor events received on topic """
+        msgserver.subscribe(topic, self.on_message)
+
+    async def on_message(self, data):
+        """ MsgServer callback, data is a JSON MonitorEvent or a list of them """
+        try:
+            events = codec.loads(data) if isinstance(data, (str, bytes)) else data
+        except ValueError as e:
+            logger.warning(f"Invalid monitor message: {e}")
+            return
+        for ev in events if isinstance(events, list) else [events]:
+            self.on_event(ev)
+
+    def stats(self):
+        lookups = self._hits + self._misses
+        return {
+            "entries": sum(len(e) for e in self._entries.values()),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": self._hits / lookups if lookups else 0.0,
+            "expired": self._expired,
+            "invalidated": self._invalidated,
+            "evicted": self._evicted,
+            "mean_staleness": self._age_sum / self._hits if self._hits else 0.0,
+            "max_staleness": self._age_max,
+        }
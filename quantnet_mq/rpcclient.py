@@ -1,20 +1,65 @@
 import asyncio
+import heapq
 import importlib
 import logging
 import uuid
 import json
 import uvloop
-import queue
-import threading
-import time
-from datetime import datetime
-from quantnet_mq.gmqtt.mqttclient import MQTTClient, PubRecReasonCode
+from quantnet_mq.gmqtt.mqttclient import MQTTClient, PubRecReasonCode, client_options
 from quantnet_mq.rpc import RPCHandler
+from quantnet_mq import attachments, codec
+from quantnet_mq.rpccache import RPCResultCache, CachePolicy
+from quantnet_mq.hedging import HedgePolicy
+from quantnet_mq.delivery import policies
+from quantnet_mq.limits import PayloadLimits, REASONS, DEFAULT_MAX_BYTES, DEFAULT_MAX_DEPTH
 from quantnet_mq.util import Constants
 
 logger = logging.getLogger(__name__)
 
 
+class PendingCall:
+    """ An outstanding request in the request table """
+
+    __slots__ = ("fut", "handler", "on_error", "deadline", "tag")
+
+    def __init__(self, fut, handler, on_error, deadline):
+        self.fut = fut
+        self.handler = handler
+        self.on_error = on_error
+        self.deadline = deadline
+        # suffix of the correlation id the response came with, "h" for a hedge
+        self.tag = None
+
+
+def _resolve_batch(fut, futs):
+    """ done callback of a batch request, resolves the future of every item """
+    if fut.cancelled():
+        for f in futs:
+            f.cancel()
+        return
+    exc = fut.exception()
+    if exc is None:
+        body = fut.result()
+        # a response with attachments is already decoded, its items keep their arrays
+        decoded = isinstance(body, dict)
+        try:
+            items = (body if decoded else codec.loads(body))["batch"]
+            if len(items) != len(futs):
+                raise ValueError(f"{len(items)} responses for {len(futs)} requests")
+        except Exception as e:
+            exc = ValueError(f"Invalid batch response: {e}")
+    for i, f in enumerate(futs):
+        if f.done():
+            continue
+        if exc is not None:
+            f.set_exception(exc)
+            continue
+        try:
+            f.set_result(items[i] if decoded else codec.dumps(items[i]))
+        except Exception as e:
+            f.set_exception(ValueError(f"Invalid batch response: {e}"))
+
+
 class RPCClient:
     """ This is the class that works as the client in the RPC communication.
     It sends to messages to the remote RPC server and received the response.
@@ -25,7 +70,32 @@ class RPCClient:
         Client ID
     topic: str
         Topic of RPC
+    callback_workers: int
+        Number of tasks running the callbacks of call(sync=False), 0 runs
+        every callback in its own task as the response arrives
+    callback_queue_size: int
+        Maximum number of responses waiting for a callback worker, the
+        receive path waits when the queue is full
+    subscribe_qos: int
+        Maximum QoS of the response subscription
+    max_payload_bytes: int
+        Maximum response size, larger responses fail the call
+    max_payload_depth: int
+        Maximum JSON nesting depth of a response
+    payload_limits: quantnet_mq.limits.PayloadLimits
+        Response limits, instead of max_payload_bytes and max_payload_depth
+    reconnect_delay: float
+        First delay of the reconnect backoff in seconds, doubled up to reconnect_max_delay
+    session_expiry_interval: int
+        Seconds the broker keeps the session and queues messages while disconnected
+    spool: quantnet_mq.spool.Spool
+        Buffer of the messages published while disconnected, False for none
+
+    Requests are published with the delivery policy of their schema, see
+    quantnet_mq.delivery.
 
+    All outstanding calls share one expiry heap and one loop timer, so the
+    number of tasks and timers does not grow with the number of calls.
     """
 
     def __init__(self, cid, topic=Constants.DEFAULT_RPC_TOPIC, **kwargs):
@@ -36,44 +106,158 @@ class RPCClient:
         self._mqtt_client_password = kwargs.get("password", "")
         self._mqtt_broker_host = kwargs.get("host", "127.0.0.1")
         self._mqtt_broker_port = kwargs.get("port", 1883)
+        self._mqtt_client_options = client_options(kwargs)
         self._mqttclient = None
         self._rpc_handlers = dict()
         self._subscriptions = dict()
         self._sent_requests = dict()
+        self._expiry = []
+        self._expiry_at = None
+        self._expiry_handle = None
+        self._callback_workers = kwargs.get("callback_workers", 0)
+        self._callback_queue_size = kwargs.get("callback_queue_size", 1000)
+        self._callback_queue = None
+        self._workers = []
+        self._cache = RPCResultCache()
+        self._hedge_policies = {}
+        self._subscribe_qos = kwargs.get("subscribe_qos", 2)
+        self._limits = kwargs.get("payload_limits") or PayloadLimits(
+            kwargs.get("max_payload_bytes", DEFAULT_MAX_BYTES), kwargs.get("max_payload_depth", DEFAULT_MAX_DEPTH))
 
     @property
     def cid(self):
         return self._cid
 
+    @property
+    def cache(self):
+        """ the RPCResultCache of the commands with a cache policy """
+        return self._cache
+
+    def set_cache_policy(self, cmd: str, ttl=1.0, max_entries=1024, invalidate_on=(), **kwargs):
+        """ serve sync calls of the read-only command cmd from a TTL cache.
+
+        The key and rid arguments of CachePolicy can be given as keyword
+        arguments. Use cache.subscribe() on a MsgServer to invalidate from
+        the invalidate_on MonitorEvents. ttl=None removes the policy.
+        """
+        if ttl is None:
+            self._cache.set_policy(cmd, None)
+            return
+        self._cache.set_policy(cmd, CachePolicy(ttl, max_entries, invalidate_on=invalidate_on, **kwargs))
+
     def on_connect(self, client, flags, rc, properties):
         logger.info("Connected: %s", self._cid)
 
     async def on_message(self, client, topic, payload, qos, properties):
         """ Handle received messages
+
+        The response body is the raw payload, or the decoded message with
+        NumPy arrays if the response carries attachments.
         """
+        # find the correlation id, late responses of hedged requests are dropped before decoding
+        corrid, _, tag = properties["correlation_data"][0].decode("utf-8").partition(".")
+        entry = self._sent_requests.pop(corrid, None)
+        if entry is None:
+            logger.debug("RECV MSG: no request for %s", corrid)
+            return
+        entry.tag = tag
+
+        # the entry is out of _sent_requests, every failure from here on has to fail the call
+        try:
+            rejected = self._limits.check(payload, topic)
+            if rejected is None:
+                body = self._decode(payload)
+        except Exception as e:
+            self._fail(entry, ValueError(f"Invalid RPC response: {e}"))
+            return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+        if rejected is not None:
+            self._fail(entry, ValueError(f"RPC response rejected: {REASONS[rejected]}"))
+            return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+
+        if entry.handler is None:
+            if not entry.fut.done():
+                entry.fut.set_result(body)
+        elif self._callback_queue is not None:
+            await self._callback_queue.put((entry, body))
+        else:
+            asyncio.get_running_loop().create_task(self._run_callback(entry, body))
 
-        jsonString = json.dumps(json.loads(payload), indent=4, sort_keys=False)
-        logger.debug("RECV MSG: %s", jsonString)
-        # find the correlation id
-        corrid = properties["correlation_data"][0].decode("utf-8")
-        # set value of body
-        body = payload
+        return PubRecReasonCode.SUCCESS
+
+    @staticmethod
+    def _decode(payload):
+        """ the response body, raises if the payload is not JSON or its attachments are invalid """
+        if attachments.is_attachment(payload):
+            logger.debug("RECV MSG: %d bytes with attachments", len(payload))
+            return attachments.decode(payload)
+        # decoding checks that the response is JSON, it is formatted only for the debug log
+        msg = codec.loads(payload)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("RECV MSG: %s", json.dumps(msg, indent=4, sort_keys=False))
+        return payload
 
-        # handle requests...
+    async def _run_callback(self, entry, body):
+        """ run the handler callback of a call(sync=False) response """
         try:
-            if not self._sent_requests:
-                return
-            fut = self._sent_requests.pop(corrid)
+            res = entry.handler.cb(body)
+            if asyncio.iscoroutine(res):
+                res = await res
         except Exception as e:
+            self._fail(entry, e)
             return
+        if not entry.fut.done():
+            entry.fut.set_result(res)
 
-        if fut is not None:
+    async def _callback_worker(self):
+        while True:
+            entry, body = await self._callback_queue.get()
             try:
-                fut.set_result(body)
-            except Exception as e:
-                raise Exception(f"Failed to set future result:{e}")
+                await self._run_callback(entry, body)
+            finally:
+                self._callback_queue.task_done()
 
-        return PubRecReasonCode.SUCCESS
+    def _fail(self, entry, exc):
+        if entry.handler is not None:
+            if entry.on_error:
+                try:
+                    entry.on_error(exc)
+                except Exception as e:
+                    logger.error(f"on_error callback failed: {e}")
+            else:
+                logger.error(f"RPC {entry.handler.cmd} failed: {exc}")
+        if not entry.fut.done():
+            entry.fut.set_exception(exc)
+            if entry.handler is not None:
+                # nobody has to await a call(sync=False), do not warn about the unretrieved exception
+                entry.fut.exception()
+
+    def _add_expiry(self, corrid, deadline):
+        heapq.heappush(self._expiry, (deadline, corrid))
+        if self._expiry_at is None or deadline < self._expiry_at:
+            self._arm_expiry(deadline)
+
+    def _arm_expiry(self, when):
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+        self._expiry_at = when
+        self._expiry_handle = asyncio.get_running_loop().call_at(when, self._expire)
+
+    def _expire(self):
+        """ fail the calls past their deadline, the one timer is re-armed for the next deadline """
+        self._expiry_handle = self._expiry_at = None
+        now = asyncio.get_running_loop().time()
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, corrid = heapq.heappop(self._expiry)
+            entry = self._sent_requests.get(corrid)
+            # answered calls are left in the heap and skipped here
+            if entry is None or entry.deadline != deadline:
+                continue
+            del self._sent_requests[corrid]
+            if entry.handler is None:
+                logger.error("Timeout awaiting RPC response")
+            self._fail(entry, TimeoutError("Timeout awaiting RPC response"))
+        if self._expiry:
+            self._arm_expiry(self._expiry[0][0])
 
     def on_disconnect(self, client, packet, exc=None):
         logger.info("Disconnected")
@@ -86,33 +270,137 @@ class RPCClient:
         start the mqtt client
         """
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-        self._mqttclient = MQTTClient(f"rpcclient-{self._cid}")
+        self._mqttclient = MQTTClient(f"rpcclient-{self._cid}", **self._mqtt_client_options)
         self._mqttclient.on_connect = self.on_connect
         self._mqttclient.on_message = self.on_message
         self._mqttclient.on_disconnect = self.on_disconnect
         self._mqttclient.on_subscribe = self.on_subscribe
         self._mqttclient.set_auth_credentials(self._mqtt_client_username, self._mqtt_client_password)
         await self._mqttclient.connect(host=self._mqtt_broker_host, port=self._mqtt_broker_port)
-        self._mqttclient.subscribe(self._queue, 2)
-        self._add_subscription(self._queue, 2)
+        self._mqttclient.subscribe(self._queue, self._subscribe_qos)
+        self._add_subscription(self._queue, self._subscribe_qos)
 
     def _add_subscription(self, queue, qos):
         self._subscriptions[queue] = qos
 
-    def _stop_mqttclient(self):
-        if not self._sync and self._resp_task:
-            self._resp_task_exit = True
-            self._resp_task.join(2*self._resp_timeout)
-            logger.info(f"Stopped response thread")
-        pass
+    async def _stop_mqttclient(self):
+        if self._mqttclient:
+            # a clean stop ends the session on the broker
+            await self._mqttclient.disconnect(session_expiry_interval=0)
+            self._mqttclient = None
+        for entry in self._sent_requests.values():
+            entry.fut.cancel()
+        self._sent_requests.clear()
+        self._expiry.clear()
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+            self._expiry_handle = self._expiry_at = None
+        for w in self._workers:
+            w.cancel()
+        self._workers = []
+        self._callback_queue = None
 
-    async def call(self, target, msg, timeout=5.0, verbose=None, topic=None, model="quantnet_mq.schema.models", sync=True):
+    def set_hedge_policy(self, cmd: str, topics, **kwargs):
+        """ hedge sync calls of the idempotent command cmd to the replica topics,
+        see HedgePolicy for the keyword arguments. topics=None removes the policy.
+        """
+        if topics is None:
+            self._hedge_policies.pop(cmd, None)
+            return
+        self._hedge_policies[cmd] = HedgePolicy(topics, **kwargs)
+
+    def hedge_stats(self, cmd):
+        policy = self._hedge_policies.get(cmd)
+        return policy.stats() if policy else None
+
+    @property
+    def limits(self):
+        """ the PayloadLimits of the responses, rejections are counted in limits.stats() """
+        return self._limits
+
+    def _publish_request(self, topic, payload, corrid, delivery):
+        qos, retain, kwargs = delivery.publish_args()
+        self._mqttclient.publish(
+            topic,
+            payload,
+            correlation_data=corrid.encode("utf-8"),
+            response_topic=self._queue,
+            qos=qos,
+            retain=retain,
+            **kwargs,
+        )
+
+    async def _hedged(self, policy, entry, topic, payload, corrid, delivery):
+        """ wait for the response, resend to a replica when none came within the hedge delay """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        policy.request()
+        try:
+            body = await asyncio.wait_for(asyncio.shield(entry.fut), policy.delay)
+        except asyncio.TimeoutError:
+            # the call itself may have timed out
+            alternate = None if entry.fut.done() else policy.acquire(topic)
+            if alternate is not None:
+                logger.debug(f"Hedging RPC {corrid} to {alternate}")
+                self._publish_request(alternate, payload, f"{corrid}.h", delivery)
+            body = await entry.fut
+        if entry.tag == "h":
+            policy.hedge_wins += 1
+        policy.observe(loop.time() - start)
+        return body
+
+    async def call(self, target, msg, timeout=5.0, verbose=None, topic=None, model="quantnet_mq.schema.models",
+                   sync=True, on_error=None):
+        """ Send an RPC request.
+
+        With sync=True wait for the response and return its body, raises
+        TimeoutError after timeout seconds. With sync=False return at once
+        with a future of the handler callback result; the callback runs
+        when the response arrives, errors and the timeout go to on_error.
+        """
         if topic is None:
             topic = self._topic
         if target not in self._rpc_handlers.keys():
             logging.error(f"Unknown RPC target: {target}")
             raise Exception(f"RPC message target not defined: {target}")
         handler = self._rpc_handlers[target]
+        cached = sync and self._cache.policy(target) is not None
+        if cached:
+            body = self._cache.get(target, topic, msg)
+            if body is not None:
+                return body
+            generation = self._cache.generation
+        obj = self._build_request(handler, target, msg, model)
+        corrid = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        deadline = loop.time() + timeout
+        entry = self._sent_requests[corrid] = PendingCall(fut, None if sync else handler, on_error, deadline)
+        self._add_expiry(corrid, deadline)
+
+        payload = codec.serialize(obj)
+        # delivery policy of the request schema, e.g. getInfo
+        delivery = policies.get(handler.classpath.rsplit(".", 1)[-1])
+        self._publish_request(topic, payload, corrid, delivery)
+
+        if sync:
+            policy = self._hedge_policies.get(target)
+            if policy is not None:
+                body = await self._hedged(policy, entry, topic, payload, corrid, delivery)
+            else:
+                body = await fut
+            if cached:
+                self._cache.put(target, topic, msg, body, generation)
+            return body
+        return fut
+
+    def _start_callback_workers(self):
+        if self._callback_workers and not self._workers:
+            self._callback_queue = asyncio.Queue(self._callback_queue_size)
+            self._workers = [asyncio.create_task(self._callback_worker()) for _ in range(self._callback_workers)]
+
+    def _build_request(self, handler, target, msg, model):
+        """ the schema object of a request """
         module_name, class_name = handler.classpath.rsplit(".", 1)
         submodules = handler.classpath.replace(f"{model}.", "").split(".")
         model_module = importlib.import_module(model)
@@ -127,38 +415,43 @@ class RPCClient:
             from quantnet_mq.schema.loader import schemaLoader
             rmsg = {"cmd": target, "agentId": self._cid, "payload": msg}
             obj = schemaLoader.coerceRPC(module_name, RPCClass, rmsg)
-        corrid = uuid.uuid4().hex
-        self._mqttclient.publish(
-            topic,
-            obj.serialize(),
-            correlation_data=corrid.encode("utf-8"),
-            response_topic=self._queue,
-            qos=1,
-            retain=False,
-        )
+        return obj
+
+    async def call_batch(self, calls, timeout=5.0, ordered=False, topic=None, model="quantnet_mq.schema.models"):
+        """ Send several RPC requests in one message.
+
+        calls is a list of (target, msg). The server runs the requests
+        concurrently, or one after the other with ordered=True, and answers
+        with one message. Returns a list with a future of the response body
+        of every call, each response has its own status.
+        """
+        if topic is None:
+            topic = self._topic
+        items = []
+        for target, msg in calls:
+            handler = self._rpc_handlers.get(target)
+            if handler is None:
+                logging.error(f"Unknown RPC target: {target}")
+                raise Exception(f"RPC message target not defined: {target}")
+            obj = self._build_request(handler, target, msg, model)
+            obj.validate()
+            items.append(obj.for_json())
 
+        corrid = uuid.uuid4().hex
         loop = asyncio.get_running_loop()
         fut = loop.create_future()
-        self._sent_requests[corrid] = fut
+        futs = [loop.create_future() for _ in items]
+        fut.add_done_callback(lambda f: _resolve_batch(f, futs))
+        deadline = loop.time() + timeout
+        self._sent_requests[corrid] = PendingCall(fut, None, None, deadline)
+        self._add_expiry(corrid, deadline)
 
-        if sync:
-            try:
-                await asyncio.wait_for(fut, timeout=timeout)
-            except asyncio.exceptions.TimeoutError:
-                logger.error("Timeout awaiting RPC response")
-                raise TimeoutError("Timeout awaiting RPC response")
-            body = fut.result()
-            return body
-        else:
-            task = None
-            try:
-                task = asyncio.create_task(self.resp_task(handler, fut))
-            except Exception as e:
-                logger.error(f"resp_task can not create: {e}")
-                raise e
-            return task
+        batch = {"cmd": Constants.BATCH_CMD, "agentId": self._cid, "ordered": ordered, "payload": items}
+        self._publish_request(topic, codec.dumps(batch), corrid, policies.get(Constants.BATCH_CMD))
+        return futs
 
     async def start(self):
+        self._start_callback_workers()
         await self._start_mqttclient()
 
     async def stop(self):
@@ -166,19 +459,3 @@ class RPCClient:
 
     def set_handler(self, cmd: str, cb, classpath):
         self._rpc_handlers[cmd] = RPCHandler(cmd, cb, classpath)
-
-    async def resp_task(self, handler, fut, timeout=5.0):
-        """ Task handling response messages
-        """
-
-        try:
-            await asyncio.wait_for(fut, timeout=timeout)
-            cb_func = handler.cb
-            body = fut.result()
-            await cb_func(body)
-        except asyncio.TimeoutError:
-            logger.info(f"resp_task was terminated due to a {timeout} second timeout!")
-        except Exception as e:
-            logger.info(e)
-
-        logger.info("resp_task was terminated successfully.")
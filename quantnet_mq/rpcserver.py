@@ -5,11 +5,16 @@ import uuid
 import json
 import uvloop
 import types
-from quantnet_mq import Code
-from quantnet_mq.gmqtt.mqttclient import MQTTClient, PubRecReasonCode
+from quantnet_mq import Code, attachments, codec
+from quantnet_mq.gmqtt.mqttclient import MQTTClient, PubRecReasonCode, client_options
 from quantnet_mq.rpc import RPCHandler
 from quantnet_mq.util import Constants
+from quantnet_mq.delivery import policies
+from quantnet_mq.fairshare import FairShare
+from quantnet_mq.profiling import Profiler, PROFILE_CMD
+from quantnet_mq.limits import PayloadLimits, REASONS, DEFAULT_MAX_BYTES, DEFAULT_MAX_DEPTH
 from quantnet_mq.schema.models import (
+    Schema,
     rpcResponse,
     Status as responseStatus,
 )
@@ -20,45 +25,93 @@ logger = logging.getLogger(__name__)
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
+def payload_key(rpcmsg):
+    """ default single-flight key, the canonical JSON of the request payload """
+    return json.dumps(rpcmsg.get("payload"), sort_keys=True, separators=(",", ":"))
+
+
 class RPCServer:
     def __init__(self, cid, model="quantnet_mq.schema.models", topic=Constants.DEFAULT_RPC_TOPIC, **kwargs):
         self._cid = cid or uuid.uuid4().hex
         self._topic = topic or Constants.DEFAULT_RPC_TOPIC
+        # servers of a shared subscription group split the requests, the broker balances them
+        shared_group = kwargs.get("shared_group")
+        self._filter = f"$share/{shared_group}/{self._topic}" if shared_group else self._topic
         self._rpc_handlers = {}
         self._model = model
         self._mqtt_client_username = kwargs.get("username", "")
         self._mqtt_client_password = kwargs.get("password", "")
         self._mqtt_broker_host = kwargs.get("host", "127.0.0.1")
         self._mqtt_broker_port = kwargs.get("port", 1883)
+        self._mqtt_client_options = client_options(kwargs)
         self._mqttclient = None
+        self._subscribe_qos = kwargs.get("subscribe_qos", 2)
+        self._recorder = kwargs.get("recorder")
+        self._limits = kwargs.get("payload_limits") or PayloadLimits(
+            kwargs.get("max_payload_bytes", DEFAULT_MAX_BYTES), kwargs.get("max_payload_depth", DEFAULT_MAX_DEPTH))
+        # serialized once, rejecting a payload costs no encoding
+        self._rejections = {kind: codec.serialize(self._error_response(reason, Code.INVALID_ARGUMENT.value))
+                            for kind, reason in REASONS.items()}
+        self._fair_share = kwargs.get("fair_share")
+        self._rate_limited = codec.serialize(self._error_response("Rate limit exceeded"))
+        self._classes = {}
+        self._profiler = None
+        self._schema_generation = Schema.generation
+        self._single_flight = {}
+        self._in_flight = {}
+        self._stats = {"single_flight_executions": 0, "single_flight_collapsed": 0}
+
+    def _send_response(self, response, properties, handler=None):
+        self._send_responses(response, [properties], handler)
 
-    def _send_response(self, response, properties):
-        """ send back response """
+    def _send_responses(self, response, targets, handler=None):
+        """ send back response to every (response_topic, correlation_data) of targets,
+        the response is serialized once. NumPy arrays in a dict response are sent as binary attachments.
+        The delivery policy is the one of the response schema of handler, e.g. getInfoResponse """
+        name = f"{handler.classpath.rsplit('.', 1)[-1]}Response" if handler else "rpcResponse"
+        qos, retain, kwargs = policies.get(name).publish_args()
         if isinstance(response, dict):
             res = response
+            if attachments.has_arrays(res):
+                res = attachments.encode(res)
+                kwargs["content_type"] = attachments.CONTENT_TYPE
+        elif isinstance(response, (str, bytes)):
+            res = response
         else:
-            res = response.serialize()
-        self._mqttclient.publish(properties['response_topic'][0],
-                                 res,
-                                 correlation_data=properties['correlation_data'][0],
-                                 qos=1,
-                                 retain=False)
+            res = codec.serialize(response)
+        for properties in targets:
+            self._mqttclient.publish(properties['response_topic'][0],
+                                     res,
+                                     correlation_data=properties['correlation_data'][0],
+                                     qos=qos,
+                                     retain=retain,
+                                     **kwargs)
         logger.debug(f'Sent RPC response: {res}')
 
     def on_connect(self, client, flags, rc, properties):
         logger.info('Connected: %s', self._cid)
-        self._mqttclient.subscribe(self._topic, 2)
+        # the client renews its subscriptions on reconnects
+        if not any(sub.topic == self._filter for sub in client.subscriptions):
+            self._mqttclient.subscribe(self._filter, self._subscribe_qos)
 
     async def on_message(self, client, topic, payload, qos, properties):
         """ check message properties """
+        if self._recorder is not None:
+            self._recorder.record(topic, payload, qos, properties)
         if 'response_topic' not in properties.keys() or 'correlation_data' not in properties.keys():
             reason = "no response_topic or correlation_data found in the propeties"
             logger.warning(reason)
             return PubRecReasonCode.TOPIC_NAME_INVALID
 
+        # size and depth limits, before anything is decoded
+        rejected = self._limits.check(payload, topic)
+        if rejected is not None:
+            self._send_response(self._rejections[rejected], properties)
+            return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+
         """ parse the message """
         try:
-            rpcmsg = json.loads(payload)
+            rpcmsg = codec.loads(payload)
             logger.debug(f"Received message: {rpcmsg}")
             if not isinstance(rpcmsg, dict):
                 raise Exception('unknown format')
@@ -89,6 +142,36 @@ class RPCServer:
             return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
 
         cmd = rpcmsg['cmd']
+        if self._limits.has_command_limits and isinstance(cmd, str):
+            # the command found in the raw bytes may not be the one decoded
+            rejected = self._limits.check(payload, topic, cmd)
+            if rejected is not None:
+                self._send_response(self._rejections[rejected], properties)
+                return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+
+        fair_share = self._fair_share
+        if fair_share is None:
+            return await self._dispatch(cmd, rpcmsg, properties, topic)
+        if not await fair_share.acquire(rpcmsg.get('agentId'), self._cost(cmd, rpcmsg)):
+            self._send_response(self._rate_limited, properties)
+            return PubRecReasonCode.QUOTA_EXCEEDED
+        try:
+            return await self._dispatch(cmd, rpcmsg, properties, topic)
+        finally:
+            fair_share.release()
+
+    def _cost(self, cmd, rpcmsg):
+        """ fair share cost of a request, a batch costs the sum of its requests """
+        if cmd == Constants.BATCH_CMD and isinstance(rpcmsg.get('payload'), list):
+            return sum(self._fair_share.cost(item.get('cmd')) if isinstance(item, dict) else 1.0
+                       for item in rpcmsg['payload'])
+        return self._fair_share.cost(cmd)
+
+    async def _dispatch(self, cmd, rpcmsg, properties, topic=None):
+        """ run the request of a decoded message and send the response """
+        if cmd == Constants.BATCH_CMD:
+            return await self._handle_batch(rpcmsg, properties, topic)
+
         if cmd not in self._rpc_handlers.keys():
             rc = 6
             reason = f"cmd not defined: {cmd}"
@@ -104,41 +187,133 @@ class RPCServer:
             return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
 
         handler = self._rpc_handlers[cmd]
+        key_func = self._single_flight.get(cmd)
+        if key_func is None:
+            res, rc = await self._execute(handler, cmd, rpcmsg)
+            self._send_response(res, properties, handler)
+            return rc
+
+        # single-flight: identical concurrent requests wait for the one execution
+        try:
+            key = (cmd, key_func(rpcmsg))
+        except Exception as e:
+            logger.warning(f"Failed single-flight key of {cmd}: {e}")
+            res, rc = await self._execute(handler, cmd, rpcmsg)
+            self._send_response(res, properties, handler)
+            return rc
+        waiters = self._in_flight.get(key)
+        if waiters is not None:
+            waiters.append(properties)
+            self._stats["single_flight_collapsed"] += 1
+            return PubRecReasonCode.SUCCESS
+        waiters = self._in_flight[key] = [properties]
+        self._stats["single_flight_executions"] += 1
         try:
-            module_name, class_name = handler.classpath.rsplit(".", 1)
+            res, rc = await self._execute(handler, cmd, rpcmsg)
+        finally:
+            del self._in_flight[key]
+        self._send_responses(res, waiters, handler)
+        return rc
+
+    @staticmethod
+    def _error_response(reason, rc=6):
+        return rpcResponse(status=responseStatus(code=rc, value=Code(rc).name, reason=reason), reason=reason)
+
+    async def _handle_batch(self, rpcmsg, properties, topic=None):
+        """ run the requests of a batch envelope and send back one response with a response per request """
+        items = rpcmsg.get('payload')
+        if not isinstance(items, list):
+            self._send_response(self._error_response("Invalid RPC batch format"), properties)
+            return PubRecReasonCode.PAYLOAD_FORMAT_INVALID
+        if rpcmsg.get('ordered', False):
+            results = [await self._batch_item(item, topic) for item in items]
+        else:
+            results = await asyncio.gather(*(self._batch_item(item, topic) for item in items))
+        rc = 0
+        self._send_response({"status": {"code": rc, "value": Code(rc).name}, "batch": results}, properties)
+        return PubRecReasonCode.SUCCESS
+
+    async def _batch_item(self, item, topic=None):
+        """ the response of one request of a batch, as a dict; a failure only fails its own response """
+        try:
+            if not isinstance(item, dict) or 'cmd' not in item:
+                res = self._error_response("Invalid RPC message format")
+            elif item['cmd'] not in self._rpc_handlers:
+                reason = f"cmd not defined: {item['cmd']}"
+                logger.warning(reason)
+                res = self._error_response(reason)
+            else:
+                rejected = None
+                if self._limits.has_command_limits and isinstance(item['cmd'], str):
+                    # the envelope was checked against the topic limit, each request is against its command's
+                    rejected = self._limits.check(codec.dumps(item), topic or "", item['cmd'])
+                if rejected is not None:
+                    res = self._error_response(REASONS[rejected], Code.INVALID_ARGUMENT.value)
+                else:
+                    res, _ = await self._execute(self._rpc_handlers[item['cmd']], item['cmd'], item)
+            if isinstance(res, (str, bytes)):
+                res = codec.loads(res)
+            if isinstance(res, dict):
+                return res
+            res.validate()
+            return res.for_json()
+        except Exception as e:
+            reason = f"Failed batch item: {e}"
+            logger.warning(reason)
+            return self._error_response(reason).for_json()
+
+    def _handler_class(self, handler):
+        """ the schema class of a handler, looked up again after Schema.register() """
+        if self._schema_generation != Schema.generation:
+            self._classes.clear()
+            self._schema_generation = Schema.generation
+        cls = self._classes.get(handler.classpath)
+        if cls is None:
+            class_name = handler.classpath.rsplit(".", 1)[-1]
             submodules = handler.classpath.replace(f"{self._model}.", "").split(".")
             model_module = importlib.import_module(self._model)
             for submodule in submodules[:-1]:
                 model_module = getattr(model_module, submodule)
-            MyClass = getattr(model_module, class_name)
+            cls = self._classes[handler.classpath] = getattr(model_module, class_name)
+        return cls
+
+    async def _execute(self, handler, cmd, rpcmsg):
+        """ run the handler of a request, returns the response and the PUBREC reason code """
+        try:
+            module_name = handler.classpath.rsplit(".", 1)[0]
+            MyClass = self._handler_class(handler)
             try:
-                instance = MyClass.from_json(payload)
+                instance = codec.from_dict(MyClass, rpcmsg)
             except Exception:
                 # Explicitly try each type in abc if coercion above fails
                 from quantnet_mq.schema.loader import schemaLoader
                 instance = schemaLoader.coerceRPC(module_name, MyClass, rpcmsg)
-            if (handler):
+            profile = self._profiler.handler_profile(cmd) if self._profiler is not None else None
+            if profile is None:
                 res = handler.handle(instance)
-                if isinstance(res, types.CoroutineType):
-                    res = await res
-                if not res:
-                    rc = 0
-                    res = rpcResponse(status=responseStatus(code=rc, value=Code(rc).name))
-                self._send_response(res, properties)
-                return PubRecReasonCode.SUCCESS
+            else:
+                profile.enable()
+                try:
+                    res = handler.handle(instance)
+                finally:
+                    profile.disable()
+            if isinstance(res, types.CoroutineType):
+                res = await (res if profile is None else self._profiler.profiled(profile, res))
+            if not res:
+                rc = 0
+                res = rpcResponse(status=responseStatus(code=rc, value=Code(rc).name))
+            return res, PubRecReasonCode.SUCCESS
         except Exception as e:
             rc = 6
             reason = f"Failed cmd {cmd}: {e}"
-            self._send_response(
-                rpcResponse(
-                    status=responseStatus(
-                        code=rc,
-                        value=Code(rc).name,
-                        reason=reason),
-                    reason=reason),
-                properties)
             logger.warn(reason)
-            return PubRecReasonCode.IMPLEMENTATION_SPECIFIC_ERROR
+            return (rpcResponse(
+                        status=responseStatus(
+                            code=rc,
+                            value=Code(rc).name,
+                            reason=reason),
+                        reason=reason),
+                    PubRecReasonCode.IMPLEMENTATION_SPECIFIC_ERROR)
 
     def on_disconnect(self, client, packet, exc=None):
         logger.info('Disconnected')
@@ -151,7 +326,7 @@ class RPCServer:
         """
         start the mqtt client
         """
-        self._mqttclient = MQTTClient(f'rpcserver-{self._cid}')
+        self._mqttclient = MQTTClient(f'rpcserver-{self._cid}', **self._mqtt_client_options)
         self._mqttclient.on_connect = self.on_connect
         self._mqttclient.on_message = self.on_message
         self._mqttclient.on_disconnect = self.on_disconnect
@@ -162,14 +337,17 @@ class RPCServer:
                                        port=self._mqtt_broker_port)
         #self._mqttclient.subscribe(self._topic, 2)
 
-    def _stop_mqttclient(self):
-        pass
+    async def _stop_mqttclient(self):
+        if self._mqttclient:
+            # a clean stop ends the session on the broker
+            await self._mqttclient.disconnect(session_expiry_interval=0)
+            self._mqttclient = None
 
     async def start(self):
         await self._start_mqttclient()
 
     async def stop(self):
-        self._stop_mqttclient()
+        await self._stop_mqttclient()
 
     @property
     def on_rpcmsg(self):
@@ -181,5 +359,41 @@ class RPCServer:
             raise ValueError
         self._on_rpcmsg_callback = cb
 
-    def set_handler(self, cmd: str, cb, classpath):
+    def stats(self):
+        """ single-flight counters, collapsed requests were answered by the execution of an identical one,
+        and the counts of requests rejected by the payload limits """
+        return dict(self._stats, **self._limits.stats())
+
+    def set_fair_share(self, fair_share: FairShare):
+        """ per agent rate limits and fair queuing of the requests, None to turn them off """
+        self._fair_share = fair_share
+
+    def enable_profiling(self, profiler=None, **kwargs):
+        """ register the admin profile command, see quantnet_mq.profiling.Profiler for the keyword arguments """
+        self._profiler = profiler or Profiler(**kwargs)
+        self.set_handler(PROFILE_CMD, self._profiler.handle, f"{self._model}.admin.profile")
+        return self._profiler
+
+    def agent_usage(self, agent=None):
+        """ fair share usage of an agent, or of every agent, see FairShare.usage """
+        if self._fair_share is None:
+            return None
+        return self._fair_share.usage(agent)
+
+    @property
+    def limits(self):
+        """ the PayloadLimits of the requests, e.g. limits.set_command_limit("submit", max_bytes=1 << 20) """
+        return self._limits
+
+    def set_handler(self, cmd: str, cb, classpath, single_flight=False, key=None):
+        """ set the handler of cmd.
+
+        With single_flight, concurrent requests of cmd with the same key share
+        one execution of the handler and its response. key maps the request
+        message to a hashable key, the canonical JSON of the payload by default.
+        """
         self._rpc_handlers[cmd] = RPCHandler(cmd, cb, classpath)
+        if single_flight:
+            self._single_flight[cmd] = key or payload_key
+        else:
+            self._single_flight.pop(cmd, None)
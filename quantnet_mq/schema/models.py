@@ -1,12 +1,16 @@
+import asyncio
 import os
 import sys
 import json
+import threading
+from collections import defaultdict
 from referencing import Registry, Resource
 import yaml
 import python_jsonschema_objects as pjs
 import importlib
 import pathlib
 import quantnet_mq
+from quantnet_mq import codec
 
 default_ns = sys.modules[__name__]
 module_path = os.path.dirname(quantnet_mq.__file__)
@@ -20,6 +24,20 @@ schema_dirs = [
 ]
 
 
+class SchemaComponent:
+    """ a component of a schema file, the classes built from it and the components it references """
+
+    __slots__ = ("node", "module", "schema", "base", "refs", "classes")
+
+    def __init__(self, node, module, schema, base, refs, classes):
+        self.node = node
+        self.module = module
+        self.schema = schema
+        self.base = base
+        self.refs = refs
+        self.classes = classes
+
+
 class Schema:
     _SCHEMA = {}
     _SCHEMA_CACHE = {}
@@ -29,6 +47,14 @@ class Schema:
     _BASE_URI = "uri:quant-net:mq"
     _SCHEMA_DRAFT = "http://json-schema.org/draft-04/schema#"
     _cpath = None
+    # (file path, component name) -> SchemaComponent, and the components referencing each one
+    _COMPONENTS = {}
+    _DEPENDENTS = defaultdict(set)
+    # _SCHEMA_CACHE key -> (file path, URI) of the cached resources
+    _URIS = {}
+    _lock = threading.Lock()
+    # incremented whenever register() swaps in new classes
+    generation = 0
 
     def __str__(self):
         ret = f"{'NAME':<20}{'NAMESPACE':<20}SCHEMA\n"
@@ -80,18 +106,93 @@ class Schema:
 
     @staticmethod
     def _get_resource_yaml(uri: str):
-        schema = Schema._SCHEMA_CACHE.get(uri)
-        if schema:
-            return Resource.from_contents(schema)
+        return Schema._get_resource(uri, Schema._cpath)
+
+    @staticmethod
+    def _get_resource(uri: str, base, staged=None):
+        """ the resource of a reference; with staged, a dict of key -> (contents, file path, URI),
+        it is looked up there first and a resource read from its file goes there instead of the cache """
         if uri.startswith(Schema._URI_PREFIX):
+            key = uri
             path = Schema._SCHEMA_DIR / pathlib.Path(uri.removeprefix(Schema._URI_PREFIX))
         else:
-            path = Schema._cpath / pathlib.Path(uri)
-        contents = yaml.safe_load(path.read_text())
+            # relative references of files in different directories are different files
+            path = pathlib.Path(base) / pathlib.Path(uri)
+            key = os.path.normpath(path)
+        if staged is not None and key in staged:
+            return Resource.from_contents(staged[key][0])
+        schema = Schema._SCHEMA_CACHE.get(key)
+        if schema:
+            return Resource.from_contents(schema)
+        contents = Schema._class_schema(yaml.safe_load(path.read_text()))
         Schema._add_schema_id(contents, uri)
-        Schema._SCHEMA_CACHE[uri] = contents
+        if staged is not None:
+            staged[key] = (contents, os.path.normpath(path), uri)
+        else:
+            Schema._SCHEMA_CACHE[key] = contents
+            Schema._URIS[key] = (os.path.normpath(path), uri)
         return Resource.from_contents(contents)
 
+    @staticmethod
+    def _refs(schema, path, base):
+        """ the (file path, component name) of the components a component references """
+        refs = set()
+        stack = [schema]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, dict):
+                ref = obj.get("$ref")
+                if isinstance(ref, str):
+                    uri, _, fragment = ref.partition("#")
+                    if fragment.startswith("/components/schemas/"):
+                        if not uri:
+                            target = path
+                        elif uri.startswith(Schema._URI_PREFIX):
+                            target = os.path.join(Schema._SCHEMA_DIR, uri.removeprefix(Schema._URI_PREFIX))
+                        else:
+                            target = os.path.join(base, uri)
+                        refs.add((os.path.normpath(target), fragment.rsplit("/", 1)[-1]))
+                stack.extend(obj.values())
+            elif isinstance(obj, list):
+                stack.extend(obj)
+        return refs
+
+    @staticmethod
+    def _class_schema(schema):
+        """ a copy of schema without the anyOf that only list required fields, e.g. timeSlot or
+        slotMap of an allocation; the classes can not express them, the validator checks them """
+        if isinstance(schema, list):
+            return [Schema._class_schema(s) for s in schema]
+        if not isinstance(schema, dict):
+            return schema
+        any_of = schema.get("anyOf")
+        drop = isinstance(any_of, list) and all(isinstance(s, dict) and list(s) == ["required"] for s in any_of)
+        return {k: Schema._class_schema(v) for k, v in schema.items() if not (drop and k == "anyOf")}
+
+    @staticmethod
+    def _build(schema, base, staged=None):
+        """ the classes of a component, by name """
+        builder = pjs.ObjectBuilder(Schema._class_schema(schema),
+                                    resolver=lambda uri: Schema._get_resource(uri, base, staged))
+        builder.basedir = "/"
+        ns = builder.build_classes(named_only=True, standardize_names=False)
+        classes = {cls: ns[cls] for cls in dir(ns)}
+        for cls in classes.values():
+            if isinstance(cls, type) and issubclass(cls, pjs.classbuilder.ProtocolBase):
+                # messages are decoded by the codec backend instead of the json module
+                cls.from_json = classmethod(codec.from_json)
+        return classes
+
+    @staticmethod
+    def _track(component):
+        old = Schema._COMPONENTS.get(component.node)
+        if old is not None:
+            for ref in old.refs:
+                Schema._DEPENDENTS[ref].discard(old.node)
+        Schema._COMPONENTS[component.node] = component
+        for ref in component.refs:
+            Schema._DEPENDENTS[ref].add(component.node)
+
     @staticmethod
     def _convert_yaml(f):
         with open(f, "r") as file:
@@ -115,19 +216,128 @@ class Schema:
             module = default_ns
 
         Schema._cpath = fpath.parent.absolute()
+        path = os.path.normpath(fpath.absolute())
+        base = os.path.dirname(path)
         sdata = Schema._get_file_yaml(fpath)
         for k, v in sdata["components"]["schemas"].items():
             Schema._add_schema_id(v, k)
-            builder = pjs.ObjectBuilder(v, resolver=Schema._get_resource_yaml)
-            builder.basedir = "/"
-            ns = builder.build_classes(named_only=True, standardize_names=False)
-            for cls in dir(ns):
-                setattr(module, cls, ns[cls])
+            classes = Schema._build(v, base)
+            for cls, value in classes.items():
+                setattr(module, cls, value)
+            Schema._track(SchemaComponent((path, k), module, v, base, Schema._refs(v, path, base), list(classes)))
 
         # Update Schema entry as needed
         if not Schema.get_entry(name):
             Schema.set_entry(name, str(fpath), namespace, classes, sdata)
 
+    @staticmethod
+    def _stage(fname, ns=None):
+        """ parse a schema file and build the classes it changes, nothing is visible yet """
+        fpath = pathlib.Path(fname)
+        path = os.path.normpath(fpath.absolute())
+        base = os.path.dirname(path)
+        name = fpath.stem
+        namespace = ns or name
+        module = default_ns if namespace == "default" else getattr(default_ns, namespace, None)
+        created = module is None
+        if created:
+            spec = importlib.machinery.ModuleSpec(namespace, None)
+            module = importlib.util.module_from_spec(spec)
+
+        sdata = Schema._get_file_yaml(fpath)
+        schemas = sdata["components"]["schemas"]
+        for k, v in schemas.items():
+            Schema._add_schema_id(v, k)
+        old = {n: c for (p, n), c in Schema._COMPONENTS.items() if p == path}
+        changed = [(path, k) for k, v in schemas.items() if k not in old or old[k].schema != v]
+        removed = [old[k] for k in old if k not in schemas]
+
+        # the references to the file resolve to its new contents, the cache is updated by _swap
+        staged = {}
+        for key, (target, uri) in list(Schema._URIS.items()):
+            if target == path:
+                contents = Schema._get_file_yaml(fpath)
+                Schema._add_schema_id(contents, uri)
+                staged[key] = (contents, target, uri)
+
+        affected = set()
+        pending = changed + [c.node for c in removed]
+        while pending:
+            node = pending.pop()
+            if node not in affected:
+                affected.add(node)
+                pending.extend(Schema._DEPENDENTS.get(node, ()))
+
+        built = []
+        for node in sorted(affected):
+            if node[0] == path:
+                if node[1] not in schemas:
+                    continue
+                schema, target, component_base = schemas[node[1]], module, base
+            elif node in Schema._COMPONENTS:
+                c = Schema._COMPONENTS[node]
+                schema, target, component_base = c.schema, c.module, c.base
+            else:
+                continue
+            classes = Schema._build(schema, component_base, staged)
+            refs = Schema._refs(schema, node[0], component_base)
+            built.append((SchemaComponent(node, target, schema, component_base, refs, list(classes)), classes))
+        return name, namespace, str(fpath), sdata, module if created else None, built, removed, staged
+
+    @staticmethod
+    def _swap(staged):
+        """ make the staged classes visible, in one step without awaiting """
+        name, namespace, fpath, sdata, created, built, removed, resources = staged
+        for key, (contents, target, uri) in resources.items():
+            Schema._SCHEMA_CACHE[key] = contents
+            Schema._URIS[key] = (target, uri)
+        if created is not None:
+            setattr(default_ns, namespace, created)
+        for component, classes in built:
+            for cls, value in classes.items():
+                setattr(component.module, cls, value)
+            Schema._track(component)
+        for component in removed:
+            del Schema._COMPONENTS[component.node]
+            for ref in component.refs:
+                Schema._DEPENDENTS[ref].discard(component.node)
+            kept = set()
+            for c in Schema._COMPONENTS.values():
+                if c.module is component.module:
+                    kept.update(c.classes)
+            for cls in component.classes:
+                if cls not in kept and hasattr(component.module, cls):
+                    delattr(component.module, cls)
+        Schema.set_entry(name, fpath, namespace if namespace != "default" else None, None, sdata)
+        Schema.generation += 1
+
+        from quantnet_mq.delivery import policies
+        policies.add_schema(sdata)
+        return sorted({cls for _, classes in built for cls in classes})
+
+    @staticmethod
+    def register(fname: str, ns: str = None):
+        """ load a new or changed schema file at runtime, returns the names of the rebuilt classes.
+
+        Only the components that changed and the components referencing
+        them, in any file, are rebuilt. The new classes replace the old ones
+        in the namespace modules at once, RPCServer looks its handler classes
+        up again on the next request.
+        """
+        with Schema._lock:
+            return Schema._swap(Schema._stage(fname, ns))
+
+    @staticmethod
+    async def register_async(fname: str, ns: str = None):
+        """ register() with the classes built in a worker thread, the event loop keeps running """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, Schema._lock.acquire)
+        try:
+            staged = await loop.run_in_executor(None, Schema._stage, fname, ns)
+            return Schema._swap(staged)
+        finally:
+            Schema._lock.release()
+
     @staticmethod
     def load_schema(fname: str, ns: str = None, classes: list = []):
         if isinstance(fname, str):
@@ -3,17 +3,60 @@
 """
 Usage:
   validator [options] <schema> <instance> <object>
+  validator batch [options] <path>...
+
+The batch mode validates JSON files, JSONL files (one instance per line),
+directories, globs or "-" for a JSONL stream on stdin against the package
+schemas. The schema object is detected per instance unless --object is given.
+Results are written as JSONL, one line per instance and a final summary line.
 
 Options:
-  -s schema directory
+  -s <dir>              Schema directory
+  -o --object=<object>  Validate every instance against this object, e.g. QNode or experiment.getInfo
+  -j --jobs=<n>         Number of validation processes (default: one per core)
+  --output=<file>       Write the batch results to a file instead of stdout
+  -q --quiet            Only emit the invalid instances and the summary
   -h --help
 """
 
 import os
-from docopt import docopt
+import sys
+import glob
 import json
+import time
+import pathlib
+import concurrent.futures
+from collections import deque
+from urllib.parse import urljoin
+import yaml
+from docopt import docopt
 import jsonschema
 from jsonschema import validate
+from referencing import Registry
+from referencing.jsonschema import DRAFT4
+
+
+SCHEMA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+URI_PREFIX = "qn-schema:"
+
+# (directory, namespace) in the order quantnet_mq.schema.models loads them,
+# a namespace of None means the file stem is the namespace
+SCHEMA_SOURCES = [
+    ("objects", "default"),
+    ("rpc/core", "default"),
+    ("rpc/qn-server", "default"),
+    ("rpc", None),
+    ("messages", None),
+]
+
+NODE_TYPES = ("QNode", "MNode", "BSMNode", "OpticalSwitch", "QRepeater")
+MONITOR_KEYS = {"rid", "ts", "eventType"}
+
+# number of JSONL lines handed to a worker at once
+CHUNK_LINES = 2000
+# chunks submitted ahead per worker, the input is read no further
+WINDOW_PER_JOB = 2
+MAX_ERRORS = 5
 
 
 def get_file_json(f):
@@ -38,8 +81,257 @@ def validate_json(schema, instance, sdir):
     return True, message
 
 
-def main():
-    args = docopt(__doc__, version="0.1")
+class SchemaCatalog:
+    """ All schema objects of the package with one compiled validator per object.
+
+    Every schema document is registered up front under its file URI and its
+    qn-schema: URI, so validation never reads files or resolves references
+    from disk after construction.
+    """
+
+    def __init__(self, sdir=SCHEMA_DIR):
+        self._sdir = sdir
+        self._objects = {}
+        self._namespaces = {}
+        self._commands = {}
+        self._validators = {}
+
+        resources = []
+        for path in sorted(pathlib.Path(sdir).rglob("*.yaml")):
+            contents = yaml.safe_load(path.read_text())
+            # a document level id would rebase the relative references
+            contents.pop("id", None)
+            resource = DRAFT4.create_resource(contents)
+            resources.append((path.absolute().as_uri(), resource))
+            resources.append((f"{URI_PREFIX}{path.relative_to(sdir).as_posix()}", resource))
+        self._registry = Registry().with_resources(resources)
+
+        for subdir, ns in SCHEMA_SOURCES:
+            for path in sorted(pathlib.Path(sdir, subdir).glob("*.yaml")):
+                namespace = ns or path.stem
+                uri = path.absolute().as_uri()
+                schemas = self._registry[uri].contents.get("components", {}).get("schemas", {})
+                for key, schema in schemas.items():
+                    title = schema.get("title", key)
+                    ref = f"{uri}#/components/schemas/{key}"
+                    # the first definition of a title wins, like in the default namespace
+                    self._objects.setdefault(title, ref)
+                    self._objects[f"{namespace}.{title}"] = ref
+                    self._namespaces.setdefault(title, namespace)
+                    self._namespaces[f"{namespace}.{title}"] = namespace
+                    if subdir.startswith("rpc") and subdir != "rpc/core" and not title.endswith("Response"):
+                        self._commands.setdefault(title.lower(), title)
+
+    @property
+    def objects(self):
+        return sorted(self._objects)
+
+    def schema(self, obj):
+        """ return the schema of an object with its references inlined """
+        if obj not in self._objects:
+            raise KeyError(f"unknown schema object {obj}")
+        return self._inline({"$ref": self._objects[obj]})
+
+    def classpath(self, obj, model="quantnet_mq.schema.models"):
+        """ return the path of the generated class of an object, e.g. quantnet_mq.schema.models.experiment.submit """
+        if obj not in self._objects:
+            raise KeyError(f"unknown schema object {obj}")
+        ns = self._namespaces[obj]
+        title = obj.rsplit(".", 1)[-1]
+        return f"{model}.{title}" if ns == "default" else f"{model}.{ns}.{title}"
+
+    def validator(self, obj):
+        """ return the compiled validator of a schema object """
+        v = self._validators.get(obj)
+        if v is None:
+            # inlined references are not looked up again on every validation
+            v = jsonschema.Draft4Validator(self.schema(obj), registry=self._registry)
+            self._validators[obj] = v
+        return v
+
+    def _inline(self, schema, base="", seen=()):
+        """ replace the references by their targets, a recursive reference is kept as an absolute one """
+        if isinstance(schema, list):
+            return [self._inline(s, base, seen) for s in schema]
+        if not isinstance(schema, dict):
+            return schema
+        ref = schema.get("$ref")
+        if isinstance(ref, str):
+            target = base + ref if ref.startswith("#") else urljoin(base, ref)
+            if target in seen:
+                return {"$ref": target}
+            resolved = self._registry.resolver().lookup(target)
+            return self._inline(resolved.contents, target.partition("#")[0], seen + (target,))
+        return {k: self._inline(v, base, seen) for k, v in schema.items()}
+
+    def detect(self, instance):
+        """ guess the schema object of an instance, None if unknown """
+        if not isinstance(instance, dict):
+            return None
+        system = instance.get("systemSettings")
+        if isinstance(system, dict) and system.get("type") in NODE_TYPES:
+            return system["type"]
+        cmd = instance.get("cmd")
+        if isinstance(cmd, str):
+            return self._commands.get(cmd.lower()) or self._commands.get(f"agent{cmd}".lower())
+        if MONITOR_KEYS <= instance.keys():
+            return "MonitorEvent"
+        if "status" in instance:
+            return "rpcResponse"
+        return None
+
+    def check(self, instance, obj=None):
+        """ validate an instance, returns (object, errors) """
+        obj = obj or self.detect(instance)
+        if obj is None:
+            return None, ["could not detect the schema object"]
+        errors = []
+        for err in self.validator(obj).iter_errors(instance):
+            path = "/".join(str(p) for p in err.absolute_path)
+            errors.append(f"{path}: {err.message}" if path else err.message)
+            if len(errors) >= MAX_ERRORS:
+                break
+        return obj, errors
+
+
+# per process state of the batch workers
+_catalog = None
+_object = None
+
+
+def _init_worker(sdir, obj):
+    global _catalog, _object
+    _catalog = SchemaCatalog(sdir)
+    _object = obj
+
+
+def _result(source, line, text):
+    try:
+        instance = json.loads(text)
+    except ValueError as e:
+        return {"source": source, "line": line, "object": None, "valid": False, "errors": [f"invalid JSON: {e}"]}
+    try:
+        obj, errors = _catalog.check(instance, _object)
+    except KeyError as e:
+        obj, errors = _object, [str(e)]
+    return {"source": source, "line": line, "object": obj, "valid": not errors, "errors": errors}
+
+
+def _validate_task(task):
+    """ validate a whole JSON file or a chunk of JSONL lines """
+    source, offset, lines = task
+    if offset is None and lines is None:
+        with open(source, "r") as f:
+            return [_result(source, None, f.read())]
+    if lines is None:
+        with open(source, "rb") as f:
+            f.seek(offset[0])
+            lines = f.read(offset[1] - offset[0]).decode("utf-8").splitlines()
+        first = offset[2]
+    else:
+        first = offset
+    return [_result(source, first + i, text) for i, text in enumerate(lines) if text.strip()]
+
+
+def _jsonl_chunks(source):
+    """ split a JSONL file into (start, end, first line) byte ranges """
+    with open(source, "rb") as f:
+        start = pos = 0
+        first = 1
+        for count, line in enumerate(f, 1):
+            pos += len(line)
+            if count % CHUNK_LINES == 0:
+                yield (start, pos, first)
+                start, first = pos, count + 1
+        if pos > start:
+            yield (start, pos, first)
+
+
+def _expand(paths):
+    """ yield the batch tasks of the given paths """
+    for p in paths:
+        if p == "-":
+            lines, first = [], 1
+            for n, line in enumerate(sys.stdin, 1):
+                lines.append(line)
+                if len(lines) == CHUNK_LINES:
+                    yield ("<stdin>", first, lines)
+                    lines, first = [], n + 1
+            if lines:
+                yield ("<stdin>", first, lines)
+            continue
+        if any(c in p for c in "*?["):
+            files = sorted(glob.glob(p, recursive=True))
+        elif os.path.isdir(p):
+            files = sorted(str(f) for f in pathlib.Path(p).rglob("*") if f.suffix in (".json", ".jsonl"))
+        else:
+            files = [p]
+        for f in files:
+            if f.endswith(".jsonl"):
+                for chunk in _jsonl_chunks(f):
+                    yield (f, chunk, None)
+            elif os.path.isfile(f):
+                yield (f, None, None)
+
+
+def _imap(executor, tasks, window):
+    """ executor.map() of _validate_task reading at most window tasks ahead, results in order """
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(_validate_task, task))
+    while pending:
+        yield pending.popleft().result()
+
+
+def batch(paths, sdir=SCHEMA_DIR, obj=None, jobs=None, out=sys.stdout, quiet=False):
+    """ validate everything in paths, returns the summary dict """
+    start = time.monotonic()
+    summary = {"total": 0, "valid": 0, "invalid": 0, "objects": {}}
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(sdir, obj))
+        results = _imap(executor, _expand(paths), jobs * WINDOW_PER_JOB)
+    else:
+        _init_worker(sdir, obj)
+        executor = None
+        results = map(_validate_task, _expand(paths))
+
+    try:
+        for chunk in results:
+            for res in chunk:
+                summary["total"] += 1
+                summary["valid" if res["valid"] else "invalid"] += 1
+                name = res["object"] or "unknown"
+                summary["objects"][name] = summary["objects"].get(name, 0) + 1
+                if not (quiet and res["valid"]):
+                    out.write(json.dumps(res))
+                    out.write("\n")
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    summary["elapsed"] = round(time.monotonic() - start, 3)
+    out.write(json.dumps({"summary": summary}))
+    out.write("\n")
+    return summary
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv, version="0.1")
+    if args.get("batch"):
+        sdir = args.get("-s") or SCHEMA_DIR
+        jobs = int(args["--jobs"]) if args.get("--jobs") else None
+        out = open(args["--output"], "w") if args.get("--output") else sys.stdout
+        try:
+            summary = batch(args.get("<path>"), sdir, args.get("--object"), jobs, out, args.get("--quiet"))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return 1 if summary["invalid"] else 0
+
     sname = args.get("<schema>")
     iname = args.get("<instance>")
     sdir = args.get("-s")
@@ -58,4 +350,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
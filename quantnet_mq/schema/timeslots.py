@@ -0,0 +1,216 @@
+"""
+Packed timeslot maps of schedules and experiment allocations.
+
+A SlotMap is a boolean NumPy array over the slots of a schedule
+(startTime, slotSize, numSlots) or of a submit request (timeslotBase),
+True for a busy slot. It is sent as a string in Schedule.timeslots or
+allocations[].slotMap, in one of two forms:
+
+    bm:<base64>      bitmap, numSlots bits packed little endian
+    iv:a-b,c,d-e     sorted inclusive slot ranges
+
+encode() picks the shorter one. Both are far smaller than a list of slot
+numbers for long horizons: a day of 1 s slots is at most 14.4 kB as a
+bitmap and a handful of bytes for a few long runs. Plain lists, as JSON
+("[1, 2, 3]") or ranges without prefix, are decoded too.
+"""
+import base64
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+BITMAP = "bm"
+INTERVALS = "iv"
+
+
+class SlotMap:
+    """ busy slots of a time window, as a boolean array """
+
+    __slots__ = ("bits",)
+
+    def __init__(self, bits):
+        self.bits = np.asarray(bits, dtype=bool)
+
+    @classmethod
+    def empty(cls, num_slots):
+        return cls(np.zeros(num_slots, dtype=bool))
+
+    @classmethod
+    def from_slots(cls, slots, num_slots=None):
+        """ map of a list of slot numbers, slots beyond num_slots are an error """
+        slots = np.asarray(slots, dtype=np.int64)
+        if num_slots is None:
+            num_slots = int(slots.max()) + 1 if slots.size else 0
+        if slots.size and (slots.min() < 0 or slots.max() >= num_slots):
+            raise ValueError(f"slots out of range 0-{num_slots - 1}")
+        bits = np.zeros(num_slots, dtype=bool)
+        bits[slots] = True
+        return cls(bits)
+
+    @classmethod
+    def from_intervals(cls, starts, ends, num_slots):
+        """ map of the inclusive ranges starts[i]-ends[i] """
+        delta = np.zeros(num_slots + 1, dtype=np.int32)
+        np.add.at(delta, np.asarray(starts, dtype=np.int64), 1)
+        np.add.at(delta, np.asarray(ends, dtype=np.int64) + 1, -1)
+        return cls(np.cumsum(delta[:-1]) > 0)
+
+    @classmethod
+    def decode(cls, text, num_slots=None):
+        """ map of an encoded string, num_slots is needed for lists and ranges ending before the window """
+        form, sep, data = text.partition(":")
+        if not sep:
+            form, data = INTERVALS, text.strip()
+            if data.startswith("["):
+                data = data.strip("[] ").replace(" ", "")
+        if form == BITMAP:
+            packed = np.frombuffer(base64.b64decode(data), dtype=np.uint8)
+            bits = np.unpackbits(packed, bitorder="little").astype(bool)
+            if num_slots is not None:
+                bits = bits[:num_slots]
+            return cls(bits)
+        if form != INTERVALS:
+            raise ValueError(f"unknown timeslot encoding {form}")
+        if not data:
+            return cls.empty(num_slots or 0)
+        ranges = [r.partition("-") for r in data.split(",")]
+        starts = np.array([int(a) for a, _, _ in ranges], dtype=np.int64)
+        ends = np.array([int(b) if b else int(a) for a, _, b in ranges], dtype=np.int64)
+        if num_slots is None:
+            num_slots = int(ends.max()) + 1
+        if starts.min() < 0 or ends.max() >= num_slots or (ends < starts).any():
+            raise ValueError(f"invalid slot ranges for {num_slots} slots")
+        return cls.from_intervals(starts, ends, num_slots)
+
+    def encode(self, form=None):
+        """ the string form of the map, the shorter of bitmap and ranges by default """
+        if form in (None, INTERVALS):
+            starts, ends = self.intervals()
+            ranges = ",".join(f"{a}-{b}" if b > a else f"{a}" for a, b in zip(starts.tolist(), ends.tolist()))
+            # a bitmap takes 4 characters per 24 slots
+            if form == INTERVALS or len(ranges) <= -(-len(self.bits) // 6):
+                return f"{INTERVALS}:{ranges}"
+        if form not in (None, BITMAP):
+            raise ValueError(f"unknown timeslot encoding {form}")
+        packed = np.packbits(self.bits, bitorder="little")
+        return f"{BITMAP}:{base64.b64encode(packed.tobytes()).decode('ascii')}"
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, SlotMap) and np.array_equal(self.bits, other.bits)
+
+    def __repr__(self):
+        return f"SlotMap({len(self.bits)} slots, {self.count()} busy)"
+
+    def _other(self, other):
+        if len(other.bits) != len(self.bits):
+            raise ValueError(f"slot maps of {len(self.bits)} and {len(other.bits)} slots")
+        return other.bits
+
+    def __or__(self, other):
+        return SlotMap(self.bits | self._other(other))
+
+    def __and__(self, other):
+        return SlotMap(self.bits & self._other(other))
+
+    def __invert__(self):
+        return SlotMap(~self.bits)
+
+    def count(self):
+        return int(np.count_nonzero(self.bits))
+
+    def slots(self):
+        """ the busy slot numbers """
+        return np.flatnonzero(self.bits)
+
+    def intervals(self):
+        """ (starts, ends) arrays of the inclusive busy ranges """
+        edges = np.diff(self.bits.astype(np.int8), prepend=0, append=0)
+        return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+    def overlaps(self, other):
+        return bool(np.any(self.bits & self._other(other)))
+
+    def conflicts(self, other):
+        """ the slots busy in both maps """
+        return np.flatnonzero(self.bits & self._other(other))
+
+    def free_runs(self, min_length=1):
+        """ (starts, lengths) of the free ranges of at least min_length slots """
+        starts, ends = (~self).intervals()
+        lengths = ends - starts + 1
+        keep = lengths >= min_length
+        return starts[keep], lengths[keep]
+
+    def find_free(self, length, after=0):
+        """ first slot of the earliest free range of length slots from slot after, None if there is none """
+        starts, lengths = self.free_runs(length)
+        # a run that begins before after can still fit the range from after
+        fits = np.maximum(starts, after) + length <= starts + lengths
+        candidates = np.maximum(starts[fits], after)
+        return int(candidates[0]) if candidates.size else None
+
+    def window(self, first, num_slots):
+        """ the map of num_slots slots from first, slots outside this map are free """
+        bits = np.zeros(num_slots, dtype=bool)
+        lo, hi = max(first, 0), min(first + num_slots, len(self.bits))
+        if hi > lo:
+            bits[lo - first:hi - first] = self.bits[lo:hi]
+        return SlotMap(bits)
+
+    def as_schedule(self, start_time, slot_size, form=None):
+        """ the Schedule object of the map """
+        return {"timeslots": self.encode(form), "startTime": start_time, "slotSize": slot_size,
+                "numSlots": len(self.bits)}
+
+    @classmethod
+    def from_schedule(cls, schedule, num_slots=None):
+        """ map of a Schedule object, a dict or schema object """
+        if hasattr(schedule, "as_dict"):
+            schedule = schedule.as_dict()
+        return cls.decode(schedule["timeslots"], schedule.get("numSlots", num_slots))
+
+
+def stack(maps):
+    """ (n, slots) boolean matrix of maps of the same length """
+    return np.vstack([m.bits for m in maps]) if maps else np.zeros((0, 0), dtype=bool)
+
+
+def merge(maps):
+    """ union of the maps, e.g. the busy slots of every node of a path """
+    return SlotMap(np.logical_or.reduce(stack(maps), axis=0))
+
+
+def occupancy(maps):
+    """ number of maps busy in every slot """
+    return stack(maps).sum(axis=0)
+
+
+def conflicts(maps):
+    """ sorted (i, j) pairs of the maps that overlap, i < j
+
+    Only the slots busy in more than one map are compared, with one
+    matrix product over them.
+    """
+    matrix = stack(maps)
+    if not matrix.size:
+        return []
+    hot = np.flatnonzero(matrix.sum(axis=0) > 1)
+    if not hot.size:
+        return []
+    sub = matrix[:, hot].astype(np.float32)
+    counts = np.triu(sub @ sub.T, k=1)
+    return [(int(i), int(j)) for i, j in zip(*np.nonzero(counts))]
+
+
+def allocation_map(allocation, num_slots):
+    """ map of a submit allocation, from its slotMap or its timeSlot list """
+    if hasattr(allocation, "as_dict"):
+        allocation = allocation.as_dict()
+    if allocation.get("slotMap") is not None:
+        return SlotMap.decode(allocation["slotMap"], num_slots)
+    return SlotMap.from_slots(allocation.get("timeSlot", []), num_slots)
@@ -0,0 +1,181 @@
+"""
+Outbound spool of the messages published while the broker is unreachable.
+
+Messages are kept in memory up to memory_bytes, later ones spill to a file
+of file_bytes mapped into memory:
+
+    header   MAGIC, read offset (u64), write offset (u64), messages (u64)
+    record   flags (u8), reserved (u8), topic length (u16), properties
+             length (u32), payload length (u32), topic, properties, payload
+
+Integers are little endian, the flags are the QoS and the retain bit (0x4)
+and the properties are MQTT5 encoded. Messages leave the spool in the
+order they were put, the file part once the memory part is empty. With a
+path the file is kept, so the spilled messages of a process that did not
+get to flush them are published by the next one; without a path it is an
+anonymous temporary file. A message that does not fit is dropped and
+counted, the spool takes space again as it drains.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from collections import deque
+from .capture import encode_properties, decode_properties
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QNSPOOL1"
+HEADER = struct.Struct("<8sQQQ")
+RECORD = struct.Struct("<BBHII")
+RETAIN = 0x4
+
+# memory accounted for a message in addition to its topic and payload
+OVERHEAD = 128
+
+
+class Spool:
+    """ Bounded FIFO of outbound messages, in memory and then on disk
+
+    Parameters
+    ----------
+    memory_bytes: int
+        Size of the messages kept in memory before spilling to the file
+    file_bytes: int
+        Size of the spool file, 0 for a spool in memory only
+    path: str
+        Spool file, kept and resumed from; a temporary file by default
+    """
+
+    def __init__(self, memory_bytes=8 * 1024 * 1024, file_bytes=64 * 1024 * 1024, path=None):
+        self._memory_bytes = memory_bytes
+        self._file_bytes = file_bytes
+        self._path = path
+        self._memory = deque()
+        self._memory_used = 0
+        self._file = None
+        self._map = None
+        self._read = self._write = HEADER.size
+        self._spilled = 0
+        self.spooled = 0
+        self.dropped = 0
+        if path is not None and file_bytes and os.path.exists(path):
+            self._open()
+
+    def __len__(self):
+        return len(self._memory) + self._spilled
+
+    def __bool__(self):
+        return bool(self._memory) or self._spilled > 0
+
+    def _open(self):
+        size = HEADER.size + self._file_bytes
+        if self._path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._file = os.fdopen(fd, "r+b")
+        resumed = os.fstat(self._file.fileno()).st_size >= HEADER.size
+        if resumed:
+            size = max(size, os.fstat(self._file.fileno()).st_size)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        magic, read, write, count = HEADER.unpack_from(self._map)
+        if resumed and magic == MAGIC and HEADER.size <= read <= write <= size:
+            self._read, self._write, self._spilled = read, write, count
+            if count:
+                logger.info(f"Resumed {count} spooled messages from {self._path}")
+        else:
+            if resumed:
+                logger.warning(f"{self._path} is not a spool file, it was reset")
+            self._sync()
+
+    def _sync(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self._read, self._write, self._spilled)
+
+    def put(self, topic, payload, qos=0, retain=False, properties=None):
+        """ append a message, returns False if it was dropped """
+        size = len(topic) + len(payload) + OVERHEAD
+        if not self._spilled and self._memory_used + size <= self._memory_bytes:
+            self._memory.append((topic, payload, qos, retain, properties))
+            self._memory_used += size
+            self.spooled += 1
+            return True
+        if self._file_bytes and self._spill(topic, payload, qos, retain, properties):
+            self.spooled += 1
+            return True
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"Spool full, {self.dropped} messages dropped")
+        return False
+
+    def _spill(self, topic, payload, qos, retain, properties):
+        if self._map is None:
+            self._open()
+        topic = topic.encode("utf-8")
+        props = encode_properties(properties) if properties else b""
+        end = self._write + RECORD.size + len(topic) + len(props) + len(payload)
+        if end > len(self._map):
+            return False
+        m = self._map
+        RECORD.pack_into(m, self._write, qos | (RETAIN if retain else 0), 0, len(topic), len(props), len(payload))
+        offset = self._write + RECORD.size
+        for part in (topic, props, payload):
+            m[offset:offset + len(part)] = part
+            offset += len(part)
+        self._write = end
+        self._spilled += 1
+        self._sync()
+        return True
+
+    def take(self, n):
+        """ remove and return up to n messages, oldest first, as (topic, payload, qos, retain, properties) """
+        out = []
+        memory = self._memory
+        while memory and len(out) < n:
+            msg = memory.popleft()
+            self._memory_used -= len(msg[0]) + len(msg[1]) + OVERHEAD
+            out.append(msg)
+        while self._spilled and len(out) < n:
+            out.append(self._unspill())
+        return out
+
+    def _unspill(self):
+        m = self._map
+        flags, _, topic_len, props_len, payload_len = RECORD.unpack_from(m, self._read)
+        offset = self._read + RECORD.size
+        topic = m[offset:offset + topic_len].decode("utf-8")
+        offset += topic_len
+        props = decode_properties(m[offset:offset + props_len]) if props_len else None
+        offset += props_len
+        payload = m[offset:offset + payload_len]
+        self._read = offset + payload_len
+        self._spilled -= 1
+        if not self._spilled:
+            # drained, the file is reused from its start
+            self._read = self._write = HEADER.size
+        self._sync()
+        return topic, payload, flags & 0x3, bool(flags & RETAIN), props
+
+    def stats(self):
+        return {
+            "queued": len(self),
+            "memory_bytes": self._memory_used,
+            "file_bytes": self._write - self._read if self._spilled else 0,
+            "spooled": self.spooled,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """ close the file, the spilled messages stay in a spool file with a path """
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._memory:
+            logger.warning(f"{len(self._memory)} spooled messages were not published")
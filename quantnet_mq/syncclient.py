@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import threading
+import uvloop
+from quantnet_mq.rpcclient import RPCClient
+from quantnet_mq.util import Constants
+
+logger = logging.getLogger(__name__)
+
+
+class SyncRPCClient:
+    """ Blocking, thread-safe facade of RPCClient.
+
+    The RPCClient and its MQTT connection run on an event loop in a
+    dedicated thread. Any number of threads can call() or call_async()
+    concurrently over the one connection.
+
+    Parameters
+    ----------
+    cid: str
+        Client ID
+    topic: str
+        Topic of RPC
+    start_timeout: float
+        Seconds to wait for the broker connection in start()
+
+    Example
+    -------
+    with SyncRPCClient("example_client", host="127.0.0.1") as client:
+        client.set_handler("myRequest", None, "quantnet_mq.schema.models.myns.myRequest")
+        res = client.call("myRequest", {"arg1": "value1"}, timeout=5.0)
+    """
+
+    def __init__(self, cid=None, topic=Constants.DEFAULT_RPC_TOPIC, start_timeout=10.0, **kwargs):
+        self._client = RPCClient(cid, topic, **kwargs)
+        self._start_timeout = start_timeout
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def cid(self):
+        return self._client.cid
+
+    @property
+    def client(self):
+        """ the wrapped RPCClient, only to be used from the loop thread """
+        return self._client
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def set_handler(self, cmd: str, cb, classpath):
+        self._client.set_handler(cmd, cb, classpath)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def start(self):
+        """ start the loop thread and connect to the broker """
+        with self._lock:
+            if self._thread:
+                return
+            self._loop = uvloop.new_event_loop()
+            self._thread = threading.Thread(target=self._run, name=f"rpcclient-{self.cid}", daemon=True)
+            self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._client.start(), self._loop).result(self._start_timeout)
+        except BaseException:
+            self._shutdown()
+            raise
+
+    def stop(self, timeout=5.0):
+        """ disconnect and stop the loop thread """
+        with self._lock:
+            if not self._thread:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._client.stop(), self._loop).result(timeout)
+            except Exception as e:
+                logger.warning(f"Failed to stop RPC client: {e}")
+            self._shutdown()
+
+    def _shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+        self._loop = None
+
+    def call_async(self, target, msg, timeout=5.0, **kwargs):
+        """ send an RPC from any thread, returns a concurrent.futures.Future of the response """
+        loop = self._loop
+        if loop is None:
+            raise RuntimeError("client is not started")
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("call_async() can not be used from the client loop, await client.call() instead")
+        kwargs["sync"] = True
+        return asyncio.run_coroutine_threadsafe(self._client.call(target, msg, timeout=timeout, **kwargs), loop)
+
+    def call(self, target, msg, timeout=5.0, **kwargs):
+        """ send an RPC and block until the response, raises TimeoutError after timeout seconds """
+        return self.call_async(target, msg, timeout=timeout, **kwargs).result()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
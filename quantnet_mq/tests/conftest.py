@@ -0,0 +1,8 @@
+import pytest
+from quantnet_mq.tests.fakes import FakeMQTTClient
+
+
+@pytest.fixture
+def mqttclient():
+    """ a FakeMQTTClient recording what is published """
+    return FakeMQTTClient()
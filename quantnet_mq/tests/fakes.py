@@ -0,0 +1,43 @@
+"""
+Fakes of the MQTT client for the tests that need no broker.
+"""
+import json
+from collections import namedtuple
+
+Published = namedtuple("Published", "topic payload qos retain correlation_data properties")
+
+
+class FakeMQTTClient:
+    """ records what is published instead of sending it
+
+    Payloads are recorded as the bytes gmqtt would send, dicts as JSON.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, topic, payload, qos=0, retain=False, correlation_data=None, **properties):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.sent.append(Published(topic, payload, qos, retain, correlation_data, properties))
+
+    def json(self, i=-1):
+        """ the decoded payload of the i-th published message """
+        return json.loads(self.sent[i].payload)
+
+    def messages(self):
+        return [json.loads(p.payload) for p in self.sent]
+
+    def topic_wildcard(self, topic):
+        return topic.split('/')[0] + '/+'
+
+    async def disconnect(self, reason_code=0, **properties):
+        pass
+
+
+def request(cmd, payload, n, agent=None):
+    """ the on_message arguments of an RPC request, answered on reply/n """
+    body = json.dumps({"cmd": cmd, "agentId": agent or f"client{n}", "payload": payload}).encode()
+    return body, 1, {"response_topic": [f"reply/{n}"], "correlation_data": [str(n).encode()]}
@@ -0,0 +1,49 @@
+import json
+import asyncio
+import numpy as np
+from quantnet_mq import attachments
+from quantnet_mq.msgserver import MsgServer
+
+
+class TestAttachments:
+
+    def test_roundtrip(self):
+        counts = np.arange(10, dtype=np.int64)
+        clicks = np.random.default_rng(1).random((3, 5)).T
+        msg = {"rid": "exp1", "eventType": "experimentResult",
+               "value": {"counts": counts, "clicks": [clicks, np.float32(1.5)], "n": np.int64(3)}}
+        payload = attachments.encode(msg)
+        assert attachments.is_attachment(payload)
+        assert not attachments.is_attachment(json.dumps({"a": 1}).encode())
+
+        res = attachments.decode(payload)
+        assert res["rid"] == "exp1"
+        assert res["value"]["n"] == 3
+        assert np.array_equal(res["value"]["counts"], counts)
+        assert np.array_equal(res["value"]["clicks"][0], clicks)
+        assert res["value"]["clicks"][1] == 1.5
+        # views of the payload, not copies
+        assert not res["value"]["counts"].flags.owndata
+        assert not res["value"]["counts"].flags.writeable
+
+    def test_has_arrays(self):
+        assert attachments.has_arrays({"a": [{"b": np.zeros(2)}]})
+        assert not attachments.has_arrays({"a": [1, 2, 3], "b": "x"})
+        # a container after scalars
+        msg = {"a": [1, {"arr": np.arange(3)}]}
+        assert attachments.has_arrays(msg) and attachments.has_arrays([1, np.zeros(1)])
+        assert attachments.decode(attachments.encode(msg))["a"][1]["arr"].tolist() == [0, 1, 2]
+
+    def test_msgserver(self):
+        received = []
+
+        async def cb(data):
+            received.append(data)
+
+        server = MsgServer()
+        server.subscribe("monitor", cb)
+        payload = attachments.encode({"value": np.ones(4)})
+        asyncio.run(server.on_message(None, "monitor", payload, 1, {}))
+        asyncio.run(server.on_message(None, "monitor", b'{"value": 1}', 1, {}))
+        assert np.array_equal(received[0]["value"], np.ones(4))
+        assert received[1] == '{"value": 1}'
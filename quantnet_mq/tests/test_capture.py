@@ -0,0 +1,82 @@
+import asyncio
+from quantnet_mq.capture import Recorder, CaptureLog, encode_properties, decode_properties
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False, **kwargs):
+        self.published.append((topic, payload, qos, retain, kwargs))
+
+
+def record(path, n, **kw):
+    with Recorder(path, **kw) as recorder:
+        for i in range(n):
+            recorder.record(f"monitor/QNode_{i % 3}", b'{"value": %d}' % i, i % 2, {"dup": 0, "retain": 0})
+        recorder.record("rpc/qn-server", b"{}", 1,
+                        {"dup": 0, "retain": 1, "response_topic": ["rpc-res/c"], "correlation_data": [b"abc"],
+                         "user_property": [("k", "v")], "topic_alias": [3]})
+        return recorder
+
+
+class TestCapture:
+
+    def test_properties(self):
+        props = {"response_topic": ["rpc-res/c"], "correlation_data": [b"abc"],
+                 "user_property": [("a", "1"), ("b", "2")], "dup": 0, "retain": 0, "topic_alias": [1]}
+        assert decode_properties(encode_properties(props)) == {
+            "response_topic": "rpc-res/c", "correlation_data": b"abc", "user_property": [("a", "1"), ("b", "2")]}
+
+    def test_record_read(self, tmp_path):
+        path = tmp_path / "traffic.qncap"
+        record(path, 10, index_interval=4, flush_size=64)
+        with CaptureLog(path) as log:
+            msgs = list(log)
+            assert len(msgs) == 11
+            assert len(log.indexed_offsets()) == 11
+            assert msgs[4].topic == "monitor/QNode_1" and bytes(msgs[4].payload) == b'{"value": 4}'
+            assert msgs[4].qos == 0 and not msgs[4].retain
+            last = msgs[-1]
+            assert last.retain and last.qos == 1
+            assert last.properties == {"response_topic": "rpc-res/c", "correlation_data": b"abc",
+                                       "user_property": [("k", "v")]}
+            assert [m.ts for m in msgs] == sorted(m.ts for m in msgs)
+            del msgs, last
+
+    def test_appended_logs(self, tmp_path):
+        path = tmp_path / "traffic.qncap"
+        record(path, 3)
+        record(path, 5)
+        with CaptureLog(path) as log:
+            assert len(log) == 10
+            times = log.index()[0]
+            assert times == sorted(times)
+
+    def test_unclosed_log(self, tmp_path):
+        path = tmp_path / "traffic.qncap"
+        recorder = Recorder(path, index_interval=1000)
+        for i in range(5):
+            recorder.record("t", b"x", 0, None)
+        recorder.flush()
+        with CaptureLog(path) as log:
+            assert log.indexed_offsets() is None
+            assert len(log) == 5
+
+    def test_replay(self, tmp_path):
+        path = tmp_path / "traffic.qncap"
+        record(path, 6)
+        client = FakeClient()
+        with CaptureLog(path) as log:
+            n = asyncio.run(log.replay(client, speed=0, remap={"monitor/": "replay/", "monitor/QNode_2": "q2"}))
+        assert n == 7
+        topics = [p[0] for p in client.published]
+        assert topics[:3] == ["replay/QNode_0", "replay/QNode_1", "q2"]
+        assert client.published[-1] == ("rpc/qn-server", b"{}", 1, True, {
+            "response_topic": "rpc-res/c", "correlation_data": b"abc", "user_property": [("k", "v")]})
+
+        client = FakeClient()
+        with CaptureLog(path) as log:
+            asyncio.run(log.replay(client, speed=0, topics={"monitor/QNode_0"}))
+        assert len(client.published) == 2
@@ -0,0 +1,53 @@
+import json
+import math
+import numpy as np
+import pytest
+from quantnet_mq import codec
+from quantnet_mq.schema.models import rpcResponse, Status
+from quantnet_mq.tools.bench_json import messages
+
+
+@pytest.fixture(params=codec.available())
+def backend(request):
+    codec.use(request.param)
+    yield request.param
+    codec.use()
+
+
+class TestCodec:
+
+    def test_wire_format(self, backend):
+        msgs = dict(messages(), text={"rid": "a", "u": "\u00e9", "s": "a/b \\ \"q\"", "n": None, "f": 1.5})
+        for msg in msgs.values():
+            data = codec.dumps(msg)
+            assert isinstance(data, bytes)
+            # compact UTF-8, the same bytes with every backend
+            assert data == json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            assert codec.loads(data) == codec.loads(data.decode("utf-8")) == codec.loads(memoryview(data)) == msg
+        assert codec.dumps(msgs["text"]) == '{"rid":"a","u":"é","s":"a/b \\\\ \\"q\\"","n":null,"f":1.5}'.encode()
+
+    def test_floats(self, backend):
+        # the exponents are spelled differently, the values are the same
+        msg = {"small": 0.00001, "big": 1e20, "tiny": 2.5e-300, "f": -0.0}
+        assert codec.loads(codec.dumps(msg)) == msg
+        assert codec.dumps(msg) == {"orjson": b'{"small":0.00001,"big":1e20,"tiny":2.5e-300,"f":-0.0}',
+                                    "json": b'{"small":1e-05,"big":1e+20,"tiny":2.5e-300,"f":-0.0}',
+                                    "ujson": b'{"small":1e-05,"big":1e+20,"tiny":2.5e-300,"f":-0.0}'}[backend]
+
+    def test_fallbacks(self, backend):
+        assert codec.dumps({"n": 2 ** 70, "s": "é", 1: "k"}) == '{"n":1180591620717411303424,"s":"é","1":"k"}'.encode()
+        assert codec.dumps({"v": float("nan"), "w": float("inf")}) == b'{"v":NaN,"w":Infinity}'
+        assert math.isnan(codec.loads(b'{"v": NaN}')["v"])
+        assert codec.dumps({"a": np.float64(0.5), "b": np.int32(3)}) == b'{"a":0.5,"b":3}'
+        with pytest.raises(TypeError):
+            codec.dumps({"a": object()})
+        with pytest.raises(ValueError):
+            codec.loads(b'{"v": ')
+
+    def test_schema_objects(self, backend):
+        res = rpcResponse(status=Status(code=0, value="OK"))
+        assert codec.serialize(res) == b'{"status":{"code":0,"value":"OK"}}'
+        assert codec.loads(codec.serialize(res)) == json.loads(res.serialize())
+        assert codec.from_dict(rpcResponse, codec.loads(codec.serialize(res))) == res
+        # the generated classes decode with the backend, the json module rejects a memoryview
+        assert rpcResponse.from_json(memoryview(codec.serialize(res))) == res
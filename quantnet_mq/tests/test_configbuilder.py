@@ -0,0 +1,34 @@
+import json
+import pytest
+from quantnet_mq.tools import configbuidler
+from quantnet_mq.tools.configbuidler import NODE_CLASSES
+
+
+def load_configs(out_dir, output):
+    if output == "jsonl":
+        with open(out_dir / "nodes.jsonl") as f:
+            return [json.loads(line) for line in f]
+    return [json.loads(path.read_text()) for path in sorted(out_dir.glob("*.json"))]
+
+
+class TestConfigBuilderCLI:
+
+    @pytest.mark.parametrize("output", ["files", "jsonl"])
+    def test_headless_parallel_sparse(self, tmp_path, monkeypatch, output):
+        # the serializer pool is used from 20 nodes on
+        monkeypatch.setattr(configbuidler, "PARALLEL_MIN_NODES", 20)
+        out_dir = tmp_path / "nodes"
+        g = configbuidler.main(["--switches", "4", "--nodes", "30", "--model", "barabasi_albert", "--degree", "2",
+                                "--workers", "2", "--format", output, "--seed", "7", "--headless",
+                                "--out-dir", str(out_dir)])
+        configs = load_configs(out_dir, output)
+        assert len(configs) == len(g) == 34
+        assert not (out_dir / "topo.png").exists()
+        names = set()
+        for config in configs:
+            system = config["systemSettings"]
+            NODE_CLASSES[system["type"]](**config).validate()
+            names.add(system["ID"])
+        # every channel points at a generated node
+        for config in configs:
+            assert {ch["neighbor"]["systemRef"] for ch in config["channels"]} <= names
@@ -0,0 +1,37 @@
+import asyncio
+from quantnet_mq.delivery import DeliveryPolicies, DeliveryPolicy
+from quantnet_mq.msgclient import MsgClient
+
+
+class TestDeliveryPolicies:
+
+    def test_schema_extensions(self):
+        policies = DeliveryPolicies()
+        assert policies.get("MonitorEvent", "agentHeartbeat") == DeliveryPolicy(qos=0, expiry=10)
+        assert policies.get("MonitorEvent", "agentState") == DeliveryPolicy(qos=1)
+        assert policies.get("getInfo") == DeliveryPolicy()
+
+        policies.add_schema({
+            "channels": {"rpc/ctl": {"subscribe": {"x-qos": 2, "message": {"$ref": "#/components/messages/Ctl"}}}},
+            "components": {
+                "messages": {"Ctl": {"payload": {"$ref": "#/components/schemas/Ctl"}, "x-message-expiry": 30}},
+                "schemas": {"Ctl": {"title": "shutdown"}},
+            }})
+        assert policies.get("shutdown") == DeliveryPolicy(qos=2, expiry=30)
+
+    def test_overrides(self):
+        policies = DeliveryPolicies()
+        policies.set_policy("MonitorEvent.agentState", retain=True)
+        assert policies.for_message([{"eventType": "agentState"}]) == DeliveryPolicy(qos=1, retain=True)
+        policies.clear_policy("MonitorEvent.agentState")
+        assert policies.for_message({"eventType": "agentState"}) == DeliveryPolicy()
+
+    def test_msgclient_publish(self, mqttclient):
+        client = MsgClient("delivery")
+        client._mqttclient = mqttclient
+        asyncio.run(client.publish("monitor/hb", {"rid": "n1", "ts": 0, "eventType": "agentHeartbeat", "value": 1}))
+        asyncio.run(client.publish("monitor/state", {"eventType": "agentState"}, qos=2))
+        assert [(p.topic, p.qos, p.retain, p.properties) for p in mqttclient.sent] == [
+            ("monitor/hb", 0, False, {"message_expiry_interval": 10}),
+            ("monitor/state", 2, False, {}),
+        ]
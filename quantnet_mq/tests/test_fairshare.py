@@ -0,0 +1,102 @@
+import asyncio
+from quantnet_mq import Code
+from quantnet_mq.fairshare import FairShare
+from quantnet_mq.gmqtt.mqttclient import PubRecReasonCode
+from quantnet_mq.rpcserver import RPCServer
+from quantnet_mq.tests.fakes import request
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFairShare:
+
+    def test_rate_limit(self):
+        async def run():
+            clock = Clock()
+            fs = FairShare(rate=10, burst=2, costs={"register": 2}, clock=clock)
+            assert [await fs.acquire("noisy") for _ in range(3)] == [True, True, False]
+            assert await fs.acquire("quiet", fs.cost("register"))
+            clock.now = 0.1
+            assert await fs.acquire("noisy")
+            assert not await fs.acquire("noisy")
+            usage = fs.usage("noisy")
+            assert (usage["requests"], usage["rejected"], usage["cost"]) == (5, 2, 3.0)
+            assert fs.usage()["quiet"]["cost"] == 2.0
+        asyncio.run(run())
+
+    def test_delay(self):
+        async def run():
+            fs = FairShare(rate=200, burst=1, mode="delay", max_delay=0.05)
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            assert await fs.acquire("a") and await fs.acquire("a")
+            assert loop.time() - start >= 0.004
+            # the wait of 20 more requests is beyond max_delay
+            results = await asyncio.gather(*(fs.acquire("a") for _ in range(20)))
+            assert results.count(False) > 0
+            assert fs.usage("a")["delayed"] == 1 + results.count(True)
+        asyncio.run(run())
+
+    def test_fair_queuing(self):
+        async def run():
+            fs = FairShare(max_concurrency=1, weights={"gold": 2})
+            order = []
+
+            async def request(agent, i):
+                await fs.acquire(agent)
+                order.append((agent, i))
+                await asyncio.sleep(0)
+                fs.release()
+
+            tasks = [asyncio.ensure_future(request("noisy", i)) for i in range(8)]
+            await asyncio.sleep(0)
+            tasks += [asyncio.ensure_future(request("quiet", i)) for i in range(2)]
+            tasks += [asyncio.ensure_future(request("gold", i)) for i in range(4)]
+            await asyncio.gather(*tasks)
+            agents = [a for a, _ in order]
+            # the quiet and gold agents do not wait behind the whole noisy backlog
+            assert agents.index("quiet") <= 4 and agents.index("gold") <= 3
+            # gold has twice the share of noisy
+            assert agents[:10].count("gold") == 4 and agents[:10].count("noisy") <= 5
+            assert fs.usage("noisy")["queued"] == 7
+        asyncio.run(run())
+
+    def test_max_queue(self):
+        async def run():
+            fs = FairShare(max_concurrency=1, max_queue=2)
+            assert await fs.acquire("a")
+            waiters = [asyncio.ensure_future(fs.acquire("a")) for _ in range(3)]
+            await asyncio.sleep(0)
+            assert waiters[2].result() is False
+            fs.release()
+            assert await waiters[0]
+        asyncio.run(run())
+
+
+class TestRPCServerFairShare:
+
+    def test_rate_limited_response(self, mqttclient):
+        async def run():
+            server = RPCServer("fs", fair_share=FairShare(rate=1, burst=1))
+            server._mqttclient = mqttclient
+
+            async def get_info(req):
+                return {"status": {"code": 0}}
+
+            server.set_handler("getInfo", get_info, "quantnet_mq.schema.models.experiment.getInfo")
+            assert await server.on_message(None, "rpc", *request("getInfo", {}, 0)) == PubRecReasonCode.SUCCESS
+            rc = await server.on_message(None, "rpc", *request("getInfo", {}, 0))
+            assert rc == PubRecReasonCode.QUOTA_EXCEEDED
+            # another agent has its own bucket
+            await server.on_message(None, "rpc", *request("getInfo", {}, 1))
+            codes = [res["status"]["code"] for res in mqttclient.messages()]
+            assert codes == [Code.OK, Code.FAILED, Code.OK]
+            assert server.agent_usage("client0")["rejected"] == 1
+        asyncio.run(run())
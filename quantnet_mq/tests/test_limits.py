@@ -0,0 +1,75 @@
+import asyncio
+import numpy as np
+import pytest
+from quantnet_mq import attachments, Code, limits as limits_module
+from quantnet_mq.limits import PayloadLimits, exceeds_depth, topic_matches
+from quantnet_mq.rpcserver import RPCServer
+from quantnet_mq.tests.fakes import request
+
+
+class TestPayloadLimits:
+
+    @pytest.mark.parametrize("numpy", [True, False])
+    def test_json_depth(self, numpy, monkeypatch):
+        if not numpy:
+            monkeypatch.setattr(limits_module, "np", None)
+        assert exceeds_depth(b'{"a": [1, {"b": [2]}]}', 3)
+        assert not exceeds_depth(b'{"a": [1, {"b": [2]}]}', 4)
+        assert not exceeds_depth(b'{"a": "[[[[{{{{", "b": "\\"[[["}', 1)
+        assert exceeds_depth(b"[" * 10000, 64)
+
+    def test_topic_limits(self):
+        limits = PayloadLimits(max_bytes=100)
+        limits.set_topic_limit("monitor/#", max_bytes=50)
+        limits.set_topic_limit("monitor/+/state", max_bytes=20)
+        assert topic_matches("monitor/+/state", "monitor/QNode_1/state")
+        assert limits.limit("monitor/QNode_1/state").max_bytes == 20
+        assert limits.limit("monitor/QNode_1/heartbeat").max_bytes == 50
+        assert limits.limit("rpc/qn-server").max_bytes == 100
+
+    def test_check(self):
+        limits = PayloadLimits(max_bytes=100, max_depth=3)
+        limits.set_command_limit("submit", max_bytes=30)
+        assert limits.check(b'{"cmd": "getInfo", "payload": {"a": 1}}', "rpc") is None
+        assert limits.check(b'{"cmd": "submit", "payload": {"a": 1}}', "rpc") == "size"
+        # a command limit never loosens the topic limit
+        limits.set_command_limit("big", max_bytes=1000)
+        assert limits.check(b'{"cmd": "big", "payload": "' + b"x" * 200 + b'"}', "rpc") == "size"
+        assert limits.check(b'{"payload": [[[[1]]]]}', "rpc") == "depth"
+        assert limits.stats() == {"rejected_size": 2, "rejected_depth": 1}
+
+    def test_attachments_header_depth(self):
+        payload = attachments.encode({"a": [[{"b": 1}]], "data": np.full(64, ord("["), dtype=np.uint8)})
+        assert PayloadLimits(max_bytes=None, max_depth=4).check(payload, "t") is None
+        assert PayloadLimits(max_bytes=None, max_depth=3).check(payload, "t") == "depth"
+
+
+class TestRPCServerLimits:
+
+    def test_rejected_before_decode(self, mqttclient):
+        async def run():
+            server = RPCServer("limits", max_payload_bytes=200, max_payload_depth=8)
+            server._mqttclient = mqttclient
+            server.limits.set_command_limit("submit", max_bytes=60)
+            calls = []
+
+            async def get_info(req):
+                calls.append(req)
+                return {"status": {"code": 0}}
+
+            server.set_handler("getInfo", get_info, "quantnet_mq.schema.models.experiment.getInfo")
+            await server.on_message(None, "rpc", *request("getInfo", {"x": "y" * 300}, 0))
+            await server.on_message(None, "rpc", *request("getInfo", {"x": [[[[[[[[1]]]]]]]]}, 1))
+            await server.on_message(None, "rpc", *request("submit", {"x": "y" * 50}, 2))
+            # the command limit holds for the decoded command, wherever it is in the payload
+            body = b'{"agentId": "c", "payload": {"x": "' + b"y" * 50 + b'"}, "cmd": "submit"}'
+            await server.on_message(None, "rpc", body, 1, {"response_topic": ["reply/3"], "correlation_data": [b"3"]})
+            await server.on_message(None, "rpc", *request("getInfo", {}, 4))
+            assert len(calls) == 1
+            for res in mqttclient.messages()[:4]:
+                assert res["status"]["code"] == Code.INVALID_ARGUMENT
+            assert mqttclient.json(0)["status"]["reason"] == "Payload too large"
+            assert mqttclient.json(1)["status"]["reason"] == "Payload nested too deep"
+            assert server.stats()["rejected_size"] == 3
+            assert server.stats()["rejected_depth"] == 1
+        asyncio.run(run())
@@ -0,0 +1,69 @@
+import json
+import asyncio
+import random
+import numpy as np
+from quantnet_mq import attachments
+from quantnet_mq.liveness import TimingWheel, LivenessTracker
+
+
+class TestTimingWheel:
+
+    def test_expiry(self):
+        wheel = TimingWheel(tick=1, slots=4, levels=3, clock=lambda: 0)
+        rng = random.Random(1)
+        deadlines = {f"k{i}": rng.randint(1, 200) for i in range(200)}
+        for k, d in deadlines.items():
+            wheel.schedule(k, d)
+        wheel.cancel("k0")
+        fired = {}
+        for now in range(1, 201):
+            for k in wheel.advance(now):
+                fired[k] = now
+        del deadlines["k0"]
+        assert fired == deadlines
+        assert len(wheel) == 0
+
+    def test_reschedule(self):
+        wheel = TimingWheel(tick=0.5, clock=lambda: 0)
+        wheel.schedule("a", 2)
+        assert wheel.advance(1.5) == []
+        wheel.schedule("a", 5)
+        assert wheel.advance(4.5) == []
+        assert wheel.advance(5) == ["a"]
+
+
+class TestLivenessTracker:
+
+    def test_transitions(self):
+        tracker = LivenessTracker(suspect_after=3, dead_after=10, tick=1, clock=lambda: 0)
+        tracker.heartbeat("a", now=0)
+        tracker.heartbeat("b", now=0)
+        assert [e["value"] for e in tracker.poll(now=0)] == ["alive", "alive"]
+
+        tracker.heartbeat("a", now=2)
+        events = tracker.poll(now=3)
+        assert [(e["rid"], e["value"]) for e in events] == [("b", "suspect")]
+        assert tracker.state("a") == "alive"
+
+        events = tracker.poll(now=10)
+        assert [(e["rid"], e["value"]) for e in events] == [("a", "suspect"), ("b", "dead")]
+        assert events[0]["eventType"] == "agentState"
+
+        tracker.heartbeat("b", now=11)
+        assert [(e["rid"], e["value"]) for e in tracker.poll(now=11)] == [("b", "alive")]
+        assert tracker.agents("alive") == ["b"]
+
+    def test_on_message(self):
+        tracker = LivenessTracker(clock=lambda: 0)
+        events = [{"rid": "a", "ts": 1.0, "eventType": "agentHeartbeat", "value": 1},
+                  {"rid": "b", "ts": 1.0, "eventType": "agentState", "value": "alive"}]
+        asyncio.run(tracker.on_message(json.dumps(events)))
+        assert tracker.agents() == ["a"]
+
+    def test_on_message_decoded(self):
+        # a message sent with attachments reaches the callback already decoded
+        tracker = LivenessTracker(clock=lambda: 0)
+        event = {"rid": "a", "ts": 1.0, "eventType": "agentHeartbeat", "value": np.ones(2)}
+        asyncio.run(tracker.on_message(attachments.decode(attachments.encode(event))))
+        asyncio.run(tracker.on_message("{not json"))
+        assert tracker.agents() == ["a"]
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import random
+from quantnet_mq.tools.loadgen import InstanceGenerator, LoadDriver, parse_mix, parse_range
+
+
+class FakeRPCClient:
+
+    def __init__(self, delay=0):
+        self.handlers = {}
+        self.calls = []
+        self.delay = delay
+
+    def set_handler(self, cmd, cb, classpath):
+        self.handlers[cmd] = classpath
+
+    async def call(self, target, msg, timeout=5.0, topic=None, sync=True, on_error=None):
+        self.calls.append((target, msg))
+        fut = asyncio.get_running_loop().create_future()
+        if target == "getInfo":
+            asyncio.get_running_loop().call_later(self.delay, fut.set_result, json.dumps({"status": {"code": 0}}))
+        else:
+            fut.set_exception(TimeoutError())
+        return fut
+
+
+class FakeMsgClient:
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+
+class TestInstanceGenerator:
+
+    def test_valid_instances(self):
+        gen = InstanceGenerator(rng=random.Random(1))
+        for obj in ("experiment.submit", "MonitorEvent", "agentRegister", "getInfo"):
+            for _ in range(5):
+                instance = gen.generate(obj)
+                assert gen.catalog.check(instance, obj)[0] == obj
+        assert gen.generate("getInfo")["cmd"] == "getInfo"
+
+    def test_node_configs(self):
+        gen = InstanceGenerator(rng=random.Random(2), agents=10)
+        for _ in range(10):
+            system = gen.generate("agentRegister")["payload"]["systemSettings"]
+            assert system["ID"].startswith(system["type"] + "_")
+
+    def test_items_for(self):
+        gen = InstanceGenerator(rng=random.Random(3), items_for={"allocations": parse_range("64")})
+        assert len(gen.generate("experiment.submit")["payload"]["allocations"]) == 64
+
+
+class TestLoadDriver:
+
+    def test_run(self):
+        rpc, msg = FakeRPCClient(), FakeMsgClient()
+        gen = InstanceGenerator(rng=random.Random(4))
+        driver = LoadDriver(gen, parse_mix(["getInfo=2", "experiment.submit", "MonitorEvent=1"]), rpc, msg,
+                            timeout=0.01)
+        assert rpc.handlers["submit"] == "quantnet_mq.schema.models.experiment.submit"
+        report = asyncio.run(driver.run(rate=500, duration=0.1))
+        assert sum(report.sent.values()) == len(rpc.calls) + len(msg.published)
+        assert report.sent["MonitorEvent"] == len(msg.published)
+        assert report.codes["OK"] == report.sent["getInfo"]
+        assert report.codes["TIMEOUT"] == report.sent["experiment.submit"]
+        assert report.as_dict()["latency"]["p50"] is not None
+        assert "achieved rate" in str(report)
+
+    def test_slow_responses(self):
+        # answers after the last send
+        rpc = FakeRPCClient(delay=0.2)
+        gen = InstanceGenerator(rng=random.Random(5))
+        generate = gen.generate
+        generated = []
+        gen.generate = lambda obj: generated.append(obj) or generate(obj)
+        driver = LoadDriver(gen, parse_mix(["getInfo"]), rpc, timeout=1.0)
+        report = asyncio.run(driver.run(rate=100, duration=0.05))
+        # the instances are generated before the timed loop, and reused
+        assert len(generated) == 6 and report.sent["getInfo"] >= 5
+        # the run waits for the responses instead of cancelling them
+        assert report.codes == {"OK": report.sent["getInfo"]}
+        assert min(report.latencies) >= 0.15
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import pytest
+from quantnet_mq.lvcache import LastValueCache
+from quantnet_mq.msgserver import MsgServer
+from quantnet_mq.schema.models import monitor
+from quantnet_mq.tests.fakes import FakeMQTTClient
+
+
+class TestLastValueCache:
+
+    def test_topic_values(self):
+        cache = LastValueCache()
+        assert cache.update("state/a", '{"v": 1}')
+        assert not cache.update("state/a", '{"v": 1}')
+        # same value, different encoding
+        assert not cache.update("state/a", '{"v":  1}')
+        assert cache.update("state/a", '{"v": 2}')
+        assert cache.get("state/a") == {"v": 2}
+        assert cache.get("state/b") is None
+        assert cache.version == 2
+
+    def test_keyed_snapshot(self):
+        cache = LastValueCache(key="rid")
+        events = [{"rid": "n1", "value": "alive"}, {"rid": "n2", "value": "alive"}]
+        assert cache.update("monitor/agentState", json.dumps(events))
+        snap = cache.snapshot("monitor/agentState")
+        assert cache.update("monitor/agentState", {"rid": "n2", "value": "dead"})
+        assert not cache.update("monitor/agentState", {"rid": "n1", "value": "alive"})
+        assert snap == {"n1": events[0], "n2": events[1]}
+        assert cache.get("monitor/agentState", "n2")["value"] == "dead"
+        assert set(cache.snapshot()) == {("monitor/agentState", "n1"), ("monitor/agentState", "n2")}
+
+
+class TestMsgServerCache:
+
+    def test_changes_only(self):
+        async def run():
+            received = []
+
+            async def cb(data):
+                received.append(json.loads(data)["value"])
+
+            server = MsgServer("lvc", last_value_cache=True, cache_key="rid")
+            server.subscribe("monitor/agentState", cb, changes_only=True)
+            for value in ["alive", "alive", "suspect", "suspect", "alive"]:
+                payload = json.dumps({"rid": "n1", "value": value}).encode()
+                await server.on_message(FakeMQTTClient(), "monitor/agentState", payload, 1, {})
+            assert received == ["alive", "suspect", "alive"]
+            assert server.get("monitor/agentState", "n1")["value"] == "alive"
+        asyncio.run(run())
+
+    def test_changes_only_ignores_ts(self):
+        async def run():
+            received = []
+
+            async def cb(data):
+                received.append(json.loads(data)["ts"])
+
+            server = MsgServer("lvc", last_value_cache=True, cache_key="rid")
+            server.subscribe("monitor/agentState", cb, changes_only=True)
+            for ts, value in [(1.0, "alive"), (2.0, "alive"), (3.0, "dead"), (4.0, "dead")]:
+                event = monitor.MonitorEvent(rid="n1", ts=ts, eventType="agentState", value=value)
+                await server.on_message(FakeMQTTClient(), "monitor/agentState", event.serialize().encode(), 1, {})
+            assert received == [1.0, 3.0]
+            # the cache still holds the latest event
+            assert server.get("monitor/agentState", "n1")["ts"] == 4.0
+        asyncio.run(run())
+
+    def test_no_ignore(self):
+        cache = LastValueCache(key="rid", ignore=None)
+        assert cache.update("monitor/agentState", {"rid": "n1", "ts": 1.0, "value": "alive"})
+        assert cache.update("monitor/agentState", {"rid": "n1", "ts": 2.0, "value": "alive"})
+
+    def test_disabled(self):
+        server = MsgServer("lvc")
+        assert server.cache is None
+        with pytest.raises(ValueError):
+            server.subscribe("monitor/agentState", None, changes_only=True)
@@ -0,0 +1,87 @@
+import json
+import asyncio
+import numpy as np
+from quantnet_mq import attachments
+from quantnet_mq.monitorstore import MonitorStore, Series, SLOT_BYTES
+
+
+class TestMonitorStore:
+
+    def test_ring(self):
+        s = Series(4)
+        for i in range(6):
+            s.append(float(i), i * 10)
+        assert len(s) == 4
+        ts, values = s.range()
+        assert ts.tolist() == [2, 3, 4, 5]
+        assert values.tolist() == [20, 30, 40, 50]
+        ts, values = s.range(3, 4)
+        assert ts.tolist() == [3, 4]
+
+        s.extend([6, 7, 8], [60, 70, 80])
+        assert s.range()[0].tolist() == [5, 6, 7, 8]
+        assert s.last() == (8, 80)
+
+    def test_objects_overwritten(self):
+        s = Series(2)
+        s.append(1.0, {"a": 1})
+        s.append(2.0, 2)
+        s.append(3.0, 3)
+        assert s.objects()[1].tolist() == []
+        s.append(4.0, [4])
+        assert s.objects()[1].tolist() == [[4]]
+
+    def test_unsorted(self):
+        s = Series(8)
+        for t in (1, 3, 2, 5, 4):
+            s.append(float(t), t)
+        assert sorted(s.range(2, 4)[0].tolist()) == [2, 3, 4]
+        assert s.aggregate(aggs=("first", "last", "count")) == {"first": 1, "last": 5, "count": 5}
+
+    def test_downsample(self):
+        s = Series(1000)
+        s.extend(np.arange(100, dtype=float), np.arange(100, dtype=float))
+        ts, values = s.downsample(10, start=0, agg="mean")
+        assert ts.tolist() == list(range(0, 100, 10))
+        assert values.tolist() == [4.5 + 10 * i for i in range(10)]
+        assert s.downsample(25, agg="max")[1].tolist() == [24, 49, 74, 99]
+        assert s.downsample(25, agg="count")[1].tolist() == [25, 25, 25, 25]
+
+    def test_store(self):
+        store = MonitorStore(capacity=16, max_series=2)
+        events = [
+            {"rid": "a", "ts": 1.0, "eventType": "agentHeartbeat", "value": 1},
+            {"rid": "a", "ts": 2.0, "eventType": "agentState", "value": "alive"},
+            {"rid": "a", "ts": 3.0, "eventType": "agentState", "value": "dead"},
+            {"rid": "b", "ts": 3.0, "eventType": "agentState", "value": "alive"},
+            {"rid": "a", "eventType": "agentState", "value": "alive"},
+        ]
+        asyncio.run(store.on_message(json.dumps(events)))
+        assert len(store) == 2
+        assert store.dropped == 2
+        s = store.series("agentState", "a")
+        assert s.decode(s.range()[1]).tolist() == ["alive", "dead"]
+        assert store.aggregate("agentHeartbeat", aggs=("count",)) == {"a": {"count": 1}}
+
+    def test_on_message_decoded(self):
+        # a message sent with attachments reaches the callback already decoded
+        store = MonitorStore(capacity=16)
+        events = [{"rid": "a", "ts": 1.0, "eventType": "agentHeartbeat", "value": 1.0},
+                  {"rid": "a", "ts": 2.0, "eventType": "agentHeartbeat", "value": np.ones(2)}]
+        asyncio.run(store.on_message(attachments.decode(attachments.encode(events))))
+        asyncio.run(store.on_message(b"{not json"))
+        assert store.range("agentHeartbeat", "a")[0].tolist() == [1.0, 2.0]
+        assert store.dropped == 1
+
+    def test_spill(self, tmp_path):
+        store = MonitorStore(capacity=8, spill_dir=str(tmp_path))
+        store.extend("agentHeartbeat", "a", [1, 2, 3], [1, 1, 1])
+        store.flush()
+        assert store.range("agentHeartbeat", "a")[0].tolist() == [1, 2, 3]
+        assert len(list(tmp_path.iterdir())) == 2
+
+    def test_max_bytes(self):
+        store = MonitorStore(capacity=100, max_bytes=3 * 100 * SLOT_BYTES)
+        for rid in "abcd":
+            store.add({"rid": rid, "ts": 1.0, "eventType": "agentHeartbeat", "value": 1})
+        assert len(store) == 3 and store.nbytes == 3 * 100 * SLOT_BYTES and store.dropped == 1
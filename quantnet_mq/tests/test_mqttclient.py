@@ -0,0 +1,119 @@
+import asyncio
+import struct
+from gmqtt import Message
+from gmqtt.mqtt.constants import MQTTCommands
+from gmqtt.mqtt.package import PublishPacket
+from gmqtt.mqtt.protocol import MQTTProtocol
+from quantnet_mq.gmqtt.mqttclient import MQTTClient
+
+
+class FakeConnection:
+
+    _protocol = MQTTProtocol
+
+    def __init__(self):
+        self.packets = []
+        self.acks = []
+
+    def send_package(self, package):
+        self.packets.append(bytes(package))
+
+    def send_command_with_mid(self, cmd, mid, dup, reason_code=0):
+        self.acks.append((cmd, mid, reason_code))
+
+
+def make_client(alias_maximum=0):
+    client = MQTTClient("template-test")
+    client._connection = FakeConnection()
+    client._connack_properties = {"topic_alias_maximum": [alias_maximum]}
+    client._clear_topics_aliases()
+    return client
+
+
+class TestPublishTemplate:
+
+    def test_same_packet_as_gmqtt(self):
+        async def run():
+            client = make_client()
+            props = {"response_topic": "rpc/reply", "content_type": "application/json"}
+            for qos in (0, 1):
+                message = Message("rpc/qn-server", '{"cmd": "getInfo"}', qos=qos, **props, correlation_data=b"abc")
+                mid, expected = PublishPacket.build_package(message, MQTTProtocol)
+                if mid is not None:
+                    # hand the same message id to the template
+                    PublishPacket.id_generator.free_id(mid)
+                    PublishPacket.id_generator._last_used_id = mid - 1
+                tpl = client.template("rpc/qn-server", qos, False, **props)
+                assert tpl.encode('{"cmd": "getInfo"}', correlation_data=b"abc")[:2] == (mid, expected)
+        asyncio.run(run())
+
+    def test_topic_alias(self):
+        async def run():
+            client = make_client(alias_maximum=1)
+            for _ in range(3):
+                client.publish("monitor/agentHeartbeat", {"rid": "n1"}, 0)
+            client.publish("monitor/agentState", {"rid": "n1"}, 0)
+            first, second, third, other = client._connection.packets
+            # the topic is sent once, then replaced by the alias
+            assert b"monitor/agentHeartbeat" in first
+            assert b"monitor/agentHeartbeat" not in second and second == third
+            assert len(second) == len(first) - len("monitor/agentHeartbeat")
+            # no alias left for a second topic
+            assert b"monitor/agentState" in other
+            # aliases are renegotiated after a reconnect
+            client._clear_topics_aliases()
+            client.publish("monitor/agentHeartbeat", {"rid": "n1"}, 0)
+            assert client._connection.packets[-1] == first
+        asyncio.run(run())
+
+
+def receive(client, topic, payload, qos, mid):
+    """ feed a PUBLISH packet from the broker to the client """
+    raw = struct.pack("!H", len(topic)) + topic.encode() + struct.pack("!H", mid) + b"\x00" + payload
+    client._handle_publish_packet(MQTTCommands.PUBLISH | (qos << 1), raw)
+
+
+class TestManualAck:
+
+    def test_ack_after_processing(self):
+        async def run():
+            client = MQTTClient("ack-test", manual_ack=True, receive_maximum=2)
+            assert client._connect_properties["receive_maximum"] == 2
+            client._connection = FakeConnection()
+            release = asyncio.Event()
+            processed = []
+
+            async def on_message(client, topic, payload, qos, properties):
+                await release.wait()
+                if payload == b"bad":
+                    raise ValueError(payload)
+                processed.append(payload)
+
+            client.on_message = on_message
+            receive(client, "monitor/a", b"1", 1, 10)
+            receive(client, "monitor/a", b"bad", 1, 11)
+            receive(client, "monitor/a", b"2", 2, 12)
+            await asyncio.sleep(0)
+            # nothing is acknowledged while the messages are processed
+            assert client._connection.acks == [] and client.unacked == 3
+            release.set()
+            await asyncio.sleep(0.01)
+            assert sorted(client._connection.acks) == [(MQTTCommands.PUBACK, 10, 0), (MQTTCommands.PUBACK, 11, 0x83),
+                                                       (MQTTCommands.PUBREC, 12, 0)]
+            assert processed == [b"1", b"2"] and client.unacked == 0
+            client._resend_task.cancel()
+        asyncio.run(run())
+
+    def test_optimistic_by_default(self):
+        async def run():
+            client = MQTTClient("ack-test")
+            client._connection = FakeConnection()
+
+            async def on_message(*args):
+                await asyncio.sleep(1)
+
+            client.on_message = on_message
+            receive(client, "monitor/a", b"1", 1, 10)
+            assert client._connection.acks == [(MQTTCommands.PUBACK, 10, 0)]
+            client._resend_task.cancel()
+        asyncio.run(run())
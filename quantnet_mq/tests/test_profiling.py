@@ -0,0 +1,93 @@
+import asyncio
+import time
+from quantnet_mq.rpcserver import RPCServer
+from quantnet_mq.tests.fakes import FakeMQTTClient, request
+
+
+def make_server(**kwargs):
+    server = RPCServer("profiled")
+    server._mqttclient = FakeMQTTClient()
+    server.enable_profiling(**kwargs)
+    return server
+
+
+async def busy_loop(until):
+    while time.monotonic() < until:
+        spin_for_a_while()
+        await asyncio.sleep(0)
+
+
+def spin_for_a_while():
+    end = time.perf_counter() + 0.002
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiler:
+
+    def test_sample(self):
+        async def run():
+            server = make_server(agents={"admin"}, max_overhead=0.05)
+            load = asyncio.ensure_future(busy_loop(time.monotonic() + 0.5))
+            await server.on_message(None, "rpc", *request("profile", {"mode": "sample", "duration": 0.3}, 0, "admin"))
+            await load
+            res = server._mqttclient.json()
+            assert res["status"]["code"] == 0
+            payload = res["payload"]
+            assert payload["samples"] > 0 and payload["overhead"] < 0.1
+            assert "spin_for_a_while" in payload["result"]
+            stack, count = payload["result"].splitlines()[0].rsplit(" ", 1)
+            assert int(count) > 0 and ";" in stack
+        asyncio.run(run())
+
+    def test_handler_cprofile(self, tmp_path):
+        async def run():
+            server = make_server(token="s3cret", output_dir=str(tmp_path))
+
+            def get_info(req):
+                spin_for_a_while()
+
+            server.set_handler("getInfo", get_info, "quantnet_mq.schema.models.experiment.getInfo")
+            capture = asyncio.ensure_future(server.on_message(None, "rpc", *request(
+                "profile", {"mode": "cprofile", "duration": 0.2, "command": "getInfo", "token": "s3cret",
+                            "toFile": True}, 0)))
+            await asyncio.sleep(0.01)
+            for n in range(1, 4):
+                await server.on_message(None, "rpc", *request("getInfo", {}, n))
+            await capture
+            payload = server._mqttclient.json()["payload"]
+            with open(payload["file"]) as f:
+                assert "spin_for_a_while" in f.read()
+        asyncio.run(run())
+
+    def test_tracemalloc(self):
+        async def run():
+            server = make_server()
+            kept = []
+
+            async def allocate():
+                await asyncio.sleep(0.02)
+                kept.append([bytearray(1024) for _ in range(500)])
+
+            task = asyncio.ensure_future(allocate())
+            await server.on_message(None, "rpc", *request("profile", {"mode": "tracemalloc", "duration": 0.1}, 0))
+            await task
+            result = server._mqttclient.json()["payload"]["result"]
+            assert "test_profiling.py" in result.splitlines()[0]
+        asyncio.run(run())
+
+    def test_refused(self):
+        async def run():
+            server = make_server(agents={"admin"}, token="s3cret", max_duration=1)
+            requests = [
+                ({"mode": "sample", "token": "s3cret"}, "intruder"),
+                ({"mode": "sample", "token": "wrong"}, "admin"),
+                ({"mode": "sample", "token": "s3cret", "duration": 60}, "admin"),
+                ({"mode": "sample", "token": "s3cret", "toFile": True}, "admin"),
+            ]
+            for n, (payload, agent) in enumerate(requests):
+                await server.on_message(None, "rpc", *request("profile", payload, n, agent))
+            codes = [res["status"]["code"] for res in server._mqttclient.messages()]
+            assert codes == [6, 6, 3, 3]
+            assert server._profiler.active is None
+        asyncio.run(run())
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import numpy as np
+import pytest
+from quantnet_mq import attachments
+from quantnet_mq.rpcclient import RPCClient, _resolve_batch
+from quantnet_mq.rpcserver import RPCServer
+from quantnet_mq.hedging import HedgePolicy
+from quantnet_mq.tests.fakes import FakeMQTTClient
+
+
+def make_client(**kwargs):
+    client = RPCClient("test", **kwargs)
+    client._mqttclient = FakeMQTTClient()
+    return client
+
+
+async def respond(client, corrid, body):
+    await client.on_message(None, "rpc", json.dumps(body).encode(), 1, {"correlation_data": [corrid]})
+
+
+class TestRPCClientDispatch:
+
+    def test_sync_call(self):
+        async def run():
+            client = make_client()
+            client.set_handler("getInfo", None, "quantnet_mq.schema.models.experiment.getInfo")
+            call = asyncio.ensure_future(client.call("getInfo", {}, timeout=1.0))
+            await asyncio.sleep(0)
+            await respond(client, client._mqttclient.sent[0].correlation_data, {"status": "ok"})
+            assert json.loads(await call) == {"status": "ok"}
+            with pytest.raises(TimeoutError):
+                await client.call("getInfo", {}, timeout=0.01)
+            assert not client._sent_requests
+        asyncio.run(run())
+
+    @pytest.mark.parametrize("workers", [0, 2])
+    def test_async_callbacks(self, workers):
+        async def run():
+            results, errors = [], []
+
+            async def cb(body):
+                results.append(json.loads(body)["n"])
+                return len(results)
+
+            client = make_client(callback_workers=workers, callback_queue_size=4)
+            client.set_handler("getInfo", cb, "quantnet_mq.schema.models.experiment.getInfo")
+            client._start_callback_workers()
+            tasks = len(asyncio.all_tasks())
+            futs = [await client.call("getInfo", {}, timeout=0.05 if n == 99 else 1.0, sync=False,
+                                      on_error=errors.append) for n in range(100)]
+            # no task or timer per outstanding call
+            assert len(asyncio.all_tasks()) == tasks
+            assert len(client._expiry) == 100
+            for n, request in enumerate(client._mqttclient.sent[:99]):
+                await respond(client, request.correlation_data, {"n": n})
+            assert sorted(await asyncio.gather(*futs[:99])) == list(range(1, 100))
+            assert sorted(results) == list(range(99))
+            with pytest.raises(TimeoutError):
+                await futs[99]
+            assert len(errors) == 1 and isinstance(errors[0], TimeoutError)
+            await client.stop()
+        asyncio.run(run())
+
+    def test_malformed_response(self):
+        async def run():
+            client = make_client()
+            client.set_handler("getInfo", None, "quantnet_mq.schema.models.experiment.getInfo")
+            for body in (b'{"status": ', attachments.MAGIC + b"\xff\xff\xff\xff{"):
+                call = asyncio.ensure_future(client.call("getInfo", {}, timeout=5.0))
+                await asyncio.sleep(0)
+                corrid = client._mqttclient.sent[-1].correlation_data
+                await client.on_message(None, "rpc", body, 1, {"correlation_data": [corrid]})
+                # fails at once instead of waiting for a timeout that never comes
+                with pytest.raises(ValueError, match="Invalid RPC response"):
+                    await asyncio.wait_for(call, 0.5)
+            assert not client._sent_requests
+        asyncio.run(run())
+
+
+class TestRPCClientCache:
+
+    def test_cached_reads(self):
+        async def run():
+            client = make_client()
+            client.set_handler("getInfo", None, "quantnet_mq.schema.models.experiment.getInfo")
+            client.set_cache_policy("getInfo", ttl=10.0, invalidate_on=("agentState",),
+                                    rid=lambda topic, msg: msg.get("rid"))
+            sent = client._mqttclient.sent
+
+            async def read(rid, status=0):
+                call = asyncio.ensure_future(client.call("getInfo", {"rid": rid}, timeout=1.0))
+                await asyncio.sleep(0)
+                if len(sent) > len(answered):
+                    answered.append(sent[-1].correlation_data)
+                    await respond(client, sent[-1].correlation_data, {"status": {"code": status}, "payload": rid})
+                return json.loads(await call)["payload"]
+
+            answered = []
+            assert await read("n1", status=6) == "n1"
+            assert await read("n1") == "n1"
+            assert await read("n1") == "n1"
+            assert await read("n2") == "n2"
+            # the failed response was not cached, the third read was a hit
+            assert len(sent) == 3
+            await client.cache.on_message(json.dumps({"rid": "n1", "eventType": "agentState", "value": "dead"}))
+            assert await read("n1") == "n1"
+            assert await read("n2") == "n2"
+            assert len(sent) == 4
+            stats = client.cache.stats()
+            assert stats["hits"] == 2 and stats["invalidated"] == 1
+            assert stats["hit_ratio"] == 2 / 6
+        asyncio.run(run())
+
+
+class TestRPCBatch:
+
+    def test_call_batch(self):
+        async def run():
+            order = []
+
+            async def get_info(req):
+                await asyncio.sleep(0.01 if req.payload.as_dict() == {"n": 1} else 0)
+                order.append(req.payload.as_dict())
+                return {"status": {"code": 0, "value": "OK"}, "payload": req.payload.as_dict()}
+
+            server = RPCServer("srv")
+            server._mqttclient = FakeMQTTClient()
+            server.set_handler("getInfo", get_info, "quantnet_mq.schema.models.experiment.getInfo")
+            client = make_client()
+            client.set_handler("getInfo", None, "quantnet_mq.schema.models.experiment.getInfo")
+            client.set_handler("getState", None, "quantnet_mq.schema.models.experiment.getState")
+
+            for ordered in (True, False):
+                order.clear()
+                futs = await client.call_batch([("getInfo", {"n": 1}), ("getState", {}), ("getInfo", {"n": 2})],
+                                               ordered=ordered)
+                # the request reaches the server and its response the client
+                req = client._mqttclient.sent[-1]
+                await server.on_message(None, "rpc", req.payload, 1, {
+                    "response_topic": ["reply"], "correlation_data": [req.correlation_data]})
+                reply = server._mqttclient.sent[-1]
+                await client.on_message(None, "reply", reply.payload, 1, {"correlation_data": [reply.correlation_data]})
+                res = [json.loads(r) for r in await asyncio.gather(*futs)]
+                assert res[0]["payload"] == {"n": 1} and res[2]["payload"] == {"n": 2}
+                # getState has no handler on the server
+                assert res[1]["status"]["code"] == 6
+                # unordered, the slow first item does not hold up the last one
+                assert order == ([{"n": 1}, {"n": 2}] if ordered else [{"n": 2}, {"n": 1}])
+
+            futs = await client.call_batch([("getInfo", {})], timeout=0.01)
+            with pytest.raises(TimeoutError):
+                await futs[0]
+        asyncio.run(run())
+
+    def test_batch_responses(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+
+            def resolve(body):
+                fut, futs = loop.create_future(), [loop.create_future() for _ in range(2)]
+                fut.set_result(body)
+                _resolve_batch(fut, futs)
+                assert all(f.done() for f in futs)
+                return futs
+
+            # the items of a response with attachments keep their arrays
+            assert resolve({"batch": [{"a": np.arange(2)}, {"b": 1}]})[0].result()["a"].tolist() == [0, 1]
+            assert json.loads(resolve(b'{"batch": [{"b": 1}, {"b": 2}]}')[1].result()) == {"b": 2}
+            for body in (b'{"batch": 5}', {"status": {}}, b"{"):
+                for f in resolve(body):
+                    with pytest.raises(ValueError, match="Invalid batch response"):
+                        f.result()
+        asyncio.run(run())
+
+
+class TestHedging:
+
+    def test_hedge_policy(self):
+        policy = HedgePolicy(["rpc/a", "rpc/b"], percentile=90, min_samples=10, max_ratio=0.5, burst=1.0)
+        assert policy.delay == policy.initial_delay
+        for n in range(10):
+            policy.observe(n / 100)
+        assert policy.delay == 0.09
+        policy.request()
+        assert policy.acquire("rpc/a") == "rpc/b"
+        # the one token of the burst is used, two more requests earn the next
+        assert policy.acquire("rpc/a") is None
+        policy.request()
+        policy.request()
+        assert policy.acquire("rpc/b") == "rpc/a"
+
+    def test_hedged_call(self):
+        async def run():
+            client = make_client()
+            client.set_handler("getState", None, "quantnet_mq.schema.models.experiment.getState")
+            client.set_hedge_policy("getState", ["rpc/a", "rpc/b"], initial_delay=0.01)
+            call = asyncio.ensure_future(client.call("getState", {}, timeout=1.0, topic="rpc/a"))
+            await asyncio.sleep(0.05)
+            # the request and its hedge share the correlation id
+            first, hedge = (p.correlation_data for p in client._mqttclient.sent)
+            assert hedge == first + b".h"
+            await respond(client, hedge, {"replica": "b"})
+            await respond(client, first, {"replica": "a"})
+            assert json.loads(await call) == {"replica": "b"}
+            assert client.hedge_stats("getState")["hedge_wins"] == 1
+        asyncio.run(run())
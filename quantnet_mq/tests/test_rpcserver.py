@@ -0,0 +1,66 @@
+import asyncio
+import json
+from quantnet_mq.rpcserver import RPCServer, rpcResponse
+from quantnet_mq.tests.fakes import request
+
+
+class TestSingleFlight:
+
+    def test_identical_requests_collapse(self, mqttclient):
+        async def run():
+            calls = []
+            release = asyncio.Event()
+
+            async def get_info(req):
+                calls.append(req.payload)
+                await release.wait()
+                return {"status": {"code": 0}, "payload": [len(calls), req.payload.as_dict()]}
+
+            server = RPCServer("sf")
+            server._mqttclient = mqttclient
+            server.set_handler("getInfo", get_info, "quantnet_mq.schema.models.experiment.getInfo",
+                               single_flight=True)
+            payloads = [{"a": 1, "b": 2}, {"b": 2, "a": 1}, {"a": 1, "b": 2}, {"a": 2}]
+            tasks = [asyncio.ensure_future(server.on_message(None, "rpc", *request("getInfo", p, n)))
+                     for n, p in enumerate(payloads)]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(*tasks)
+
+            assert len(calls) == 2
+            sent = server._mqttclient.sent
+            assert sorted(p.topic for p in sent) == [f"reply/{n}" for n in range(4)]
+            by_topic = {p.topic: (json.loads(p.payload)["payload"], p.correlation_data) for p in sent}
+            assert by_topic["reply/0"][0] == by_topic["reply/1"][0] == by_topic["reply/2"][0] != by_topic["reply/3"][0]
+            assert by_topic["reply/2"][1] == b"2"
+            assert server.stats() == {"single_flight_executions": 2, "single_flight_collapsed": 2}
+
+            # not in flight any more, executed again
+            await server.on_message(None, "rpc", *request("getInfo", payloads[0], 4))
+            assert len(calls) == 3
+        asyncio.run(run())
+
+
+class TestBatch:
+
+    def test_item_failures(self, mqttclient):
+        async def run():
+            server = RPCServer("batch")
+            server._mqttclient = mqttclient
+            # a JSON str response
+            server.set_handler("getInfo",
+                               lambda req: json.dumps({"status": {"code": 0}, "payload": req.payload.as_dict()["n"]}),
+                               "quantnet_mq.schema.models.experiment.getInfo")
+            # not a valid response, it has no status
+            server.set_handler("getState", lambda req: rpcResponse(),
+                               "quantnet_mq.schema.models.experiment.getState")
+            server.limits.set_command_limit("getInfo", max_bytes=100)
+            items = [{"cmd": "getInfo", "agentId": "a", "payload": {"n": 1}},
+                     {"cmd": "getState", "agentId": "a", "payload": {}},
+                     {"cmd": "getInfo", "agentId": "a", "payload": {"n": 2, "pad": "x" * 100}}]
+            await server.on_message(None, "rpc", *request("$batch", items, 0))
+            res = mqttclient.json()
+            assert res["status"]["code"] == 0
+            assert res["batch"][0] == {"status": {"code": 0}, "payload": 1}
+            assert [r["status"]["code"] for r in res["batch"][1:]] == [6, 3]
+        asyncio.run(run())
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import pytest
+from quantnet_mq.rpcserver import RPCServer
+from quantnet_mq.schema import models
+from quantnet_mq.schema.models import Schema
+from quantnet_mq.tests.fakes import request
+
+
+BASE = """
+components:
+  schemas:
+    Widget:
+      title: Widget
+      type: object
+      additionalProperties: false
+      properties:
+        name:
+          type: string
+    Gadget:
+      title: Gadget
+      type: object
+      properties:
+        n:
+          type: integer
+"""
+
+PLUGIN = """
+components:
+  schemas:
+    build:
+      title: build
+      type: object
+      properties:
+        cmd:
+          type: string
+        agentId:
+          type: string
+        payload:
+          $ref: "widgets.yaml#/components/schemas/Widget"
+    buildResponse:
+      title: buildResponse
+      type: object
+      properties:
+        status:
+          $ref: "qn-schema:objects/objects.yaml#/components/schemas/Status"
+"""
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+class TestRegister:
+
+    def test_incremental(self, tmp_path):
+        base = write(tmp_path, "widgets.yaml", BASE)
+        plugin = write(tmp_path, "plugin.yaml", PLUGIN)
+        assert Schema.register(base, ns="widgets") == ["Gadget", "Widget"]
+        assert Schema.register(plugin, ns="widgets") == ["Status", "Widget", "build", "buildResponse"]
+        generation = Schema.generation
+        # nothing changed, nothing rebuilt
+        assert Schema.register(plugin, ns="widgets") == []
+
+        write(tmp_path, "widgets.yaml", BASE.replace("type: string", "type: string\n        size:\n"
+                                                     "          type: integer"))
+        # the request that references Widget is rebuilt with it, buildResponse and Gadget are not
+        assert Schema.register(base, ns="widgets") == ["Widget", "build"]
+        assert Schema.generation > generation
+        msg = models.widgets.build(cmd="build", agentId="a", payload={"name": "w", "size": 2})
+        msg.validate()
+
+        write(tmp_path, "widgets.yaml", BASE.split("    Gadget:")[0])
+        Schema.register(base, ns="widgets")
+        assert not hasattr(models.widgets, "Gadget") and hasattr(models.widgets, "Widget")
+
+    def test_staging_isolated(self, tmp_path):
+        base = write(tmp_path, "widgets.yaml", BASE)
+        plugin = write(tmp_path, "plugin.yaml", PLUGIN)
+        Schema.register(base, ns="staged")
+        Schema.register(plugin, ns="staged")
+        key = os.path.normpath(base)
+        cached = Schema._SCHEMA_CACHE[key]
+
+        write(tmp_path, "widgets.yaml", BASE.replace("type: string", "type: strng"))
+        with pytest.raises(Exception):
+            Schema.register(base, ns="staged")
+        # a failed build leaves the cache as it was
+        assert Schema._SCHEMA_CACHE[key] is cached
+
+        write(tmp_path, "widgets.yaml", BASE.replace("type: string", "type: string\n        size:\n"
+                                                     "          type: integer"))
+        staged = Schema._stage(base, ns="staged")
+        # the references resolve to the new contents only once swapped
+        assert Schema._SCHEMA_CACHE[key] is cached
+        Schema._swap(staged)
+        assert "size" in Schema._SCHEMA_CACHE[key]["components"]["schemas"]["Widget"]["properties"]
+        models.staged.build(cmd="build", agentId="a", payload={"name": "w", "size": 2}).validate()
+
+    def test_dispatch(self, tmp_path, mqttclient):
+        base = write(tmp_path, "widgets.yaml", BASE)
+        plugin = write(tmp_path, "plugin.yaml", PLUGIN)
+
+        async def run():
+            await Schema.register_async(base, ns="gizmos")
+            await Schema.register_async(plugin, ns="gizmos")
+            received = []
+            server = RPCServer("registry")
+            server._mqttclient = mqttclient
+            server.set_handler("build", lambda req: received.append(req.payload.as_dict()),
+                               "quantnet_mq.schema.models.gizmos.build")
+            await server.on_message(None, "rpc", *request("build", {"name": "w", "size": 2}, 0))
+            assert mqttclient.json()["status"]["code"] == 6
+
+            write(tmp_path, "widgets.yaml", BASE.replace("type: string", "type: string\n        size:\n"
+                                                         "          type: integer"))
+            await Schema.register_async(base, ns="gizmos")
+            await server.on_message(None, "rpc", *request("build", {"name": "w", "size": 2}, 1))
+            assert mqttclient.json()["status"]["code"] == 0
+            assert received == [{"name": "w", "size": 2}]
+        asyncio.run(run())
@@ -0,0 +1,127 @@
+import asyncio
+import re
+from gmqtt.mqtt.property import Property
+from gmqtt.mqtt.protocol import MQTTProtocol
+from quantnet_mq.gmqtt.mqttclient import MQTTClient
+from quantnet_mq.spool import Spool
+
+
+class FakeConnection:
+
+    _protocol = MQTTProtocol
+
+    def __init__(self):
+        self.packets = []
+        self.subscribed = []
+        self.closing = False
+
+    def send_package(self, package):
+        self.packets.append(bytes(package))
+
+    def subscribe(self, subscriptions, **kwargs):
+        self.subscribed.extend(s.topic for s in subscriptions)
+
+    def is_closing(self):
+        return self.closing
+
+
+def make_client(**kwargs):
+    client = MQTTClient("spool-test", **kwargs)
+    client._connection = FakeConnection()
+    client._is_active = True
+    return client
+
+
+def connack(client, session_present=False, receive_maximum=None):
+    props = bytes(Property.factory(name="receive_maximum").dumps(receive_maximum)) if receive_maximum else b""
+    client._handle_connack_packet(0x20, bytes((int(session_present), 0, len(props))) + props)
+
+
+class TestSpool:
+
+    def test_spill_in_order(self, tmp_path):
+        spool = Spool(memory_bytes=1000, file_bytes=4096, path=str(tmp_path / "out.spool"))
+        for i in range(20):
+            assert spool.put(f"monitor/{i}", b"x" * 100, 1, i == 3, {"correlation_data": b"%d" % i} if i > 5 else {})
+        assert len(spool) == 20 and spool.stats()["file_bytes"] > 0
+        first = spool.take(8)
+        assert [m[0] for m in first] == [f"monitor/{i}" for i in range(8)]
+        assert first[3][3] and first[7] == ("monitor/7", b"x" * 100, 1, False, {"correlation_data": b"7"})
+        assert [m[0] for m in spool.take(100)] == [f"monitor/{i}" for i in range(8, 20)]
+        assert not spool and spool.take(1) == []
+
+    def test_bounded(self):
+        spool = Spool(memory_bytes=1000, file_bytes=1000)
+        accepted = sum(spool.put("t", b"x" * 200) for _ in range(20))
+        assert spool.dropped == 20 - accepted and len(spool) == accepted
+        spool.take(len(spool))
+        # the file is reused once drained
+        assert spool.put("t", b"x" * 200)
+
+    def test_resume(self, tmp_path):
+        path = str(tmp_path / "out.spool")
+        spool = Spool(memory_bytes=0, path=path)
+        for i in range(3):
+            spool.put("rpc/qn-server", b"%d" % i, 2)
+        spool.take(1)
+        spool.close()
+        spool = Spool(memory_bytes=0, path=path)
+        assert [m[1] for m in spool.take(10)] == [b"1", b"2"]
+
+
+class TestReconnect:
+
+    def test_spool_while_disconnected(self):
+        async def run():
+            client = make_client()
+            connack(client)
+            client.publish("monitor/a", {"n": 0}, 1)
+            assert len(client._connection.packets) == 1
+            client._connection.closing = True
+            for n in range(1, 4):
+                client.publish("monitor/a", {"n": n}, 1)
+            assert len(client.spool) == 3 and len(client._connection.packets) == 1
+            # the broker acknowledged the first message before the connection was lost
+            await asyncio.sleep(0)
+            await client._persistent_storage.remove_message_by_mid(client._persistent_storage._queue[0][1])
+
+            client.subscribe("monitor/#", 1)
+            client._connection = FakeConnection()
+            connack(client, receive_maximum=2)
+            client.publish("monitor/a", {"n": 4}, 1)
+            assert client._connection.subscribed == ["monitor/#"]
+            await asyncio.sleep(0.01)
+            # two in flight at most, in order and in one write
+            assert len(client._connection.packets) == 1
+            assert re.findall(rb'"n":(\d)', client._connection.packets[0]) == [b"1", b"2"]
+            for _, mid, _ in list(client._persistent_storage._queue):
+                await client._persistent_storage.remove_message_by_mid(mid)
+            await asyncio.sleep(0.05)
+            assert re.findall(rb'"n":(\d)', b"".join(client._connection.packets[1:])) == [b"3", b"4"]
+            assert not client.spool
+            client._resend_task.cancel()
+        asyncio.run(run())
+
+    def test_session_resumed(self):
+        async def run():
+            client = make_client(spool=False)
+            connack(client)
+            client.subscribe("rpc/qn-server", 2)
+            client._connection = FakeConnection()
+            connack(client, session_present=True)
+            assert client._connection.subscribed == [] and client.connects == 2
+            client._resend_task.cancel()
+        asyncio.run(run())
+
+    def test_backoff(self):
+        async def run():
+            client = make_client(reconnect_delay=1.0, reconnect_max_delay=8.0)
+            delays = []
+            for failed in range(6):
+                client.failed_connections = failed
+                delays.append(client.reconnect_backoff())
+            for failed, delay in enumerate(delays):
+                cap = min(8.0, 2 ** failed)
+                assert cap / 2 <= delay <= cap
+            client._resend_task.cancel()
+        asyncio.run(run())
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import concurrent.futures
+import pytest
+from quantnet_mq.syncclient import SyncRPCClient
+
+
+class EchoClient:
+    """ stands in for RPCClient, answers every call from the loop thread """
+
+    cid = "echo"
+
+    def __init__(self):
+        self.threads = set()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def call(self, target, msg, timeout=5.0, **kwargs):
+        self.threads.add(threading.current_thread().name)
+        await asyncio.sleep(0.01)
+        if msg == "slow":
+            await asyncio.wait_for(asyncio.sleep(1), timeout)
+        return (target, msg)
+
+
+class TestSyncRPCClient:
+
+    def test_concurrent_calls(self):
+        client = SyncRPCClient("echo")
+        client._client = echo = EchoClient()
+        with client:
+            with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                res = list(pool.map(lambda i: client.call("getInfo", i), range(64)))
+            assert res == [("getInfo", i) for i in range(64)]
+            assert client.call_async("getState", 1).result() == ("getState", 1)
+            with pytest.raises(TimeoutError):
+                client.call("getInfo", "slow", timeout=0.05)
+        # every call ran on the one loop thread
+        assert echo.threads == {"rpcclient-echo"}
+        with pytest.raises(RuntimeError):
+            client.call("getInfo", 1)
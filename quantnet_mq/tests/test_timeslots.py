@@ -0,0 +1,59 @@
+import json
+import numpy as np
+import pytest
+from quantnet_mq.schema.models import Schedule
+from quantnet_mq.schema.scripts.validator import SchemaCatalog
+from quantnet_mq.schema.timeslots import SlotMap, merge, occupancy, conflicts, allocation_map
+
+
+class TestSlotMap:
+
+    def test_encode_decode(self):
+        m = SlotMap.from_slots([0, 1, 2, 10, 20, 21], 100)
+        assert m.encode() == "iv:0-2,10,20-21"
+        assert SlotMap.decode(m.encode(), 100) == m
+        assert SlotMap.decode(m.encode("bm"), 100) == m
+        assert SlotMap.decode("[0, 1, 2, 10, 20, 21]", 100) == m
+        assert SlotMap.decode("0-2,10,20-21", 100) == m
+        rng = np.random.default_rng(1)
+        noisy = SlotMap(rng.random(86400) < 0.5)
+        assert noisy.encode().startswith("bm:") and len(noisy.encode()) == 14403
+        assert SlotMap.decode(noisy.encode(), 86400) == noisy
+        with pytest.raises(ValueError):
+            SlotMap.decode("iv:5-2", 10)
+
+    def test_search(self):
+        m = SlotMap.from_intervals([2, 10], [5, 12], 20)
+        assert m.slots().tolist() == [2, 3, 4, 5, 10, 11, 12]
+        assert [a.tolist() for a in m.intervals()] == [[2, 10], [5, 12]]
+        assert [a.tolist() for a in m.free_runs(3)] == [[6, 13], [4, 7]]
+        assert m.find_free(4) == 6
+        assert m.find_free(2) == 0
+        assert m.find_free(3, after=8) == 13
+        assert m.find_free(8) is None
+        assert m.window(10, 5).slots().tolist() == [0, 1, 2]
+
+    def test_merge_and_conflicts(self):
+        maps = [SlotMap.from_slots(s, 10) for s in ([0, 1], [5], [1, 2], [5, 9], [3])]
+        assert merge(maps).slots().tolist() == [0, 1, 2, 3, 5, 9]
+        assert occupancy(maps).tolist() == [1, 2, 1, 1, 0, 2, 0, 0, 0, 1]
+        assert conflicts(maps) == [(0, 2), (1, 3)]
+        assert maps[0].overlaps(maps[2]) and not maps[0].overlaps(maps[1])
+        assert maps[0].conflicts(maps[2]).tolist() == [1]
+
+    def test_schema(self):
+        m = SlotMap.from_slots([3, 4, 5], 3600)
+        sched = Schedule(**m.as_schedule(1700000000.0, 1.0))
+        assert SlotMap.from_schedule(json.loads(sched.serialize())) == m
+        catalog = SchemaCatalog()
+        submit = {"cmd": "submit", "agentId": "a", "payload": {
+            "type": "exp", "exp_id": "1", "timeslotBase": 1700000000.0, "allocations": [
+                {"expName": "e1", "parameters": [], "slotMap": m.encode()},
+                {"expName": "e2", "parameters": [], "timeSlot": [5, 6]}]}}
+        assert catalog.check(submit, "experiment.submit")[1] == []
+        # an allocation needs timeSlot or slotMap
+        submit["payload"]["allocations"].append({"expName": "e", "parameters": []})
+        assert len(catalog.check(submit, "experiment.submit")[1]) == 1
+        del submit["payload"]["allocations"][-1]
+        allocs = [allocation_map(a, 3600) for a in submit["payload"]["allocations"]]
+        assert conflicts(allocs) == [(0, 1)]
@@ -0,0 +1,83 @@
+import os
+import json
+from quantnet_mq.topology import TopologyIndex
+
+TEST_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__),
+                                          "../schema/examples/topology"))
+
+LBNL = ["conf_lbnl-q.json",
+        "conf_lbnl-m.json",
+        "conf_lbnl-bsm.json",
+        "conf_lbnl-switch.json"]
+
+
+def make_node(node_id, node_type, neighbors):
+    return {
+        "systemSettings": {"type": node_type, "name": node_id, "ID": node_id, "controlInterface": "localhost"},
+        "channels": [
+            {"ID": str(i), "name": f"channel_{i}", "type": "quantum", "direction": "out",
+             "wavelength": {"value": 1550, "unit": "nm"}, "power": 1.0,
+             "neighbor": {"systemRef": n, "channelRef": c}}
+            for i, (n, c) in enumerate(neighbors)
+        ]
+    }
+
+
+class TestTopologyIndex:
+
+    def get_file_json(self, f):
+        with open(f, "r") as file:
+            data = json.load(file)
+        return data
+
+    def test_examples(self):
+        topo = TopologyIndex()
+        for ex in LBNL:
+            topo.add(self.get_file_json(os.path.join(TEST_PATH, ex)))
+        assert len(topo) == 4
+        assert "LBNL-SWITCH" in topo.neighbors("LBNL-Q")
+        assert topo.node_type("LBNL-SWITCH") == "OpticalSwitch"
+
+    def test_dangling(self):
+        topo = TopologyIndex()
+        topo.add(make_node("a", "QNode", [("s", "0")]))
+        assert topo.dangling() == [("a", "0", "s", "0")]
+        assert topo.peer("a", "0") is None
+
+        topo.add(make_node("s", "OpticalSwitch", [("a", "0"), ("b", "0")]))
+        assert topo.dangling() == [("s", "1", "b", "0")]
+        assert topo.peer("a", "0") == ("s", "0")
+        assert set(topo.neighbors("s")) == {"a"}
+
+        topo.add(make_node("b", "QNode", [("s", "5")]))
+        assert topo.dangling() == [("b", "0", "s", "5")]
+        assert set(topo.neighbors("s")) == {"a", "b"}
+
+        topo.remove("s")
+        assert not topo.neighbors("a")
+        assert topo.dangling() == [("a", "0", "s", "0"), ("b", "0", "s", "5")]
+
+    def test_shortest_path(self):
+        topo = TopologyIndex()
+        topo.add(make_node("a", "QNode", [("s1", None)]))
+        topo.add(make_node("b", "QNode", [("s2", None)]))
+        topo.add(make_node("s1", "OpticalSwitch", [("s2", None)]))
+        topo.add(make_node("s2", "OpticalSwitch", []))
+        assert topo.shortest_path("a", "b") == ["a", "s1", "s2", "b"]
+
+        version = topo.version
+        topo.add(make_node("s3", "OpticalSwitch", [("a", None), ("b", None)]))
+        assert topo.version > version
+        assert topo.shortest_path("a", "b") == ["a", "s3", "b"]
+
+        topo.remove("s3")
+        topo.remove("s1")
+        assert topo.shortest_path("a", "b") is None
+
+    def test_register(self):
+        topo = TopologyIndex()
+        node = self.get_file_json(os.path.join(TEST_PATH, LBNL[0]))
+        assert topo.register({"cmd": "register", "agentId": "agent-q", "payload": node}) == "LBNL-Q"
+        assert topo.channel("LBNL-Q", "1")["name"] == "channel_1"
+        assert topo.deregister({"cmd": "deregister", "agentId": "agent-q"}) == "LBNL-Q"
+        assert len(topo) == 0
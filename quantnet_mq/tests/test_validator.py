@@ -0,0 +1,64 @@
+import concurrent.futures
+import json
+from quantnet_mq.schema.scripts import validator
+from quantnet_mq.schema.scripts.validator import SchemaCatalog
+
+EVENT = {"rid": "QNode_1", "ts": 1700000000.0, "eventType": "agentHeartbeat", "value": 0.5}
+
+
+def results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestBatchValidator:
+
+    def test_detect(self):
+        catalog = SchemaCatalog()
+        assert catalog.detect({"systemSettings": {"type": "BSMNode"}}) == "BSMNode"
+        assert catalog.detect(EVENT) == "MonitorEvent"
+        assert catalog.detect({"cmd": "getInfo", "agentId": "a"}) == "getInfo"
+        assert catalog.detect({"status": {"code": 0}}) == "rpcResponse"
+        assert catalog.detect({"foo": 1}) is None and catalog.detect([]) is None
+
+    def test_jsonl_line_numbers(self, tmp_path, monkeypatch):
+        # several chunks, so the workers get the lines of a chunk with its first line number
+        monkeypatch.setattr(validator, "CHUNK_LINES", 3)
+        lines = [json.dumps(dict(EVENT, value=n + 0.5)) for n in range(10)]
+        lines[7] = json.dumps({"rid": "QNode_1", "ts": "yesterday", "eventType": "agentHeartbeat", "value": 0.5})
+        lines.insert(4, "")
+        src = tmp_path / "events.jsonl"
+        src.write_text("\n".join(lines) + "\n")
+        out = tmp_path / "out.jsonl"
+        for jobs in ("1", "2"):
+            assert validator.main(["batch", "-j", jobs, "-q", "--output", str(out), str(src)]) == 1
+            res = results(out)
+            assert len(res) == 2
+            assert res[0]["line"] == 9 and res[0]["object"] == "MonitorEvent" and not res[0]["valid"]
+            assert res[0]["errors"][0].startswith("ts:")
+            assert res[1]["summary"]["total"] == 10 and res[1]["summary"]["invalid"] == 1
+
+    def test_exit_status(self, tmp_path):
+        src = tmp_path / "event.json"
+        src.write_text(json.dumps(EVENT))
+        out = tmp_path / "out.jsonl"
+        assert validator.main(["batch", "-j", "1", "--output", str(out), str(tmp_path)]) == 0
+        assert results(out)[0]["valid"]
+
+    def test_bounded_window(self):
+        read = []
+
+        class Executor:
+            def submit(self, func, task):
+                fut = concurrent.futures.Future()
+                fut.set_result(task)
+                return fut
+
+        def tasks():
+            for n in range(100):
+                read.append(n)
+                yield n
+
+        results = validator._imap(Executor(), tasks(), 4)
+        assert next(results) == 0 and len(read) == 5
+        assert list(results) == list(range(1, 100))
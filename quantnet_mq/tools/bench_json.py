@@ -0,0 +1,76 @@
+"""
+Benchmark the JSON backends of quantnet_mq.codec on the example messages.
+
+The messages are the node configurations of schema/examples, an RPC
+request and response and a batch of monitor events. orjson also encodes,
+the other backends encode with the json module; "json (before)" is
+json.dumps and json.loads as the messaging layer called them before the
+codec.
+
+Usage:
+  bench_json [options]
+
+Options:
+  -n --repeat=<n>       Encodes and decodes per message and backend [default: 2000]
+  -h --help
+"""
+import gc
+import glob
+import json
+import os
+import time
+from docopt import docopt
+from quantnet_mq import codec
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema", "examples")
+
+
+def messages():
+    msgs = {}
+    for path in sorted(glob.glob(os.path.join(EXAMPLES, "*.json"))):
+        with open(path) as f:
+            msgs[os.path.basename(path)] = json.load(f)
+    msgs["rpc request"] = {"cmd": "getInfo", "agentId": "quantnet-client-0123456789abcdef",
+                           "payload": {"type": "QNode", "parameters": {"verbose": True}}}
+    msgs["rpc response"] = {"status": {"code": 0, "value": "OK", "reason": ""},
+                            "payload": {"exp_id": "4f1c7a2e", "timeslotBase": 1700000000.25,
+                                        "allocations": [{"expName": f"exp{i}", "timeSlot": list(range(i, i + 8))}
+                                                        for i in range(16)]}}
+    msgs["monitor events"] = [{"rid": f"QNode_{i}", "ts": 1700000000.0 + i * 0.125,
+                               "eventType": "agentHeartbeat", "value": i} for i in range(100)]
+    return msgs
+
+
+def measure(func, arg, n):
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(n):
+            func(arg)
+        return n / (time.perf_counter() - start)
+    finally:
+        gc.enable()
+
+
+def main(args):
+    n = int(args["--repeat"])
+    msgs = messages()
+    cases = [("json (before)", lambda m: json.dumps(m).encode("utf-8"), json.loads)]
+    for name in codec.available():
+        codec.use(name)
+        cases.append((name, codec._dumps, codec._loads))
+    codec.use()
+
+    print(f"{'message':<18}{'bytes':>8}  {'backend':<15}{'encode/s':>12}{'decode/s':>12}"
+          f"{'enc MB/s':>10}{'dec MB/s':>10}")
+    for label, msg in msgs.items():
+        for backend, dumps, loads in cases:
+            data = dumps(msg)
+            enc = measure(dumps, msg, n)
+            dec = measure(loads, data, n)
+            print(f"{label:<18}{len(data):>8}  {backend:<15}{enc:>12.0f}{dec:>12.0f}"
+                  f"{enc * len(data) / 1e6:>10.1f}{dec * len(data) / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
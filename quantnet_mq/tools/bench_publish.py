@@ -0,0 +1,94 @@
+"""
+Benchmark PUBLISH encoding with and without publish templates and topic aliases.
+
+Packets are written to an in-memory connection, so the numbers are the
+client side cost of a publish and the bytes that go on the wire.
+
+Usage:
+  bench_publish [options]
+
+Options:
+  -n --messages=<n>     Number of messages per case [default: 100000]
+  --aliases=<n>         Topic alias maximum announced by the broker [default: 16]
+  -h --help
+"""
+import asyncio
+import gc
+import time
+import uuid
+from docopt import docopt
+from gmqtt import Client
+from gmqtt.mqtt.package import PackageFactory, PublishPacket
+from gmqtt.mqtt.protocol import MQTTProtocol
+from quantnet_mq.gmqtt.mqttclient import MQTTClient
+
+CASES = {
+    "rpc request": ("rpc/qn-server", 1,
+                    {"response_topic": "rpc-res/quantnet-client-0123456789abcdef"},
+                    '{"cmd": "getInfo", "agentId": "client", "payload": {}}'),
+    "heartbeat": ("monitor/agentHeartbeat", 0, {},
+                  '{"rid": "QNode_1", "ts": 1700000000.0, "eventType": "agentHeartbeat", "value": 1}'),
+}
+
+
+class MemoryConnection:
+
+    _protocol = MQTTProtocol
+
+    def __init__(self):
+        self.bytes = 0
+
+    def send_package(self, package):
+        self.bytes += len(package)
+
+    def publish(self, message):
+        # gmqtt's encoding, without the transport
+        mid, package = PublishPacket.build_package(message, self._protocol)
+        self.send_package(package)
+        return mid, package
+
+
+class NullStorage:
+    """ acknowledges every message at once, the message ids are reused """
+
+    def push_message_nowait(self, mid, package):
+        PackageFactory.id_generator.free_id(mid)
+
+
+def run_case(client, publish, n, topic, qos, props, payload, corrids):
+    conn = client._connection = MemoryConnection()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for i in range(n):
+            if corrids:
+                publish(client, topic, payload, qos, False, correlation_data=corrids[i], **props)
+            else:
+                publish(client, topic, payload, qos, False, **props)
+        elapsed = time.perf_counter() - start
+    finally:
+        gc.enable()
+    return n / elapsed, conn.bytes / n
+
+
+async def main(args):
+    n = int(args["--messages"])
+    client = MQTTClient("bench")
+    client._persistent_storage = NullStorage()
+    client._connack_properties = {"topic_alias_maximum": [int(args["--aliases"])]}
+    client._clear_topics_aliases()
+    corrids = [uuid.uuid4().hex.encode() for _ in range(n)]
+
+    print(f"{'case':<14}{'mode':<12}{'publish/s':>12}{'bytes/msg':>12}")
+    for name, (topic, qos, props, payload) in CASES.items():
+        ids = corrids if name == "rpc request" else None
+        for mode, publish in (("gmqtt", Client.publish), ("template", MQTTClient.publish)):
+            for _ in range(2):
+                # the first round warms up
+                client._clear_topics_aliases()
+                rate, size = run_case(client, publish, n, topic, qos, props, payload, ids)
+            print(f"{name:<14}{mode:<12}{rate:>12.0f}{size:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(docopt(__doc__)))
@@ -0,0 +1,97 @@
+"""
+Benchmark the TopologyIndex on synthetic topologies.
+
+Usage:
+  bench_topology [options]
+
+Options:
+  -n --nodes=<list>     Comma separated topology sizes [default: 10000,100000]
+  -q --queries=<n>      Number of lookups and path queries per size [default: 10000]
+  --seed=<seed>         Random seed [default: 1]
+  -h --help
+"""
+import gc
+import random
+import time
+from docopt import docopt
+from quantnet_mq.topology import TopologyIndex
+
+
+def make_configs(num_nodes, rng, switch_ratio=0.01, uplinks=2):
+    """ end nodes attached to a sparse switch mesh, every link is declared on both ends """
+    num_switches = max(2, int(num_nodes * switch_ratio))
+    channels = {}
+
+    def link(a, b):
+        ca, cb = channels.setdefault(a, []), channels.setdefault(b, [])
+        ca.append((b, len(cb)))
+        cb.append((a, len(ca) - 1))
+
+    switches = [f"OpticalSwitch_{i}" for i in range(num_switches)]
+    for i in range(num_switches):
+        link(switches[i], switches[(i + 1) % num_switches])
+        link(switches[i], rng.choice(switches))
+    for i in range(num_switches, num_nodes):
+        node = f"{rng.choice(['QNode', 'MNode', 'BSMNode'])}_{i}"
+        channels.setdefault(node, [])
+        for s in rng.sample(switches, uplinks):
+            link(node, s)
+
+    for node, chans in channels.items():
+        yield {
+            "systemSettings": {"type": node.split("_")[0], "name": node, "ID": node, "controlInterface": "localhost"},
+            "channels": [
+                {"ID": str(i), "name": f"channel_{i}", "type": "quantum", "direction": "out",
+                 "wavelength": {"value": 1550, "unit": "nm"}, "power": 1.0,
+                 "neighbor": {"systemRef": remote, "channelRef": str(rc)}}
+                for i, (remote, rc) in enumerate(chans)
+            ]
+        }
+
+
+def timed(fn, n):
+    # like timeit, keep the collector of the large heap out of the numbers
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) / n
+    finally:
+        gc.enable()
+
+
+def bench(num_nodes, queries, rng):
+    configs = list(make_configs(num_nodes, rng))
+    topo = TopologyIndex()
+    rng.shuffle(configs)
+
+    ingest = timed(lambda: [topo.add(c) for c in configs], len(configs))
+    ids = topo.nodes()
+    sample = [rng.choice(ids) for _ in range(queries)]
+    pairs = [(rng.choice(ids), rng.choice(ids)) for _ in range(queries)]
+    sources = [rng.choice(ids) for _ in range(16)]
+    warm_pairs = [(rng.choice(sources), rng.choice(ids)) for _ in range(queries)]
+
+    node = timed(lambda: [topo.node(n) for n in sample], queries)
+    nbrs = timed(lambda: [topo.neighbors(n) for n in sample], queries)
+    peer = timed(lambda: [topo.peer(n, "0") for n in sample], queries)
+    cold = timed(lambda: [topo.shortest_path(a, b) for a, b in pairs[:100]], 100)
+    for src in sources:
+        topo.shortest_path(src, ids[0])
+    warm = timed(lambda: [topo.shortest_path(a, b) for a, b in warm_pairs], queries)
+
+    churn = [topo.node(n) for n in sample[:1000]]
+    update = timed(lambda: [(topo.remove(c["systemSettings"]["ID"]), topo.add(c)) for c in churn], len(churn))
+    assert not topo.dangling()
+
+    print(f"{num_nodes:>8} nodes: ingest {ingest * 1e6:8.1f} us/node, node {node * 1e9:6.0f} ns, "
+          f"neighbors {nbrs * 1e9:6.0f} ns, peer {peer * 1e9:6.0f} ns, "
+          f"path cold {cold * 1e3:7.2f} ms, warm {warm * 1e6:6.1f} us, "
+          f"re-register {update * 1e6:6.1f} us")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    rng = random.Random(int(args["--seed"]))
+    for n in args["--nodes"].split(","):
+        bench(int(n), int(args["--queries"]), rng)
@@ -0,0 +1,89 @@
+"""
+Record MQTT traffic to a capture log, replay or inspect it.
+
+Usage:
+  capture record [options] <log> <topic>...
+  capture replay [options] <log>
+  capture info <log>
+
+Options:
+  --host=<host>          MQTT broker host [default: 127.0.0.1]
+  --port=<port>          MQTT broker port [default: 1883]
+  --username=<user>      MQTT username [default: ]
+  --password=<pass>      MQTT password [default: ]
+  --duration=<s>         Seconds to record for, until interrupted if not set
+  --speed=<x>            Replay speed relative to the recording, 0 for as fast as possible [default: 1]
+  --remap=<list>         Topic prefixes to rename, e.g. monitor/=replay/monitor/,rpc/qn-server=rpc/test
+  --start=<s>            Replay the messages from start seconds into the recording
+  --end=<s>              Replay the messages until end seconds into the recording
+  -h --help
+"""
+import asyncio
+import uuid
+from collections import Counter
+from docopt import docopt
+from quantnet_mq.capture import Recorder, CaptureLog
+from quantnet_mq.gmqtt.mqttclient import MQTTClient
+
+
+async def connect(args):
+    client = MQTTClient(f"quantnet-capture-{uuid.uuid4().hex}")
+    client.set_auth_credentials(args["--username"], args["--password"])
+    await client.connect(host=args["--host"], port=int(args["--port"]))
+    return client
+
+
+async def record(args):
+    client = await connect(args)
+    with Recorder(args["<log>"]) as recorder:
+        recorder.subscribe(client, *args["<topic>"])
+        try:
+            if args["--duration"]:
+                await asyncio.sleep(float(args["--duration"]))
+            else:
+                await asyncio.Event().wait()
+        finally:
+            await client.disconnect()
+            print(f"recorded {recorder.messages} messages")
+
+
+async def replay(args):
+    remap = {}
+    for entry in filter(None, (args["--remap"] or "").split(",")):
+        old, _, new = entry.partition("=")
+        remap[old] = new
+    start = float(args["--start"]) if args["--start"] else None
+    end = float(args["--end"]) if args["--end"] else None
+    client = await connect(args)
+    with CaptureLog(args["<log>"]) as log:
+        n = await log.replay(client, float(args["--speed"]), remap, start, end)
+    await client.disconnect()
+    print(f"replayed {n} messages")
+
+
+def info(args):
+    with CaptureLog(args["<log>"]) as log:
+        topics = Counter()
+        size = 0
+        for msg in log:
+            topics[msg.topic] += 1
+            size += len(msg.payload)
+        times = log.index()[0]
+        duration = times[-1] - times[0] if times else 0.0
+        print(f"{len(times)} messages, {size} payload bytes over {duration:.3f}s")
+        for topic, n in topics.most_common():
+            print(f"  {topic:<50}{n:>10}")
+
+
+def main():
+    args = docopt(__doc__)
+    if args["info"]:
+        info(args)
+    elif args["record"]:
+        asyncio.run(record(args))
+    else:
+        asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()
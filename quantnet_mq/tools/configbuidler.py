@@ -1,13 +1,30 @@
 """
-Copyright ESnet 2023 - 
-
+Copyright ESnet 2023 -
+
+Usage:
+  configbuidler [options]
+
+Options:
+  -s --switches=<n>     Number of optical switches [default: 3]
+  -n --nodes=<n>        Number of end nodes [default: 5]
+  -o --out-dir=<dir>    Output directory [default: /tmp/quantnet_nodes]
+  -m --model=<model>    Graph model: erdos_renyi, gnp, barabasi_albert, regular [default: erdos_renyi]
+  -d --degree=<d>       Average degree for the sparse graph models [default: 3]
+  -u --uplinks=<k>      Maximum switch uplinks per end node
+  -w --workers=<w>      Number of serializer processes (default: one per core)
+  -f --format=<fmt>     Output format: files or jsonl [default: files]
+  --seed=<seed>         Random seed
+  --headless            Do not print configs or plot the topology
+  --no-validate         Do not validate the generated configs against the schema
+  -h --help
 """
 import os
 import shutil
-import networkx as nx
-import json
-import matplotlib.pyplot as plt
 import random
+import json
+import multiprocessing
+import networkx as nx
+import quantnet_mq
 from quantnet_mq.schema.models import (
     QNode,
     MNode,
@@ -15,14 +32,150 @@ from quantnet_mq.schema.models import (
     OpticalSwitch)
 
 
+EXAMPLE_DIR = os.path.join(os.path.dirname(quantnet_mq.__file__), "schema/examples")
+
+NODE_CLASSES = {
+    "QNode": QNode,
+    "MNode": MNode,
+    "BSMNode": BSMNode,
+    "OpticalSwitch": OpticalSwitch
+}
+
+DEFAULT_CONFIG_FILES = {
+    "QNode": "q.json",
+    "MNode": "m.json",
+    "BSMNode": "bsm.json",
+    "OpticalSwitch": "switch.json"
+}
+
+GRAPH_MODELS = ("erdos_renyi", "gnp", "barabasi_albert", "regular")
+
+# below this many nodes the process pool costs more than it saves
+PARALLEL_MIN_NODES = 256
+
+
+def _render_node(spec):
+    """ Build and serialize one node configuration.
+
+    Runs in the serializer processes, so it only takes plain data:
+    (node, class_name, [(neighbor_id, neighbor_type, neighbor_channel), ...], indent, validate)
+    """
+    node, class_name, neighbors, indent, validate = spec
+    default_config = ConfigBuilder.load_default_config(class_name)
+
+    node_config = {}
+    node_config['systemSettings'] = {'name': f"{class_name}_{node}",
+                                     'ID': f'{class_name}_{node}',
+                                     'type': f'{class_name}',
+                                     'controlInterface': 'localhost'}
+
+    if class_name == "QNode":
+        node_config['qubitSettings'] = default_config['qubitSettings']
+        node_config['matterLightInterfaceSettings'] = default_config['matterLightInterfaceSettings']
+
+    if class_name == 'BSMNode' or class_name == 'MNode':
+        node_config['quantumSettings'] = default_config['quantumSettings']
+
+    channels = []
+    for index, (neighbor_id, neighbor_type, neighbor_channel) in enumerate(neighbors):
+        channels.append(
+            {
+                "ID": f'{index}',
+                "name": f"channel_{index}",
+                "type": "quantumconnection",
+                "direction": "out",
+                "wavelength": {"value": 1550,  "unit": "nm"},
+                "power": 12.1,
+                "neighbor": {
+                    "idRef": f"urn:quant-net:{neighbor_id}:{neighbor_channel}",
+                    "systemRef": neighbor_id,
+                    "channelRef": f"{neighbor_channel}",
+                    "type": neighbor_type,
+                    "loss": {"value": 5,  "unit": "dB"}
+                }
+            }
+        )
+    node_config['channels'] = channels
+
+    if validate:
+        # the generated classes validate on construction
+        data = NODE_CLASSES[class_name](**node_config).serialize()
+        if indent is not None:
+            data = json.dumps(json.loads(data), indent=indent)
+    else:
+        data = json.dumps(node_config, indent=indent)
+    return f"{class_name}_{node}", data
+
+
 class ConfigBuilder:
-    def __init__(self, num_switches=1, num_nodes=5, out_dir="/tmp/quantnet_nodes"):
+    """ Generate random node configurations and their topology graph.
+
+    Parameters
+    ----------
+    num_switches: int
+        Number of optical switches, the end nodes are attached to them
+    num_nodes: int
+        Number of end nodes (QNode, MNode, BSMNode)
+    out_dir: str
+        Directory the configurations are written to
+    seed: int
+        Seed for the graph and node type generation, for reproducible topologies
+    model: str
+        One of GRAPH_MODELS. ``erdos_renyi`` is the dense O(n^2) model, the
+        others are sparse and scale to 100k nodes
+    edge_prob: float
+        Edge probability of the ``erdos_renyi`` model
+    avg_degree: int
+        Average degree of the sparse models
+    max_uplinks: int
+        Maximum number of switches an end node is attached to, defaults to
+        all switches for ``erdos_renyi`` and ``avg_degree`` otherwise
+    workers: int
+        Number of serializer processes, defaults to the number of cores
+    output: str
+        ``files`` writes one file per node, ``jsonl`` one bundle ``nodes.jsonl``
+    indent: int
+        Indentation of the written JSON, None for compact output
+    plot: bool
+        Draw the topology graph, skipped above ``plot_max_nodes`` nodes
+    verbose: bool
+        Print every generated configuration
+    validate: bool
+        Validate every configuration against its schema class, this dominates
+        the generation time of large topologies
+    """
+
+    _DEFAULT_CONFIGS = {}
+
+    def __init__(self, num_switches=1, num_nodes=5, out_dir="/tmp/quantnet_nodes", seed=None,
+                 model="erdos_renyi", edge_prob=0.6, avg_degree=3, max_uplinks=None, workers=None,
+                 output="files", indent=4, plot=True, plot_max_nodes=200, verbose=True,
+                 validate=True):
+        if model not in GRAPH_MODELS:
+            raise ValueError(f"unknown graph model {model}")
+        if output not in ("files", "jsonl"):
+            raise ValueError(f"unknown output format {output}")
         self._num_switches = num_switches
         self._num_nodes = num_nodes
         self._outdir = out_dir
+        self._seed = seed
+        self._rng = random.Random(seed)
+        self._model = model
+        self._edge_prob = edge_prob
+        self._avg_degree = avg_degree
+        # the legacy model attaches an end node to up to every switch
+        self._max_uplinks = max_uplinks or (num_switches if model == "erdos_renyi" else avg_degree)
+        self._workers = workers or os.cpu_count() or 1
+        self._output = output
+        self._indent = indent
+        self._plot = plot
+        self._plot_max_nodes = plot_max_nodes
+        self._verbose = verbose
+        self._validate = validate
 
     @staticmethod
-    def draw_and_save_graph(g, dirpath=None):
+    def draw_and_save_graph(g, dirpath=None, show=True):
+        import matplotlib.pyplot as plt
 
         pos = nx.spring_layout(g)
         color_map = {
@@ -46,7 +199,9 @@ class ConfigBuilder:
         plt.title("Topology with Additional Randomly Added Nodes")
         if dirpath:
             plt.savefig(f"{dirpath}/topo.png")
-        plt.show()
+        if show:
+            plt.show()
+        plt.close()
 
     @staticmethod
     def delete_and_mkdir(dir_path):
@@ -68,24 +223,19 @@ class ConfigBuilder:
 
     @staticmethod
     def load_default_config(node_type: str) -> dict:
-        if node_type == "QNode":
-            f = "../schema/examples/q.json"
-        elif node_type == "MNode":
-            f = "../schema/examples/m.json"
-        elif node_type == "BSMNode":
-            f = "../schema/examples/bsm.json"
-        elif node_type == "OpticalSwitch":
-            f = "../schema/examples/switch.json"
-        else:
+        """ Return the example configuration of a node type.
+
+        The file is read once per process, the returned dict is shared and must not be modified.
+        """
+        conf = ConfigBuilder._DEFAULT_CONFIGS.get(node_type)
+        if conf is not None:
+            return conf
+        if node_type not in DEFAULT_CONFIG_FILES:
             raise Exception(f"unknown configuration type {node_type}")
 
-        with open(f, 'r') as nf:
-            data = nf.read()
-        try:
-            conf = json.loads(data)
-        except Exception as e:
-            raise(e)
-
+        with open(os.path.join(EXAMPLE_DIR, DEFAULT_CONFIG_FILES[node_type]), 'r') as nf:
+            conf = json.load(nf)
+        ConfigBuilder._DEFAULT_CONFIGS[node_type] = conf
         return conf
 
     @staticmethod
@@ -101,110 +251,142 @@ class ConfigBuilder:
 
         return result
 
-    def build(self):
+    def _make_graph(self, n):
+        """ create a random graph with the configured model """
+        seed = self._rng.randrange(2**32)
+        if self._model == "erdos_renyi":
+            return nx.erdos_renyi_graph(n, self._edge_prob, seed=seed)
+        degree = max(1, min(self._avg_degree, n - 1))
+        if self._model == "gnp":
+            return nx.fast_gnp_random_graph(n, degree / max(1, n - 1), seed=seed)
+        if self._model == "barabasi_albert":
+            return nx.barabasi_albert_graph(n, max(1, min(degree // 2, n - 1)), seed=seed)
+        # a regular graph needs n * d to be even
+        if (n * degree) % 2:
+            degree -= 1
+        return nx.random_regular_graph(degree, n, seed=seed)
+
+    def build_graph(self):
+        """ create the topology graph, nodes are annotated with their node_type """
+        rng = self._rng
         # Create the switch topology
         if self._num_switches > 0:
-            g = switches = nx.erdos_renyi_graph(self._num_switches, 0.6)
+            g = self._make_graph(self._num_switches)
             for node in g.nodes():
-                g.nodes[node]['node_type'] = f'type_{random.choice(["OpticalSwitch"])}'
-
-            # self.draw_and_save_graph(switches)
-
-        # Add More Nodes Randomly
-        if self._num_switches > 0:
-            switch_nodes = list(switches.nodes())
-            for i in range(len(switches), len(switches) + self._num_nodes):
-                g.add_node(i, node_type=f'type_{random.choice(["QNode", "MNode", "BSMNode"])}')
-
-                num_edges = random.randint(1, self._num_switches)
-                # existing_nodes = list(switches.nodes())
-                random.shuffle(switch_nodes)
-                for j in range(num_edges):
-                    g.add_edge(i, switch_nodes[j])
+                g.nodes[node]['node_type'] = 'type_OpticalSwitch'
+
+            # Add More Nodes Randomly
+            switch_nodes = list(g.nodes())
+            max_uplinks = max(1, min(self._max_uplinks, self._num_switches))
+            for i in range(len(switch_nodes), len(switch_nodes) + self._num_nodes):
+                g.add_node(i, node_type=f'type_{rng.choice(["QNode", "MNode", "BSMNode"])}')
+                num_edges = rng.randint(1, max_uplinks)
+                for j in rng.sample(switch_nodes, num_edges):
+                    g.add_edge(i, j)
         else:
-            g = nx.erdos_renyi_graph(self._num_nodes, 0.6)
+            g = self._make_graph(self._num_nodes)
 
             # Assign types to new nodes
             for node in g.nodes():
-                g.nodes[node]['node_type'] = f'type_{random.choice(["QNode", "MNode", "BSMNode"])}'
+                g.nodes[node]['node_type'] = f'type_{rng.choice(["QNode", "MNode", "BSMNode"])}'
 
         # TODO: mnode require at least two neighbors
-        mnodes = [node for node in g.nodes() if g.nodes[node]['node_type'] == 'type_MNode']
-        for node in mnodes:
-            if len(list(g.neighbors(node))) < 2:
-                g.nodes[node]['node_type'] = f'type_{random.choice(["QNode","BSMNode"])}'
+        for node in g.nodes():
+            if g.nodes[node]['node_type'] == 'type_MNode' and g.degree(node) < 2:
+                g.nodes[node]['node_type'] = f'type_{rng.choice(["QNode", "BSMNode"])}'
 
-        self.delete_and_mkdir(self._outdir)
+        return g
 
-        for node in g.nodes():
-            class_name = self.get_type(g.nodes[node]['node_type'])
-            nodeClass = globals().get(class_name)
-            node_config = nodeClass()
+    def _node_specs(self, g):
+        """ yield the plain-data description of every node for _render_node """
+        types = {node: self.get_type(g.nodes[node]['node_type']) for node in g.nodes()}
+        adjacency = {node: list(g.neighbors(node)) for node in g.nodes()}
+        # channel index of each link on the remote side
+        ports = {}
+        for node, neighbors in adjacency.items():
+            for index, neighbor in enumerate(neighbors):
+                ports[(node, neighbor)] = index
+
+        # one record per line in the bundle
+        indent = None if self._output == "jsonl" else self._indent
+        for node, neighbors in adjacency.items():
+            yield (node,
+                   types[node],
+                   [(f"{types[n]}_{n}", types[n], ports[(n, node)]) for n in neighbors],
+                   indent,
+                   self._validate)
+
+    def write_configs(self, g):
+        """ serialize the node configurations of g and stream them to the output directory """
+        specs = self._node_specs(g)
+        if self._workers > 1 and len(g) >= PARALLEL_MIN_NODES:
+            pool = multiprocessing.Pool(self._workers)
+            chunksize = max(1, min(256, len(g) // (self._workers * 4)))
+            results = pool.imap(_render_node, specs, chunksize=chunksize)
+        else:
+            pool = None
+            results = map(_render_node, specs)
 
-            default_config = self.load_default_config(class_name)
+        bundle = None
+        try:
+            if self._output == "jsonl":
+                bundle = open(os.path.join(self._outdir, "nodes.jsonl"), 'w')
+            for name, data in results:
+                if bundle:
+                    bundle.write(data)
+                    bundle.write("\n")
+                else:
+                    with open(os.path.join(self._outdir, f"{name}.json"), 'w') as f:
+                        f.write(data)
+                if self._verbose:
+                    print(data)
+        finally:
+            if bundle:
+                bundle.close()
+            if pool:
+                pool.close()
+                pool.join()
 
-            node_config.systemSettings = {'name': f"{class_name}_{node}",
-                                          'ID': f'{class_name}_{node}',
-                                          'type': f'{class_name}',
-                                          'controlInterface': 'localhost'}
+    def build(self):
+        g = self.build_graph()
 
-            neighbors = list(g.neighbors(node))
-            channels = []
-            for index, neighbor in enumerate(neighbors):
-                channels.append(
-                    {
-                        "ID": f'{index}',
-                        "name": f"channel_{index}",
-                        "type": "quantumconnection",
-                        "direction": "out",
-                        "wavelength": {"value": 1550,  "unit": "nm"},
-                        "power": 12.1,
-                        "neighbor": {
-                            "idRef": f"urn:quant-net:f{neighbor}:{index}",
-                            "systemRef": f"{neighbor}",
-                            "channelRef": f"{index}",
-                            "loss": {"value": 5,  "unit": "dB"}
-                        }
-                    }
-                )
-            node_config.channels = channels
-
-            if class_name == 'BSMNode' or class_name == 'MNode':
-                detectors = []
-                for index, neighbor in enumerate(neighbors):
-                    detectors.append(
-                        {
-                            "name": f"detector_{index}",
-                            "efficiency": "0.99",
-                            "darkCount": "1",
-                            "countRate": {"value": 1000,  "unit": "Hz"},
-                            "timeResolution": {"value": 100,  "unit": "ns"}
-                        }
-                    )
-                node_config.quantumSettings = default_config['quantumSettings']
-
-            if class_name == "QNode":
-                node_config.qubitSettings = default_config['qubitSettings']
-
-                node_config.matterLightInterfaceSettings = default_config['matterLightInterfaceSettings']
-
-            file_path = f'{self._outdir}/{class_name}_{node}.json'
-            data = json.loads(node_config.serialize())
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=4)
-
-            print(json.dumps(node_config.serialize(), indent=4))
+        self.delete_and_mkdir(self._outdir)
+        self.write_configs(g)
 
         # draw and save the topology graph
-        self.draw_and_save_graph(g, self._outdir)
+        if self._plot:
+            if len(g) <= self._plot_max_nodes:
+                self.draw_and_save_graph(g, self._outdir)
+            else:
+                print(f"Topology has {len(g)} nodes, not plotting above {self._plot_max_nodes}")
 
         return g
 
 
-# This block will only execute if the script is run directly
-if __name__ == "__main__":
-    # Create an instance of ConfigBuilder
-    builder = ConfigBuilder(num_switches=3, num_nodes=5, out_dir="/tmp/quantnet_nodes")
+def main(argv=None):
+    from docopt import docopt
+
+    args = docopt(__doc__, argv=argv)
+    headless = args.get("--headless")
+    builder = ConfigBuilder(num_switches=int(args.get("--switches")),
+                            num_nodes=int(args.get("--nodes")),
+                            out_dir=args.get("--out-dir"),
+                            seed=int(args["--seed"]) if args.get("--seed") else None,
+                            model=args.get("--model"),
+                            avg_degree=int(args.get("--degree")),
+                            max_uplinks=int(args["--uplinks"]) if args.get("--uplinks") else None,
+                            workers=int(args["--workers"]) if args.get("--workers") else None,
+                            output=args.get("--format"),
+                            indent=None if headless else 4,
+                            plot=not headless,
+                            verbose=not headless,
+                            validate=not args.get("--no-validate"))
     # Call the build method
-    builder.build()
+    g = builder.build()
     print("completed!")
+    return g
+
+
+# This block will only execute if the script is run directly
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""
+Schema-driven synthetic traffic generator.
+
+Generates random valid instances of the package schema objects and drives
+them at an open-loop rate, RPC commands through an RPCClient and other
+messages, e.g. MonitorEvent, through a MsgClient. A mix entry is an object
+with an optional weight, e.g. getInfo=5 experiment.submit=1 MonitorEvent=20.
+
+Usage:
+  loadgen sample [options] <object>...
+  loadgen run [options] <mix>...
+
+Options:
+  -r --rate=<r>          Target messages per second [default: 100]
+  -d --duration=<s>      Seconds to send for [default: 10]
+  -n --count=<n>         Instances per object in sample mode [default: 1]
+  --items=<n>            Array length, a number or a range like 1-4 [default: 1-4]
+  --items-for=<list>     Array lengths of named properties, e.g. allocations=64,qubits=2
+  --agents=<n>           Number of simulated agents used as agentId, rid and node IDs [default: 100]
+  --topic=<topic>        RPC topic [default: rpc/qn-server]
+  --monitor-topic=<t>    Topic of the non RPC messages [default: monitor/loadgen]
+  --timeout=<s>          RPC timeout in seconds [default: 5]
+  --host=<host>          MQTT broker host [default: 127.0.0.1]
+  --port=<port>          MQTT broker port [default: 1883]
+  --username=<user>      MQTT username [default: ]
+  --password=<pass>      MQTT password [default: ]
+  --seed=<seed>          Random seed
+  --json                 Print the report as JSON
+  -h --help
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import Counter
+from docopt import docopt
+from quantnet_mq import Code
+from quantnet_mq.schema.scripts.validator import SchemaCatalog, NODE_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 12
+MAX_ATTEMPTS = 20
+# instances generated before a run, sent again in turn by longer runs
+MAX_POOL = 10000
+
+
+def parse_range(spec):
+    lo, _, hi = str(spec).partition("-")
+    return int(lo), int(hi or lo)
+
+
+class InstanceGenerator:
+    """ Random instances of the schema objects of a SchemaCatalog
+
+    Instances follow the schema (types, required and optional properties,
+    enums, oneOf and minItems) with values picked to look like real traffic:
+    agent names for agentId, rid and node IDs, node configurations whose
+    systemSettings.type matches their schema and current timestamps. Every
+    instance is validated and generated again if invalid.
+
+    Parameters
+    ----------
+    catalog: SchemaCatalog
+        The schema objects
+    rng: random.Random
+        Random source
+    items: tuple
+        (min, max) length of arrays
+    items_for: dict
+        (min, max) length of the arrays of named properties
+    agents: int
+        Number of agent names to pick from
+    """
+
+    def __init__(self, catalog=None, rng=None, items=(1, 4), items_for=None, agents=100):
+        self._catalog = catalog or SchemaCatalog()
+        self._rng = rng or random.Random()
+        self._items = items
+        self._items_for = items_for or {}
+        self._agents = [f"{NODE_TYPES[i % len(NODE_TYPES)]}_{i}" for i in range(max(1, agents))]
+        self._schemas = {}
+        self.invalid = 0
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    def agent(self, node_type=None):
+        """ a random agent name, of a node of node_type if given """
+        if node_type is None:
+            return self._rng.choice(self._agents)
+        names = [a for a in self._agents if a.startswith(f"{node_type}_")]
+        return self._rng.choice(names) if names else f"{node_type}_{self._rng.randint(0, 999)}"
+
+    def generate(self, obj):
+        """ return a valid random instance of a schema object """
+        schema = self._schemas.get(obj)
+        if schema is None:
+            schema = self._schemas[obj] = self._catalog.schema(obj)
+        validator = self._catalog.validator(obj)
+        for _ in range(MAX_ATTEMPTS):
+            instance = self._value(schema, None, {"cmd": obj.rsplit(".", 1)[-1]}, 0)
+            # a node configuration also matches the looser OpticalSwitch schema,
+            # a oneOf matched by more than one branch is accepted
+            if all(e.validator == "oneOf" and not e.context for e in validator.iter_errors(instance)):
+                return instance
+            self.invalid += 1
+        raise ValueError(f"could not generate a valid {obj}")
+
+    def _value(self, schema, name, ctx, depth):
+        rng = self._rng
+        if not isinstance(schema, dict) or depth > MAX_DEPTH or "$ref" in schema:
+            # recursive references are cut off
+            return None
+        if "enum" in schema:
+            if name == "type" and ctx.get("node_type") in schema["enum"]:
+                return ctx["node_type"]
+            return rng.choice(schema["enum"])
+        for key in ("oneOf", "anyOf"):
+            if key in schema:
+                branch = rng.choice(schema[key])
+                if isinstance(branch, dict) and list(branch) == ["required"]:
+                    # a branch only requiring some properties of the object, e.g. timeSlot or slotMap
+                    rest = {k: v for k, v in schema.items() if k != key}
+                    branch = dict(rest, required=rest.get("required", []) + branch["required"])
+                return self._value(branch, name, ctx, depth + 1)
+        if "allOf" in schema:
+            value = {}
+            for sub in schema["allOf"]:
+                part = self._value(sub, name, ctx, depth + 1)
+                if isinstance(part, dict):
+                    value.update(part)
+            return value
+
+        typ = schema.get("type")
+        if isinstance(typ, list):
+            typ = rng.choice(typ)
+        if typ is None:
+            typ = "object" if "properties" in schema else "string"
+        if typ == "object":
+            return self._object(schema, ctx, depth)
+        if typ == "array":
+            lo, hi = self._items_for.get(name, self._items)
+            lo = max(lo, schema.get("minItems", 0))
+            hi = max(lo, min(hi, schema.get("maxItems", hi)))
+            items = schema.get("items", {})
+            if isinstance(items, list):
+                return [self._value(s, name, ctx, depth + 1) for s in items]
+            return [self._value(items, name, ctx, depth + 1) for _ in range(rng.randint(lo, hi))]
+        if typ == "string":
+            return self._string(name, ctx)
+        if typ == "integer":
+            lo, hi = schema.get("minimum", 0), schema.get("maximum", 1000)
+            return rng.randint(int(lo), int(hi))
+        if typ == "number":
+            if name == "ts" or name and name.endswith("Time"):
+                return time.time()
+            return round(rng.uniform(schema.get("minimum", 0.0), schema.get("maximum", 1000.0)), 6)
+        if typ == "boolean":
+            return rng.random() < 0.5
+        return None
+
+    def _object(self, schema, ctx, depth):
+        props = schema.get("properties", {})
+        required = set(schema.get("required", ()))
+        if schema.get("title") in NODE_TYPES:
+            ctx = dict(ctx, node_type=schema["title"], node=self.agent(schema["title"]))
+        value = {}
+        for key, sub in props.items():
+            if key in required or self._rng.random() < 0.5:
+                v = self._value(sub, key, dict(ctx, system=True) if key == "systemSettings" else ctx, depth + 1)
+                if v is not None or key in required:
+                    value[key] = v
+        return value
+
+    def _string(self, name, ctx):
+        rng = self._rng
+        if name == "cmd":
+            return ctx["cmd"]
+        if name in ("agentId", "rid", "systemRef"):
+            return self.agent()
+        if name == "ID" and ctx.get("system"):
+            return ctx["node"]
+        if name == "name" and ctx.get("system"):
+            return ctx["node"].lower()
+        if name == "controlInterface":
+            return f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        if name and name.endswith("id") or name == "ID":
+            return f"{rng.getrandbits(64):016x}"
+        return f"{name or 'value'}-{rng.randint(0, 9999)}"
+
+
+class LoadReport:
+    """ Sent messages, RPC latencies and response codes of a run """
+
+    def __init__(self):
+        self.sent = Counter()
+        self.codes = Counter()
+        self.latencies = []
+        self.late = 0
+        self.elapsed = 0.0
+
+    def result(self, latency, code):
+        self.codes[code] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def as_dict(self):
+        total = sum(self.sent.values())
+        return {
+            "sent": dict(self.sent),
+            "rate": total / self.elapsed if self.elapsed else 0.0,
+            "late": self.late,
+            "codes": dict(self.codes),
+            "latency": {f"p{p}": self.percentile(p) for p in (50, 90, 99, 99.9)} | {
+                "max": max(self.latencies) if self.latencies else None},
+        }
+
+    def __str__(self):
+        d = self.as_dict()
+        lines = [f"achieved rate: {d['rate']:.1f} msg/s over {self.elapsed:.1f}s ({d['late']} sends were late)"]
+        for obj, n in sorted(self.sent.items()):
+            lines.append(f"  {obj:<30}{n:>10}")
+        lines.append("responses:")
+        for code, n in sorted(self.codes.items()):
+            lines.append(f"  {code:<30}{n:>10}")
+        lines.append("latency (ms):")
+        for k, v in d["latency"].items():
+            lines.append(f"  {k:<30}{'-' if v is None else f'{v * 1000:.2f}':>10}")
+        return "\n".join(lines)
+
+
+def _code(body):
+    """ name of the status code of a response body """
+    try:
+        code = json.loads(body)["status"]["code"]
+        return Code(code).name
+    except (ValueError, KeyError, TypeError):
+        return "NO_STATUS"
+
+
+class LoadDriver:
+    """ Open-loop sender of a weighted mix of schema objects
+
+    Objects with a cmd property are sent as RPC requests, others are
+    published. Sends are scheduled at fixed intervals whatever the response
+    times, a send that could not keep its slot is counted as late. The
+    instances are generated and validated before the timed part of the run,
+    which waits for every response or its timeout at the end.
+    """
+
+    def __init__(self, generator, mix, rpcclient=None, msgclient=None, topic=None,
+                 monitor_topic="monitor/loadgen", timeout=5.0):
+        self._gen = generator
+        self._objects = list(mix)
+        self._weights = [mix[o] for o in self._objects]
+        self._rpcclient = rpcclient
+        self._msgclient = msgclient
+        self._topic = topic
+        self._monitor_topic = monitor_topic
+        self._timeout = timeout
+        self._rpc = {}
+        for obj in self._objects:
+            schema = generator.catalog.schema(obj)
+            self._rpc[obj] = "cmd" in schema.get("properties", {})
+            if self._rpc[obj] and rpcclient is not None:
+                rpcclient.set_handler(obj.rsplit(".", 1)[-1], lambda body: body, generator.catalog.classpath(obj))
+        self._pending = set()
+        self.report = LoadReport()
+
+    def pregenerate(self, n, rng):
+        """ n (object, instance) pairs picked from the mix """
+        return [(obj, self._gen.generate(obj)) for obj in rng.choices(self._objects, self._weights, k=n)]
+
+    async def _send(self, obj, instance, loop):
+        self.report.sent[obj] += 1
+        if not self._rpc[obj]:
+            await self._msgclient.publish(self._monitor_topic, instance)
+            return
+        start = loop.time()
+
+        def done(fut):
+            self._pending.discard(fut)
+            if fut.cancelled():
+                self.report.result(None, "CANCELLED")
+            elif isinstance(fut.exception(), TimeoutError):
+                self.report.result(None, "TIMEOUT")
+            elif fut.exception() is not None:
+                self.report.result(None, type(fut.exception()).__name__)
+            else:
+                self.report.result(loop.time() - start, _code(fut.result()))
+
+        fut = await self._rpcclient.call(obj.rsplit(".", 1)[-1], instance["payload"], timeout=self._timeout,
+                                         topic=self._topic, sync=False, on_error=lambda e: None)
+        self._pending.add(fut)
+        fut.add_done_callback(done)
+
+    async def run(self, rate, duration):
+        loop = asyncio.get_running_loop()
+        rng = random.Random(self._gen._rng.random())
+        interval = 1.0 / rate
+        pool = self.pregenerate(max(1, min(MAX_POOL, int(rate * duration) + 1)), rng)
+        start = loop.time()
+        n = 0
+        while True:
+            now = loop.time()
+            if now - start >= duration:
+                break
+            due = start + n * interval
+            if due > now:
+                await asyncio.sleep(due - now)
+            elif now - due > interval:
+                self.report.late += 1
+            await self._send(*pool[n % len(pool)], loop)
+            n += 1
+        self.report.elapsed = loop.time() - start
+        if self._pending:
+            # every request times out after self._timeout, the margin only guards against lost futures
+            await asyncio.wait(set(self._pending), timeout=self._timeout + 1.0)
+        return self.report
+
+
+def parse_mix(entries):
+    mix = {}
+    for entry in entries:
+        obj, _, weight = entry.partition("=")
+        mix[obj] = float(weight or 1)
+    return mix
+
+
+def make_generator(args):
+    items_for = {}
+    for entry in filter(None, (args["--items-for"] or "").split(",")):
+        name, _, n = entry.partition("=")
+        items_for[name] = parse_range(n)
+    rng = random.Random(None if args["--seed"] is None else int(args["--seed"]))
+    return InstanceGenerator(SchemaCatalog(), rng, parse_range(args["--items"]), items_for, int(args["--agents"]))
+
+
+async def run(args, gen):
+    from quantnet_mq.rpcclient import RPCClient
+    from quantnet_mq.msgclient import MsgClient
+
+    mix = parse_mix(args["<mix>"])
+    conn = {"host": args["--host"], "port": int(args["--port"]),
+            "username": args["--username"], "password": args["--password"]}
+    rpcclient = RPCClient("loadgen", topic=args["--topic"], **conn)
+    msgclient = MsgClient("loadgen", **conn)
+    driver = LoadDriver(gen, mix, rpcclient, msgclient, args["--topic"], args["--monitor-topic"],
+                        float(args["--timeout"]))
+    await rpcclient.start()
+    await msgclient.start()
+    try:
+        report = await driver.run(float(args["--rate"]), float(args["--duration"]))
+    finally:
+        await rpcclient.stop()
+        await msgclient.stop()
+    print(json.dumps(report.as_dict()) if args["--json"] else report)
+
+
+def main():
+    args = docopt(__doc__)
+    gen = make_generator(args)
+    if args["sample"]:
+        for obj in args["<object>"]:
+            for _ in range(int(args["--count"])):
+                sys.stdout.write(json.dumps(gen.generate(obj)) + "\n")
+        return
+    asyncio.run(run(args, gen))
+
+
+if __name__ == "__main__":
+    main()
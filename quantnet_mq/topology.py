@@ -0,0 +1,241 @@
+import logging
+from collections import OrderedDict, deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class Link:
+    """ A channel of a node and the remote end given by its neighbor reference """
+
+    __slots__ = ("node", "channel", "remote", "remote_channel", "resolved")
+
+    def __init__(self, node, channel, remote, remote_channel):
+        self.node = node
+        self.channel = channel
+        self.remote = remote
+        self.remote_channel = remote_channel
+        self.resolved = False
+
+    def __repr__(self):
+        return f"Link({self.node}:{self.channel} -> {self.remote}:{self.remote_channel})"
+
+
+class TopologyIndex:
+    """ Incremental in-memory index of the node configurations.
+
+    Nodes are added from QNode, MNode, BSMNode or OpticalSwitch configurations
+    (dicts or schema objects) or from register/deregister messages. Adjacency
+    comes from ``channels[].neighbor.systemRef`` and ``channelRef``; a reference
+    to a node or channel that is not known is dangling and becomes resolved as
+    soon as its target is added. Node, channel and neighbor lookups are O(1),
+    shortest paths are cached until the adjacency changes.
+
+    Parameters
+    ----------
+    path_cache_size: int
+        Number of single source shortest path trees kept in the cache, a tree
+        holds an entry per reachable node
+    """
+
+    def __init__(self, path_cache_size=64):
+        self._nodes = {}
+        self._types = {}
+        self._channels = {}
+        self._links = {}
+        self._referrers = {}
+        self._adj = {}
+        self._dangling = set()
+        self._agents = {}
+        self._path_cache = OrderedDict()
+        self._path_cache_size = path_cache_size
+        self._version = 0
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self._nodes
+
+    @property
+    def version(self):
+        """ incremented whenever the adjacency changes """
+        return self._version
+
+    @staticmethod
+    def _as_dict(config):
+        if hasattr(config, "as_dict"):
+            return config.as_dict()
+        if not isinstance(config, dict):
+            raise TypeError("config must be a dict or a schema object")
+        return config
+
+    def add(self, config):
+        """ add or replace a node configuration, returns the node ID """
+        config = self._as_dict(config)
+        try:
+            node_id = str(config["systemSettings"]["ID"])
+        except (KeyError, TypeError):
+            raise ValueError("node configuration has no systemSettings.ID")
+        if node_id in self._nodes:
+            self.remove(node_id)
+
+        self._nodes[node_id] = config
+        self._types[node_id] = config["systemSettings"].get("type")
+        self._adj.setdefault(node_id, {})
+        channels = self._channels[node_id] = {}
+        links = self._links[node_id] = {}
+        for ch in config.get("channels", []):
+            ch_id = str(ch.get("ID"))
+            channels[ch_id] = ch
+            neighbor = ch.get("neighbor") or {}
+            remote = neighbor.get("systemRef")
+            if remote is None:
+                continue
+            remote_channel = neighbor.get("channelRef")
+            link = Link(node_id, ch_id, str(remote), None if remote_channel is None else str(remote_channel))
+            links[ch_id] = link
+            self._referrers.setdefault(link.remote, set()).add(link)
+            self._resolve(link)
+
+        # links of other nodes that were waiting for this one
+        for link in self._referrers.get(node_id, ()):
+            if link.node != node_id:
+                self._resolve(link)
+        return node_id
+
+    def remove(self, node_id):
+        """ remove a node, the references to it become dangling """
+        if node_id not in self._nodes:
+            raise KeyError(node_id)
+        for link in self._links.pop(node_id).values():
+            refs = self._referrers.get(link.remote)
+            refs.discard(link)
+            if not refs:
+                del self._referrers[link.remote]
+            self._unresolve(link)
+            self._dangling.discard(link)
+        for link in self._referrers.get(node_id, ()):
+            if link.resolved:
+                self._unresolve(link)
+                self._dangling.add(link)
+        del self._nodes[node_id]
+        del self._types[node_id]
+        del self._channels[node_id]
+        del self._adj[node_id]
+
+    def _resolve(self, link):
+        channels = self._channels.get(link.remote)
+        if channels is None or (link.remote_channel is not None and link.remote_channel not in channels):
+            self._dangling.add(link)
+            return
+        self._dangling.discard(link)
+        if not link.resolved:
+            link.resolved = True
+            self._connect(link.node, link.remote, 1)
+
+    def _unresolve(self, link):
+        if link.resolved:
+            link.resolved = False
+            self._connect(link.node, link.remote, -1)
+
+    def _connect(self, a, b, n):
+        """ count the links between a and b, the neighbor sets change when a count goes to or from 0 """
+        changed = False
+        for x, y in ((a, b), (b, a)):
+            adj = self._adj[x]
+            count = adj.get(y, 0) + n
+            if count:
+                changed |= y not in adj
+                adj[y] = count
+            else:
+                del adj[y]
+                changed = True
+            if a == b:
+                break
+        if changed:
+            self._version += 1
+            self._path_cache.clear()
+
+    def register(self, msg):
+        """ add the node of an agentRegister message """
+        msg = self._as_dict(msg)
+        node_id = self.add(msg["payload"])
+        agent = msg.get("agentId")
+        if agent is not None:
+            self._agents[agent] = node_id
+        return node_id
+
+    def deregister(self, msg):
+        """ remove the node of an agentDeregister message """
+        agent = self._as_dict(msg).get("agentId")
+        node_id = self._agents.pop(agent, agent)
+        self.remove(node_id)
+        return node_id
+
+    def node(self, node_id):
+        return self._nodes.get(node_id)
+
+    def node_type(self, node_id):
+        return self._types.get(node_id)
+
+    def nodes(self, node_type=None):
+        if node_type is None:
+            return list(self._nodes)
+        return [n for n, t in self._types.items() if t == node_type]
+
+    def channel(self, node_id, channel_id):
+        return self._channels.get(node_id, {}).get(str(channel_id))
+
+    def peer(self, node_id, channel_id):
+        """ return (node, channel) at the remote end of a channel, None if unknown or dangling """
+        link = self._links.get(node_id, {}).get(str(channel_id))
+        if link is None or not link.resolved:
+            return None
+        return link.remote, link.remote_channel
+
+    def neighbors(self, node_id):
+        """ return the IDs of the nodes linked to node_id in either direction """
+        return self._adj[node_id].keys()
+
+    def degree(self, node_id):
+        return len(self._adj[node_id])
+
+    def dangling(self):
+        """ return the unresolved references as (node, channel, systemRef, channelRef) """
+        return sorted((link.node, link.channel, link.remote, link.remote_channel) for link in self._dangling)
+
+    def _tree(self, src):
+        """ breadth first predecessor map of src, cached """
+        tree = self._path_cache.get(src)
+        if tree is not None:
+            self._path_cache.move_to_end(src)
+            return tree
+        tree = {src: None}
+        queue = deque([src])
+        adj = self._adj
+        while queue:
+            u = queue.popleft()
+            for v in adj[u]:
+                if v not in tree:
+                    tree[v] = u
+                    queue.append(v)
+        self._path_cache[src] = tree
+        if len(self._path_cache) > self._path_cache_size:
+            self._path_cache.popitem(last=False)
+        return tree
+
+    def shortest_path(self, src, dst):
+        """ return the node IDs of a shortest path from src to dst, None if unreachable """
+        if src not in self._nodes:
+            raise KeyError(src)
+        if dst not in self._nodes:
+            raise KeyError(dst)
+        tree = self._tree(src)
+        if dst not in tree:
+            return None
+        path = [dst]
+        while path[-1] != src:
+            path.append(tree[path[-1]])
+        path.reverse()
+        return path
@@ -1,2 +1,3 @@
 class Constants:
     DEFAULT_RPC_TOPIC = "rpc/qn-server"
+    BATCH_CMD = "$batch"